@@ -19,13 +19,17 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import struct
+import threading
 import time
-import smbus
 
 TCS34725_ADDRESS          = 0x29
 TCS34725_ID               = 0x12 # 0x44 = TCS34721/TCS34725, 0x4D = TCS34723/TCS34727
 
 TCS34725_COMMAND_BIT      = 0x80
+TCS34725_COMMAND_AUTO_INC = 0x20 # Auto-increment protocol transaction, register address increments after each byte
+TCS34725_COMMAND_SPECIAL  = 0x60 # Special function
+TCS34725_SPECIAL_INT_CLEAR = 0x06 # Clear channel interrupt clear
 
 TCS34725_ENABLE           = 0x00
 TCS34725_ENABLE_AIEN      = 0x10 # RGBC Interrupt Enable
@@ -58,6 +62,8 @@ TCS34725_PERS_45_CYCLE    = 0b1100 # 45 clean channel values outside threshold r
 TCS34725_PERS_50_CYCLE    = 0b1101 # 50 clean channel values outside threshold range generates an interrupt
 TCS34725_PERS_55_CYCLE    = 0b1110 # 55 clean channel values outside threshold range generates an interrupt
 TCS34725_PERS_60_CYCLE    = 0b1111 # 60 clean channel values outside threshold range generates an interrupt
+# Number of consecutive cycles outside the threshold range per persistence setting
+PERS_CYCLES = (1, 1, 2, 3, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60)
 TCS34725_CONFIG           = 0x0D
 TCS34725_CONFIG_WLONG     = 0x02 # Choose between short and long (12x) wait times via TCS34725_WTIME
 TCS34725_CONTROL          = 0x0F # Set the gain level for the sensor
@@ -75,6 +81,10 @@ TCS34725_GDATAH           = 0x19
 TCS34725_BDATAL           = 0x1A # Blue channel data
 TCS34725_BDATAH           = 0x1B
 
+# CDATAL..BDATAH are contiguous, so all four channels can be read in one block transaction.
+TCS34725_RGBC_BLOCK_LEN   = 8
+TCS34725_RGBC_BLOCK_FMT   = '<HHHH' # Little endian: clear, red, green, blue
+
 TCS34725_INTEGRATIONTIME_2_4MS  = 0xFF   #  2.4ms - 1 cycle    - Max Count: 1024
 TCS34725_INTEGRATIONTIME_24MS   = 0xF6   #  24ms  - 10 cycles  - Max Count: 10240
 TCS34725_INTEGRATIONTIME_50MS   = 0xEB   #  50ms  - 20 cycles  - Max Count: 20480
@@ -87,6 +97,14 @@ TCS34725_GAIN_4X                  = 0x01   #  2x gain
 TCS34725_GAIN_16X                 = 0x02   #  16x gain
 TCS34725_GAIN_60X                 = 0x03   #  60x gain
 
+# Ways to find out if a new sample is available:
+READY_MODE_SLEEP          = 'sleep'     # Sleep for the integration time (times sleepfactor)
+READY_MODE_STATUS         = 'status'    # Poll the STATUS register until a new integration cycle completed
+READY_MODE_INTERRUPT      = 'interrupt' # Wait for the INT pin (needs a GPIO module and a pin)
+READY_MODES = (READY_MODE_SLEEP, READY_MODE_STATUS, READY_MODE_INTERRUPT)
+READY_POLL_INTERVAL       = 0.0005 # seconds between two STATUS reads
+READY_TIMEOUT_FACTOR      = 3.0    # wait at most this many integration times for a sample
+
 # Lookup table for integration time delays.
 INTEGRATION_TIME_DELAY = {
     0xFF: 0.0024,  # 2.4ms - 1 cycle    - Max Count: 1024
@@ -97,8 +115,31 @@ INTEGRATION_TIME_DELAY = {
     0x00: 0.700    # 700ms - 256 cycles - Max Count: 65535
 }
 
+# Factor of each gain setting
+GAIN_FACTOR = {
+    TCS34725_GAIN_1X: 1,
+    TCS34725_GAIN_4X: 4,
+    TCS34725_GAIN_16X: 16,
+    TCS34725_GAIN_60X: 60
+}
+
 
 # Utility methods:
+def get_max_count(integration_time):
+    """Returns the highest value of a channel for integration_time (see
+    INTEGRATION_TIME_DELAY), 1024 per integration cycle.
+    """
+    return min(1024 * (256 - integration_time), 0xFFFF)
+
+
+def get_count_scale(integration_time, gain, ref_integration_time, ref_gain):
+    """Returns the factor between the readings with integration_time and gain and
+    the readings of the same light with ref_integration_time and ref_gain.
+    """
+    return 1.0 * (256 - integration_time) * GAIN_FACTOR[gain] / \
+        ((256 - ref_integration_time) * GAIN_FACTOR[ref_gain])
+
+
 def calculate_color_temperature(r, g, b):
     """Converts the raw R/G/B values to color temperature in degrees Kelvin."""
     # 1. Map RGB values to their XYZ counterparts.
@@ -133,10 +174,20 @@ class TCS34725(object):
     """TCS34725 color sensor."""
 
     def __init__(self, integration_time=TCS34725_INTEGRATIONTIME_2_4MS,
-                 gain=TCS34725_GAIN_4X, address=TCS34725_ADDRESS, i2c=1):
-        """Initialize the TCS34725 sensor."""
+                 gain=TCS34725_GAIN_4X, address=TCS34725_ADDRESS, i2c=1,
+                 monotonic=time.monotonic, sleep=time.sleep):
+        """Initialize the TCS34725 sensor. i2c is either the bus number or an
+        already opened SMBus compatible object. monotonic and sleep are the time
+        base used for all delays.
+        """
+        self._monotonic = monotonic
+        self._sleep = sleep
         # Setup I2C interface for the device.
-        self.i2c = smbus.SMBus(i2c)
+        if isinstance(i2c, int):
+            # Only needed on the target
+            import smbus
+            i2c = smbus.SMBus(i2c)
+        self.i2c = i2c
         self.i2c_address = address
         # Make sure we're connected to the sensor.
         chip_id = self._readU8(TCS34725_ID)
@@ -148,6 +199,10 @@ class TCS34725(object):
         # Enable the device (by default, the device is in power down mode on bootup).
         self.enable()
         self.sleepfactor = 1.0
+        self.ready_mode = READY_MODE_SLEEP
+        self._gpio = None
+        self._int_pin = None
+        self._int_event = threading.Event()
 
     def _readU8(self, reg):
         """Read an unsigned 8-bit register."""
@@ -158,6 +213,16 @@ class TCS34725(object):
         bytes = self.i2c.read_i2c_block_data(self.i2c_address, TCS34725_COMMAND_BIT | reg, 2)
         return bytes[0] + 256 * bytes[1]
 
+    def _readRGBC(self):
+        """Read all color registers (CDATAL..BDATAH) with one auto-increment
+        block transaction. Returns a 4-tuple with red, green, blue and clear.
+        """
+        data = self.i2c.read_i2c_block_data(self.i2c_address,
+                                            TCS34725_COMMAND_BIT | TCS34725_COMMAND_AUTO_INC | TCS34725_CDATAL,
+                                            TCS34725_RGBC_BLOCK_LEN)
+        c, r, g, b = struct.unpack(TCS34725_RGBC_BLOCK_FMT, bytes(data))
+        return (r, g, b, c)
+
     def _write8(self, reg, value):
         """Write a 8-bit value to a register."""
         self.i2c.write_byte_data(self.i2c_address, TCS34725_COMMAND_BIT | reg, value)
@@ -166,7 +231,7 @@ class TCS34725(object):
         """Enable the chip."""
         # Flip on the power and enable bits.
         self._write8(TCS34725_ENABLE, TCS34725_ENABLE_PON)
-        time.sleep(0.01)
+        self._sleep(0.01)
         self._write8(TCS34725_ENABLE, (TCS34725_ENABLE_PON | TCS34725_ENABLE_AEN))
 
     def disable(self):
@@ -195,6 +260,12 @@ class TCS34725(object):
         """
         return self._readU8(TCS34725_ATIME)
 
+    def get_sample_time(self):
+        """Return the time in seconds until the next sample is available, the
+        integration time.
+        """
+        return INTEGRATION_TIME_DELAY[self._integration_time]
+
     def set_gain(self, gain):
         """Adjusts the gain on the TCS34725 (adjusts the sensitivity to light).
         Use one of the following constants:
@@ -211,20 +282,168 @@ class TCS34725(object):
         """
         return self._readU8(TCS34725_CONTROL)
 
+    def set_int_pin(self, gpio, int_pin):
+        """Connects the INT output of the sensor. gpio is the GPIO module (e.g.
+        RPi.GPIO) and int_pin the (BCM) pin the INT line is connected to. Use
+        None as int_pin to disconnect.
+        """
+        if self._int_pin is not None:
+            self._gpio.remove_event_detect(self._int_pin)
+        self._gpio = gpio
+        self._int_pin = int_pin
+        if int_pin is None:
+            return
+        # INT is an open drain output, active low
+        gpio.setup(int_pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+        gpio.add_event_detect(int_pin, gpio.FALLING, callback=self._on_interrupt)
+
+    def has_int_pin(self):
+        """Return True if the INT output is connected."""
+        return self._int_pin is not None
+
+    def set_ready_mode(self, mode, gpio=None, int_pin=None):
+        """Selects how get_raw_data waits for a new sample. Use one of the
+        READY_MODES:
+         - READY_MODE_SLEEP      = sleep for sleepfactor * integration time
+         - READY_MODE_STATUS     = poll the STATUS register for a completed cycle
+         - READY_MODE_INTERRUPT  = wait for a falling edge on the INT pin, needs
+                                   gpio and int_pin (see set_int_pin) or an
+                                   already connected INT pin
+        In status and interrupt mode every integration cycle raises the clear
+        channel interrupt, which is cleared after each read. Therefore each read
+        returns the result of an integration cycle that was not read before.
+        """
+        if mode not in READY_MODES:
+            raise ValueError('Unknown ready mode %s, use one of %s' % (mode, str(READY_MODES)))
+        if gpio is not None and int_pin is not None:
+            self.set_int_pin(gpio, int_pin)
+        if mode == READY_MODE_INTERRUPT and not self.has_int_pin():
+            raise ValueError('Ready mode %s needs a gpio module and an int_pin' % mode)
+        self.ready_mode = mode
+        self._restore_interrupt()
+
+    def _restore_interrupt(self):
+        """Configure the interrupt as needed by the ready mode."""
+        if self.ready_mode == READY_MODE_SLEEP:
+            self._set_enable_bits(TCS34725_ENABLE_AIEN, False)
+            self.clear_interrupt()
+            return
+        # Every integration cycle generates an interrupt
+        self.set_persistence(TCS34725_PERS_NONE)
+        self._int_event.clear()
+        self.clear_interrupt()
+        self._set_enable_bits(TCS34725_ENABLE_AIEN, True)
+
+    def wait_clear_threshold(self, low, high, persistence=TCS34725_PERS_1_CYCLE, timeout=None):
+        """Blocks until the clear channel was below low or above high for the
+        number of cycles given by persistence (one of the TCS34725_PERS_*
+        constants). The sensor does the comparison, the host just waits for the
+        INT pin, so no I2C traffic is caused while waiting. Returns False if
+        timeout (seconds) expired before.
+        """
+        self.arm_clear_threshold(low, high, persistence)
+        try:
+            return self.wait_clear_interrupt(timeout)
+        finally:
+            self.disarm_clear_threshold()
+
+    def arm_clear_threshold(self, low, high, persistence=TCS34725_PERS_1_CYCLE):
+        """Starts the comparison of wait_clear_threshold without waiting. The
+        sensor counts the cycles of persistence from now on, wait with
+        wait_clear_interrupt and restore the ready mode with
+        disarm_clear_threshold.
+        """
+        if not self.has_int_pin():
+            raise RuntimeError('Waiting for a clear channel threshold needs the INT pin')
+        self.set_interrupt_limits(low, high)
+        self.set_persistence(persistence)
+        self._int_event.clear()
+        self.clear_interrupt()
+        self._set_enable_bits(TCS34725_ENABLE_AIEN, True)
+
+    def wait_clear_interrupt(self, timeout=None):
+        """Waits for the interrupt armed by arm_clear_threshold. Returns False if
+        timeout (seconds) expired before. After the timeout the STATUS register
+        is checked for an interrupt whose edge was missed. The sensor keeps
+        counting, so the wait may be repeated.
+        """
+        if self._int_event.wait(timeout):
+            return True
+        return bool(self._readU8(TCS34725_STATUS) & TCS34725_STATUS_AINT)
+
+    def disarm_clear_threshold(self):
+        """Configures the interrupt for the ready mode again."""
+        self._restore_interrupt()
+
+    def _on_interrupt(self, channel):
+        self._int_event.set()
+
+    def data_ready(self):
+        """Returns True if an integration cycle completed since the last read.
+        Only meaningful in status and interrupt ready mode.
+        """
+        status = self._readU8(TCS34725_STATUS)
+        return (status & (TCS34725_STATUS_AINT | TCS34725_STATUS_AVALID)) == \
+            (TCS34725_STATUS_AINT | TCS34725_STATUS_AVALID)
+
+    def wait_data_ready(self):
+        """Blocks until a new sample is available according to the ready mode.
+        Returns False if no new sample was signalled within READY_TIMEOUT_FACTOR
+        integration times.
+        """
+        delay = INTEGRATION_TIME_DELAY[self._integration_time]
+        if self.ready_mode == READY_MODE_SLEEP:
+            self._sleep(self.sleepfactor * delay)
+            return True
+        timeout = READY_TIMEOUT_FACTOR * delay
+        if self.ready_mode == READY_MODE_INTERRUPT:
+            if self._int_event.wait(timeout):
+                return True
+            # Missed an edge? Double check the status register
+            return self.data_ready()
+        deadline = self._monotonic() + timeout
+        while not self.data_ready():
+            if self._monotonic() > deadline:
+                return False
+            self._sleep(READY_POLL_INTERVAL)
+        return True
+
+    def _sample_done(self):
+        if self.ready_mode != READY_MODE_SLEEP:
+            self._int_event.clear()
+            self.clear_interrupt()
+
     def get_raw_data(self):
         """Reads the raw red, green, blue and clear channel values. Will return
         a 4-tuple with the red, green, blue, clear color values (unsigned 16-bit
         numbers).
         """
-        # Delay for the integration time to allow proper reading.
-        time.sleep(self.sleepfactor * INTEGRATION_TIME_DELAY[self._integration_time])
+        # Wait for the integration time to allow proper reading.
+        self.wait_data_ready()
 
-        # Read each color register.
-        r = self._readU16LE(TCS34725_RDATAL)
-        g = self._readU16LE(TCS34725_GDATAL)
-        b = self._readU16LE(TCS34725_BDATAL)
-        c = self._readU16LE(TCS34725_CDATAL)
-        return (r, g, b, c)
+        # Read all color registers at once.
+        rgbc = self._readRGBC()
+        self._sample_done()
+        return rgbc
+
+    def read_raw_data(self):
+        """Reads the raw red, green, blue and clear channel values of the last
+        completed integration cycle right away, the caller takes care that a new
+        sample is available (see get_sample_time()).
+        """
+        return self._readRGBC()
+
+    def get_raw_data_many(self, n):
+        """Reads n consecutive samples. Will return a numpy array with shape
+        (n, 4) holding red, green, blue and clear per row (unsigned 16-bit).
+        """
+        import numpy
+        res = numpy.empty((n, 4), dtype=numpy.uint16)
+        for i in range(n):
+            self.wait_data_ready()
+            res[i] = self._readRGBC()
+            self._sample_done()
+        return res
 
     def set_sleep_factor(self, factor):
         self.sleepfactor = factor
@@ -237,16 +456,32 @@ class TCS34725(object):
         else:
             enable_reg &= ~TCS34725_ENABLE_AIEN
         self._write8(TCS34725_ENABLE, enable_reg)
-        time.sleep(1)
+        self._sleep(1)
+
+    def _set_enable_bits(self, bits, enabled):
+        """Set or clear bits in the enable register without any delay."""
+        enable_reg = self._readU8(TCS34725_ENABLE)
+        if enabled:
+            enable_reg |= bits
+        else:
+            enable_reg &= ~bits
+        self._write8(TCS34725_ENABLE, enable_reg)
 
     def clear_interrupt(self):
         """Clear interrupt."""
-        self._device.write8(0x66 & 0xff)
+        self.i2c.write_byte(self.i2c_address,
+                            TCS34725_COMMAND_BIT | TCS34725_COMMAND_SPECIAL | TCS34725_SPECIAL_INT_CLEAR)
 
     def set_interrupt_limits(self, low, high):
         """Set the interrupt limits to provied unsigned 16-bit threshold values.
         """
-        self._device.write8(0x04, low & 0xFF)
-        self._device.write8(0x05, low >> 8)
-        self._device.write8(0x06, high & 0xFF)
-        self._device.write8(0x07, high >> 8)
+        self._write8(TCS34725_AILTL, low & 0xFF)
+        self._write8(TCS34725_AILTH, low >> 8)
+        self._write8(TCS34725_AIHTL, high & 0xFF)
+        self._write8(TCS34725_AIHTH, high >> 8)
+
+    def set_persistence(self, persistence):
+        """Set how many consecutive cycles outside the interrupt limits are needed
+        to raise an interrupt. Use one of the TCS34725_PERS_* constants.
+        """
+        self._write8(TCS34725_PERS, persistence)
@@ -0,0 +1,149 @@
+"""Sensor acquisition thread for app2.
+
+AcquisitionThread reads the sensor continuously and puts timestamped samples (t, r, g, b, c)
+into a SampleBuffer, detection, stabilisation and classification consume them. The sensor is
+read again as soon as a sample is taken, no matter how long the consumer needs for a sample.
+If the consumer falls behind the buffer drops the oldest samples and counts them.
+While waiting for the INT pin of the sensor the thread is paused, it does not read the sensor
+until it is resumed.
+"""
+
+import collections
+import threading
+
+from helper import prerr
+
+DEF_SAMPLE_BUFFER_SIZE = 64
+
+# get() checks this often (in s) whether the acquisition thread is still alive
+ACQUISITION_GET_TIMEOUT = 1.0
+
+
+class SampleBuffer(object):
+    """ Bounded FIFO of samples, put() drops the oldest sample if it is full. A sample is a
+        tuple starting with its timestamp. Samples older than skip_before() are not returned.
+    """
+    def __init__(self, size=DEF_SAMPLE_BUFFER_SIZE):
+        self.size = size
+        self.produced = 0
+        self.consumed = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.closed = False
+        self._samples = collections.deque(maxlen=size)
+        self._latest = None
+        self._not_before = None
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._samples)
+
+    def put(self, sample):
+        with self._cond:
+            if len(self._samples) == self.size:
+                self.dropped += 1
+            self._samples.append(sample)
+            self._latest = sample
+            self.produced += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """ Returns the oldest sample not before the skip_before() time. Waits at most timeout
+            seconds for it, returns None if there is none or the buffer was closed.
+        """
+        with self._cond:
+            while 42:
+                while self._samples:
+                    sample = self._samples.popleft()
+                    if self._not_before is not None and sample[0] < self._not_before:
+                        self.skipped += 1
+                        continue
+                    self.consumed += 1
+                    return sample
+                if self.closed or not self._cond.wait(timeout):
+                    return None
+
+    def latest(self):
+        """ Returns the newest sample put, consumed or not (None if there is none yet) """
+        with self._cond:
+            return self._latest
+
+    def skip_before(self, t):
+        """ From now on samples taken before t are skipped, e.g. the ones integrated before the LED was switched """
+        with self._cond:
+            self._not_before = t
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class AcquisitionThread(threading.Thread):
+    def __init__(self, read, buffer, clock):
+        """ read() returns the next (r, g, b, c) of the sensor, e.g. TCS34725.get_raw_data,
+            clock() the timestamp of the samples.
+        """
+        threading.Thread.__init__(self, name='acquisition', daemon=True)
+        self.read = read
+        self.buffer = buffer
+        self.clock = clock
+        self.error = None
+        self.paused = False
+        self._reading = False
+        self._exit = threading.Event()
+        self._cond = threading.Condition()
+
+    def run(self):
+        try:
+            while 42:
+                with self._cond:
+                    while self.paused and not self._exit.is_set():
+                        self._cond.wait()
+                    if self._exit.is_set():
+                        return
+                    self._reading = True
+                try:
+                    r, g, b, c = self.read()
+                finally:
+                    with self._cond:
+                        self._reading = False
+                        self._cond.notify_all()
+                self.buffer.put((self.clock(), r, g, b, c))
+        except Exception as e:
+            self.error = e
+            prerr('acquisition: Reading the sensor failed: %s', e)
+        finally:
+            self.buffer.close()
+
+    def get(self):
+        """ Returns the next sample (t, r, g, b, c), raises RuntimeError if the thread ended """
+        while 42:
+            sample = self.buffer.get(ACQUISITION_GET_TIMEOUT)
+            if sample is not None:
+                return sample
+            if not self.is_alive():
+                raise RuntimeError('Acquisition thread ended: %s' % self.error)
+
+    def pause(self):
+        """ Stops reading the sensor, returns once a read in progress is done. The sensor may be
+            used by the caller until resume().
+        """
+        with self._cond:
+            self.paused = True
+            while self._reading:
+                self._cond.wait()
+
+    def resume(self):
+        """ Reads the sensor again, the samples taken before are skipped """
+        self.buffer.skip_before(self.clock())
+        with self._cond:
+            self.paused = False
+            self._cond.notify_all()
+
+    def exit(self, timeout=None):
+        self._exit.set()
+        with self._cond:
+            self._cond.notify_all()
+        self.join(timeout)
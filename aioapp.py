@@ -0,0 +1,160 @@
+"""asyncio runtime of multi (ledsense.py multi --asyncio).
+
+The sensors of config['sensors'] run as tasks of one event loop instead of threads. Like
+ledsense.py multi, and unlike app2, each head is the state machine of multisensor.SensorHead.
+There is a task per sensor head advancing its state machine, a task per player, the periodic
+RGB log and a health check. The blocking calls run in executors, the I2C reads in one and
+the audio output in another, so decoding the tracks never delays a sample. The tasks wait
+on timers and queues, an idle station does not poll, and more sensors or duties mean more
+tasks, not more threads.
+
+The first task that ends or fails stops the station, all tasks are cancelled and awaited.
+Times are seconds of backend.monotonic, with the sim backend the loop timers are scaled.
+"""
+
+import asyncio
+import concurrent.futures
+
+import backend
+import multisensor
+import play_music
+from helper import pr, prerr
+
+# Seconds between two RGB logs of all heads
+AIO_LOG_RGB_INT = 10
+# Seconds between two health checks, a head without a new sample since the last check stalled
+AIO_HEALTH_INT = 5
+
+
+def to_wall(seconds):
+    """ Returns seconds of backend.monotonic as seconds of the wall clock, the loop timers use """
+    return seconds / backend.get_speed()
+
+
+class AsyncPlayer(play_music.Player):
+    """ Player driven by the commands of start_playing() and stop_playing(), run() executes
+        them in the executor. Only while a track is playing the sink is polled to notice its
+        end, an idle player waits on its queue.
+    """
+    def __init__(self, mp3_index, station, executor, sink=None, cache_max_bytes=play_music.DEF_AUDIO_CACHE_MAX_BYTES):
+        play_music.Player.__init__(self, mp3_index, station, sink, cache_max_bytes)
+        self.executor = executor
+        # Bound to the running loop, see run_station()
+        self._queue = asyncio.Queue()
+
+    def start_playing(self, color):
+        self._queue.put_nowait((play_music.CMD_START, color))
+
+    def stop_playing(self):
+        self._queue.put_nowait((play_music.CMD_STOP, None))
+
+    async def run(self):
+        """ Runs until cancelled, the track still playing is stopped by stop_track() in the
+            executor afterwards (see run_station)
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.setup)
+        while 42:
+            if self.playing is None:
+                name, color = await self._queue.get()
+            else:
+                try:
+                    name, color = await asyncio.wait_for(self._queue.get(),
+                                                         to_wall(play_music.BUSY_POLL_INTERVAL))
+                except asyncio.TimeoutError:
+                    self.check_finished()
+                    continue
+            if name == play_music.CMD_START:
+                await loop.run_in_executor(self.executor, self.start_track, color)
+            else:
+                await loop.run_in_executor(self.executor, self.stop_track)
+
+
+async def run_head(head, executor):
+    """ Reads the samples of head when they are due and advances its state machine """
+    loop = asyncio.get_running_loop()
+    while 42:
+        wait = head.next_due - head.clock()
+        if wait > 0:
+            await asyncio.sleep(to_wall(wait))
+        now = head.clock()
+        head.process(now, await loop.run_in_executor(executor, head.tcs.read_raw_data))
+
+
+async def log_rgb(heads, interval=AIO_LOG_RGB_INT):
+    while 42:
+        await asyncio.sleep(to_wall(interval))
+        for head in heads:
+            pr('%s: RGBC : %s - %d samples', head.name, head.last_rgbc, head.samples)
+
+
+async def check_health(heads, interval=AIO_HEALTH_INT):
+    """ Returns as soon as a head took no sample for interval seconds """
+    samples = [head.samples for head in heads]
+    while 42:
+        await asyncio.sleep(to_wall(interval))
+        for i, head in enumerate(heads):
+            if head.samples == samples[i]:
+                prerr('%s: No sample for %d s', head.name, interval)
+                return
+            samples[i] = head.samples
+
+
+async def run_station(sensors, config, gpio, classifier, holdoff, duration=None, log_rgb_int=AIO_LOG_RGB_INT,
+                      health_int=AIO_HEALTH_INT):
+    """ Runs the station for duration seconds (forever if None), until a task ends or until
+        it is cancelled. sensors as returned by ledsense.setup_sensors(), each one plays the
+        MP3 files of its station. classifier and holdoff as for multisensor.SensorHead.
+        Returns the throughput per sensor (see multisensor.get_throughput).
+    """
+    i2c_executor = concurrent.futures.ThreadPoolExecutor(1, 'aio_i2c')
+    audio_executor = concurrent.futures.ThreadPoolExecutor(1, 'aio_audio')
+    players = {}
+    # The players share the memory of one audio cache
+    cache_max_bytes = play_music.DEF_AUDIO_CACHE_MAX_BYTES // len(sensors)
+
+    def on_color(head, color):
+        if color is None:
+            pr('%s: Max RGB color distance exceeded. Not playing...', head.name)
+            return
+        players[head.name].start_playing(color[0])
+
+    def on_removed(head):
+        players[head.name].stop_playing()
+
+    heads = []
+    for name, tcs, led_pin, station in sensors:
+        players[name] = AsyncPlayer(config.mp3_index, station, audio_executor, cache_max_bytes=cache_max_bytes)
+        heads.append(multisensor.SensorHead(name, tcs, gpio, led_pin, station, config['det'], config['rgb'],
+                                            classifier, holdoff, backend.monotonic, on_color, on_removed))
+
+    tasks = {}
+    for head in heads:
+        tasks[asyncio.ensure_future(run_head(head, i2c_executor))] = head.name
+    for name, player in players.items():
+        tasks[asyncio.ensure_future(player.run())] = 'play_music %s' % name
+    tasks[asyncio.ensure_future(log_rgb(heads, log_rgb_int))] = 'log_rgb'
+    tasks[asyncio.ensure_future(check_health(heads, health_int))] = 'check_health'
+
+    start = backend.monotonic()
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=None if duration is None else to_wall(duration),
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is not None:
+                prerr('Task %s failed: %s. Exiting...', tasks[task], task.exception())
+            else:
+                prerr('Task %s ended. Exiting...', tasks[task])
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # The sink calls block, not in the loop
+        loop = asyncio.get_running_loop()
+        for player in players.values():
+            await loop.run_in_executor(audio_executor, player.stop_track)
+        i2c_executor.shutdown()
+        audio_executor.shutdown()
+        throughput = multisensor.get_throughput(heads, backend.monotonic() - start)
+        multisensor.report(throughput)
+    return throughput
@@ -0,0 +1,144 @@
+"""Hardware backends.
+
+rpi: the real hardware, RPi.GPIO, smbus, pygame and alsaaudio (imported on first use)
+sim: simulated sensor, GPIOs and audio output, runs on any Linux box (see sim.py)
+
+The selected backend also provides the time base (monotonic/sleep), with the sim
+backend time may run faster than the wall clock.
+"""
+
+import time
+
+BACKEND_RPI = 'rpi'
+BACKEND_SIM = 'sim'
+BACKENDS = (BACKEND_RPI, BACKEND_SIM)
+
+SIM_SOURCE_CUBES = 'cubes'
+SIM_SOURCE_TRACE = 'trace'
+
+name = BACKEND_RPI
+config_sim = {}
+monotonic = time.monotonic
+sleep = time.sleep
+
+_gpio = None
+_sim_clock = None
+# TCA9548A drivers by (bus, address), see get_mux_i2c
+_muxes = {}
+
+
+def select(backend, sim_config=None):
+    """ Selects the backend, sim_config is the 'sim' section of the configuration
+        (see config.DEF_SIM_CONFIG).
+    """
+    global name, config_sim, monotonic, sleep, _gpio, _sim_clock, _muxes
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend %s, use one of %s' % (backend, str(BACKENDS)))
+    from config import DEF_SIM_CONFIG
+    name = backend
+    config_sim = dict(DEF_SIM_CONFIG)
+    config_sim.update(sim_config or {})
+    _gpio = None
+    _muxes = {}
+    if backend == BACKEND_SIM:
+        from sim import SimClock
+        _sim_clock = SimClock(config_sim['speed'])
+        monotonic = _sim_clock.monotonic
+        sleep = _sim_clock.sleep
+    else:
+        _sim_clock = None
+        monotonic = time.monotonic
+        sleep = time.sleep
+
+
+def set_clock(new_monotonic, new_sleep):
+    """ Replaces the time base of the selected backend, e.g. by the one of a replayed trace
+        (see rgbctrace.ReplaySensor). Call get_gpio() afterwards, the simulated GPIOs keep
+        the clock they were created with.
+    """
+    global monotonic, sleep
+    monotonic = new_monotonic
+    sleep = new_sleep
+
+
+def is_sim():
+    return name == BACKEND_SIM
+
+
+def get_speed():
+    """ Returns how many times faster than the wall clock monotonic runs """
+    return _sim_clock.speed if _sim_clock is not None else 1.0
+
+
+def get_gpio():
+    """ Returns the GPIO module. The simulated GPIOs are wired as the station
+        configured in config_sim.
+    """
+    global _gpio
+    if _gpio is not None:
+        return _gpio
+    if name == BACKEND_SIM:
+        from config import DEF_STATION_GPIO_MAP, DEF_STATION_GPIOS
+        from sim import SimGPIO
+        _gpio = SimGPIO(clock=monotonic)
+        for gpios, station in DEF_STATION_GPIO_MAP:
+            if station == config_sim['station']:
+                for gpio, level in zip(DEF_STATION_GPIOS, gpios):
+                    _gpio.set_input(gpio, level)
+    else:
+        import RPi.GPIO as GPIO
+        _gpio = GPIO
+    return _gpio
+
+
+def get_i2c(bus, colors=None, led_pin=None, int_pin=None, reference=None):
+    """ Returns what TCS34725 expects as i2c argument: the bus number for the real
+        hardware or a simulated bus. The simulated cubes use colors (as
+        config['color']), the LED state is read from led_pin and the INT output
+        is wired to int_pin if given. The simulated readings are for the
+        (integration_time, gain) reference, see SimTCS34725Bus.
+    """
+    if name != BACKEND_SIM:
+        return bus
+    from sim import CubeSource, SimTCS34725Bus, TraceSource
+    gpio = get_gpio()
+    if config_sim['source'] == SIM_SOURCE_TRACE:
+        source = TraceSource(config_sim['trace'], loop=config_sim['loop'])
+    elif config_sim['source'] == SIM_SOURCE_CUBES:
+        source = CubeSource(colors, gpio, led_pin,
+                            present=config_sim['present'],
+                            absent=config_sim['absent'],
+                            ambient=config_sim['ambient'],
+                            led_settle=config_sim['led_settle'],
+                            noise=config_sim['noise'],
+                            repeat=config_sim['repeat'],
+                            shuffle=config_sim['shuffle'],
+                            seed=config_sim['seed'])
+    else:
+        raise ValueError('Unknown sim source %s' % config_sim['source'])
+    sim_bus = SimTCS34725Bus(source=source, transfer_rate=config_sim['transfer_rate'],
+                             clock=monotonic, sleep=sleep, reference=reference)
+    if int_pin is not None:
+        sim_bus.connect_int(gpio, int_pin)
+    return sim_bus
+
+
+def get_mux_i2c(bus, channel, address, colors=None, led_pin=None, reference=None):
+    """ Returns what TCS34725 expects as i2c argument for a sensor on channel of the TCA9548A
+        multiplexer at address on bus. All channels of a multiplexer share its driver. With
+        the sim backend a simulated sensor (see get_i2c) is attached to a simulated multiplexer.
+    """
+    import i2cmux
+    key = (bus, address)
+    if key not in _muxes:
+        if name == BACKEND_SIM:
+            from sim import SimTCA9548A
+            upstream = SimTCA9548A(address, config_sim['transfer_rate'], sleep)
+        else:
+            import smbus
+            upstream = smbus.SMBus(bus)
+        _muxes[key] = i2cmux.TCA9548A(upstream, address)
+    mux = _muxes[key]
+    if name == BACKEND_SIM:
+        mux.bus.attach(channel, get_i2c(bus, colors, led_pin, None, reference))
+    return mux.get_channel(channel)
@@ -0,0 +1,343 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""LED Sensing benchmarks. Runs off target against the simulated sensor.
+
+Usage:
+  bench.py [NAME ...]
+  bench.py --list
+
+Exits with 1 if a benchmark exceeded its budget.
+
+Options:
+  --list        List available benchmarks.
+  -h --help     Show this screen.
+
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+import yaml
+from docopt import docopt
+
+import TCS34725
+import config
+import configyaml
+from classifier import ColorClassifier
+import helper
+from helper import get_rgb_distance
+from sim import SimGPIO, SimTCS34725Bus
+
+BENCH_INT_GPIO = 17
+
+
+def bench_ready_mode(samples=50, integration_time=TCS34725.TCS34725_INTEGRATIONTIME_24MS):
+    """ Sample readiness: fixed integration sleep vs STATUS polling vs INT pin. """
+    cycle_time = TCS34725.INTEGRATION_TIME_DELAY[integration_time]
+
+    def cycle_source(t):
+        # Encode the integration cycle in the clear channel to find stale reads
+        return 0, 0, 0, int(t / cycle_time) & 0xFFFF
+
+    print('%-10s %10s %10s %10s %10s' % ('Mode', 'ms/sample', 'stale', 'skipped', 'I2C/sample'))
+    for mode in TCS34725.READY_MODES:
+        bus = SimTCS34725Bus(source=cycle_source)
+        gpio = SimGPIO()
+        bus.connect_int(gpio, BENCH_INT_GPIO)
+        tcs = TCS34725.TCS34725(integration_time=integration_time, i2c=bus)
+        tcs.set_ready_mode(mode, gpio=gpio, int_pin=BENCH_INT_GPIO)
+        tcs.get_raw_data()
+        stale = 0
+        skipped = 0
+        bus.transactions = 0
+        last = tcs.get_raw_data()[3]
+        start = time.monotonic()
+        for _ in range(samples):
+            c = tcs.get_raw_data()[3]
+            if c == last:
+                stale += 1
+            elif c - last > 1:
+                skipped += c - last - 1
+            last = c
+        duration = time.monotonic() - start
+        print('%-10s %10.2f %10d %10d %10.1f' %
+              (mode, 1000.0 * duration / samples, stale, skipped, 1.0 * bus.transactions / samples))
+
+
+def timeit(func, repeat):
+    """ Returns the average duration of func() in microseconds """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return 1e6 * (time.perf_counter() - start) / repeat
+
+
+def random_palette(color_cnt, seed=0):
+    rand = numpy.random.RandomState(seed)
+    return [['RAL %d' % i, rand.randint(0, 6000, 3).tolist()] for i in range(color_cnt)]
+
+
+def bench_classify(repeat=200):
+    """ Nearest color: linear scan with get_rgb_distance vs ColorClassifier. """
+    def linear_scan(rgb, colors):
+        min_dist = 999999999
+        match = 0
+        for color in colors:
+            dist = get_rgb_distance(rgb, color[1])
+            if dist < min_dist:
+                min_dist = dist
+                match = color
+        return match, min_dist
+
+    rgb = [2500, 2400, 2300]
+    print('%-8s %15s %15s %15s' % ('Colors', 'linear us', 'classifier us', 'build us'))
+    for color_cnt in (30, 300, 3000):
+        colors = random_palette(color_cnt)
+        classifier = ColorClassifier(colors)
+        linear = timeit(lambda: linear_scan(rgb, colors), max(repeat * 30 // color_cnt, 3))
+        indexed = timeit(lambda: classifier.classify(rgb), repeat)
+        build = timeit(lambda: ColorClassifier(colors), 10)
+        print('%-8d %15.1f %15.1f %15.1f' % (color_cnt, linear, indexed, build))
+
+
+def bench_classify_batch(sample_cnt=20000):
+    """ Classifying calibration values: per sample classify() vs classify_batch(). """
+    rand = numpy.random.RandomState(1)
+    samples = rand.randint(0, 6000, (sample_cnt, 3))
+    sample_list = samples.tolist()
+    print('%-8s %10s %15s %15s' % ('Colors', 'Samples', 'per sample ms', 'batch ms'))
+    for color_cnt in (30, 300):
+        classifier = ColorClassifier(random_palette(color_cnt))
+        single = timeit(lambda: [classifier.classify(rgb) for rgb in sample_list], 1) / 1000
+        batch = timeit(lambda: classifier.classify_batch(samples), 3) / 1000
+        print('%-8d %10d %15.1f %15.1f' % (color_cnt, sample_cnt, single, batch))
+
+
+# Budget per call in microseconds for bench_helper, a regression is reported if exceeded.
+# About 4 times the fast path on a desktop PC, to leave room for slower machines.
+BENCH_HELPER_BUDGET = {
+    'get_rgb_distance': 4.0,
+    'get_rgb_length': 3.0,
+    'get_rgb_median': 40.0,
+    'get_rgb_std': 60.0,
+    'get_rgb_distance_array': 40.0,
+    'get_rgb_median_array': 120.0,
+}
+
+
+def bench_helper(repeat=20000):
+    """ Per call cost of the RGB helpers (numpy reference vs fast path) against a budget. """
+    rgb1 = [4080, 3300, 2328]
+    rgb2 = [4188, 3079, 2263]
+    rgb_list = numpy.random.RandomState(0).randint(0, 5000, (10, 3)).tolist()
+    rgb_array = numpy.array(rgb_list)
+    cases = (
+        ('get_rgb_distance',
+         lambda: numpy.linalg.norm(numpy.array(rgb1) - numpy.array(rgb2)).astype(int).tolist(),
+         lambda: helper.get_rgb_distance(rgb1, rgb2)),
+        ('get_rgb_length',
+         lambda: numpy.linalg.norm(rgb1).astype(int).tolist(),
+         lambda: helper.get_rgb_length(rgb1)),
+        ('get_rgb_median',
+         lambda: numpy.median(rgb_list, axis=0).astype(int).tolist(),
+         lambda: helper.get_rgb_median(rgb_list)),
+        ('get_rgb_std',
+         lambda: numpy.std(rgb_list, axis=0).astype(int).tolist(),
+         lambda: helper.get_rgb_std(rgb_list)),
+        ('get_rgb_distance_array',
+         lambda: numpy.linalg.norm(rgb_array - rgb_array[::-1], axis=1).astype(int),
+         lambda: helper.get_rgb_distance_array(rgb_array, rgb_array[::-1])),
+        ('get_rgb_median_array',
+         lambda: numpy.median(rgb_array, axis=0).astype(int),
+         lambda: helper.get_rgb_median_array(rgb_array)),
+    )
+    ok = True
+    print('%-25s %12s %12s %12s' % ('Function', 'numpy us', 'helper us', 'budget us'))
+    for name, reference, func in cases:
+        ref_us = timeit(reference, repeat // 10)
+        func_us = timeit(func, repeat)
+        budget = BENCH_HELPER_BUDGET[name]
+        result = ''
+        if func_us > budget:
+            result = 'REGRESSION'
+            ok = False
+        print('%-25s %12.2f %12.2f %12.2f %s' % (name, ref_us, func_us, budget, result))
+    return ok
+
+
+def bench_mp3_check(path=config.DEF_PATH_MP3):
+    """ Checking the bundled MP3 files: mpck subprocess vs in process frame walker. """
+    paths = sorted(os.path.join(path, fn) for fn in os.listdir(path) if fn.endswith('.mp3'))
+    print('%-10s %8s %12s %12s %8s' % ('Checker', 'Files', 'total ms', 'ms/file', 'Ok'))
+    for name, check in (('mpck', config.check_valid_mp3_content_mpck),
+                        ('native', config.check_valid_mp3_content)):
+        start = time.perf_counter()
+        results = [check(fn) for fn in paths]
+        duration = 1000 * (time.perf_counter() - start)
+        ok = sum(1 for res in results if res.get('result') == 'Ok')
+        if not any(results):
+            print('%-10s %8d %12s %12s %8s' % (name, len(paths), 'n/a', 'n/a', 'n/a'))
+            continue
+        print('%-10s %8d %12.1f %12.2f %8d' % (name, len(paths), duration, duration / len(paths), ok))
+
+
+# Runs ledsense.py detect with the sim backend and exits at the first sensor read
+STARTUP_CHILD = """
+import os, sys, time
+import TCS34725
+def get_raw_data(self):
+    print('first sample %.6f' % time.time())
+    sys.stdout.flush()
+    os._exit(0)
+TCS34725.TCS34725.get_raw_data = get_raw_data
+sys.argv = ['ledsense.py', 'detect', '-b', 'sim'] + sys.argv[1:]
+import ledsense
+ledsense.main()
+"""
+
+
+def time_startup(args, runs=3):
+    """ Returns the best time in ms from process launch until the first measure() """
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        out = subprocess.run([sys.executable, '-c', STARTUP_CHILD] + args, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+        for line in out.splitlines():
+            if line.startswith('first sample'):
+                duration = 1000 * (float(line.split()[2]) - start)
+                best = duration if best is None else min(best, duration)
+    return best
+
+
+def bench_startup(value_cnt=1000):
+    """ Startup: YAML loaders and config cache, process launch until the first sample. """
+    path = tempfile.mkdtemp()
+    try:
+        # A calibration file with many values
+        rand = numpy.random.RandomState(0)
+        cfg = config.load(config.DEF_CONFIG_FN, cache=False).to_dict()
+        cfg['values'] = [[name, rand.randint(0, 6000, (value_cnt, 3)).tolist()] for name, _ in cfg['color']]
+        cal_fn = os.path.join(path, 'cal.yaml')
+        with open(cal_fn, 'w') as outfile:
+            config.dump(cfg, outfile)
+        with open(cal_fn, 'rb') as infile:
+            text = infile.read()
+        print('%-25s %12s' % ('Load %d values' % (len(cfg['values']) * value_cnt), 'ms'))
+        print('%-25s %12.1f' % ('yaml.Loader', timeit(lambda: yaml.load(text, Loader=yaml.Loader), 1) / 1000))
+        print('%-25s %12.1f' % (configyaml.ConfigLoader.__bases__[0].__name__,
+                                timeit(lambda: configyaml.load(text), 1) / 1000))
+        config.load_yaml(cal_fn)
+        print('%-25s %12.1f' % ('cache', timeit(lambda: config.load_yaml(cal_fn), 3) / 1000))
+
+        print()
+        print('%-25s %12s' % ('Start until first sample', 'ms'))
+        config_fn = os.path.join(path, 'config.yaml')
+        shutil.copyfile(config.DEF_CONFIG_FN, config_fn)
+        print('%-25s %12.1f' % ('default config', time_startup([])))
+        print('%-25s %12.1f' % ('config file, no cache', time_startup([config_fn], runs=1)))
+        print('%-25s %12.1f' % ('config file, cached', time_startup([config_fn])))
+    finally:
+        shutil.rmtree(path)
+
+
+class SlowStream(object):
+    """ Log output that takes delay seconds per write, like a slow SD card or serial console """
+    def __init__(self, delay):
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+
+def bench_log_jitter(samples=500, period=0.004, write_delay=0.001):
+    """ Sampling loop jitter with per sample debug logging: disabled vs synchronous vs queued. """
+    root = logging.getLogger()
+    saved_level = root.level
+    saved_handlers = root.handlers[:]
+    bus = SimTCS34725Bus(source=lambda t: (1000, 900, 800, 3000))
+    tcs = TCS34725.TCS34725(integration_time=TCS34725.TCS34725_INTEGRATIONTIME_2_4MS, i2c=bus)
+    print('Sample period %.1f ms, %.1f ms per log write' % (1000 * period, 1000 * write_delay))
+    print('%-10s %12s %12s %12s %12s' % ('Logging', 'mean ms', 'std ms', 'p99 ms', 'max ms'))
+    try:
+        for mode in ('disabled', 'sync', 'queue'):
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+            handler = logging.StreamHandler(SlowStream(write_delay))
+            handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+            listener = None
+            if mode == 'disabled':
+                root.setLevel(logging.INFO)
+                root.addHandler(handler)
+            else:
+                root.setLevel(logging.DEBUG)
+                if mode == 'sync':
+                    root.addHandler(handler)
+                else:
+                    listener = helper.start_log_listener(root, [handler])
+            stamps = numpy.zeros(samples)
+            deadline = time.perf_counter()
+            for i in range(samples):
+                deadline += period
+                r, g, b, c = tcs.get_raw_data()
+                if helper.is_debug():
+                    helper.prdbg('R: %5d G: %5d B: %5d C: %5d', r, g, b, c)
+                stamps[i] = time.perf_counter()
+                remaining = deadline - time.perf_counter()
+                if remaining > 0:
+                    time.sleep(remaining)
+            if listener is not None:
+                listener.stop()
+            intervals = 1000 * numpy.diff(stamps)
+            print('%-10s %12.3f %12.3f %12.3f %12.3f' %
+                  (mode, intervals.mean(), intervals.std(), numpy.percentile(intervals, 99), intervals.max()))
+    finally:
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        for handler in saved_handlers:
+            root.addHandler(handler)
+        root.setLevel(saved_level)
+
+
+BENCHMARKS = (
+    ('ready_mode', bench_ready_mode),
+    ('classify', bench_classify),
+    ('classify_batch', bench_classify_batch),
+    ('helper', bench_helper),
+    ('mp3_check', bench_mp3_check),
+    ('startup', bench_startup),
+    ('log_jitter', bench_log_jitter),
+)
+
+
+def main():
+    args = docopt(__doc__)
+    if args['--list']:
+        for name, func in BENCHMARKS:
+            print('%-20s %s' % (name, func.__doc__.strip()))
+        return
+    # Benchmarks with a budget return False if it was exceeded
+    failed = []
+    for name, func in BENCHMARKS:
+        if args['NAME'] and name not in args['NAME']:
+            continue
+        print('******************** %s ********************' % name)
+        if func() is False:
+            failed.append(name)
+    if failed:
+        print('Budget exceeded: %s' % ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import numpy
+
+# Palettes with at least this number of colors are searched with a KD-tree (if scipy is available).
+# scipy is only imported for these, importing it takes longer than classifying a few thousand samples.
+KDTREE_MIN_COLORS = 64
+
+# Number of samples classified at once by classify_batch, limits the size of temporary arrays
+BATCH_SIZE = 4096
+
+# Number of neighbours requested from the KD-tree in classify_batch to resolve equal distances
+BATCH_NEIGHBOURS = 4
+
+
+class ColorClassifier(object):
+    def __init__(self, colors, matrix=None):
+        """ Nearest color search over colors, a list of [name, [r, g, b]] as in config['color'].
+            matrix may be given if the RGBs are already available as array (Config.color_matrix).
+            The reference RGBs are kept in one contiguous float32 matrix, so all distances are
+            calculated in one go. Large palettes use a KD-tree.
+            Distances are truncated to int like get_rgb_distance does and on equal distances
+            the first color in the list wins, so results match a linear scan with
+            get_rgb_distance.
+        """
+        self.names = [color[0] for color in colors]
+        self.rgbs = [color[1] for color in colors]
+        self.matrix = numpy.ascontiguousarray(self.rgbs if matrix is None else matrix,
+                                              dtype=numpy.float32).reshape(-1, 3)
+        self.tree = None
+        if len(self.names) >= KDTREE_MIN_COLORS:
+            try:
+                from scipy.spatial import cKDTree
+            except ImportError:
+                pass
+            else:
+                self.tree = cKDTree(self.matrix)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_distances(self, rgb):
+        """ Returns the (truncated) distances between rgb and all colors """
+        diff = self.matrix - numpy.asarray(rgb, dtype=numpy.float64)
+        return numpy.sqrt(numpy.einsum('ij,ij->i', diff, diff)).astype(int)
+
+    def classify(self, rgb):
+        """ Returns index and distance of the color closest to rgb """
+        if self.tree is None:
+            dists = self.get_distances(rgb)
+            index = int(numpy.argmin(dists))
+            return index, int(dists[index])
+        dist, index = self.tree.query(rgb)
+        # Other colors with the same truncated distance may come first in the list
+        candidates = numpy.array(sorted(self.tree.query_ball_point(rgb, int(dist) + 1)), dtype=int)
+        diff = self.matrix[candidates] - numpy.asarray(rgb, dtype=numpy.float64)
+        dists = numpy.sqrt(numpy.einsum('ij,ij->i', diff, diff)).astype(int)
+        pos = int(numpy.argmin(dists))
+        return int(candidates[pos]), int(dists[pos])
+
+    def classify_batch(self, samples):
+        """ Classifies samples, an array like with shape (N, 3). Returns the indices of
+            the closest colors and the (truncated) distances as int arrays of length N.
+        """
+        samples = numpy.asarray(samples, dtype=numpy.float64).reshape(-1, 3)
+        indices = numpy.empty(len(samples), dtype=int)
+        dists = numpy.empty(len(samples), dtype=int)
+        for start in range(0, len(samples), BATCH_SIZE):
+            chunk = samples[start:start + BATCH_SIZE]
+            if self.tree is None:
+                diff = chunk[:, numpy.newaxis, :] - self.matrix[numpy.newaxis, :, :]
+                chunk_dists = numpy.sqrt(numpy.einsum('ijk,ijk->ij', diff, diff)).astype(int)
+                chunk_indices = numpy.argmin(chunk_dists, axis=1)
+                indices[start:start + len(chunk)] = chunk_indices
+                dists[start:start + len(chunk)] = chunk_dists[numpy.arange(len(chunk)), chunk_indices]
+                continue
+            neighbours = min(BATCH_NEIGHBOURS, len(self))
+            tree_dists, tree_indices = self.tree.query(chunk, k=neighbours)
+            tree_dists = tree_dists.reshape(len(chunk), neighbours).astype(int)
+            tree_indices = tree_indices.reshape(len(chunk), neighbours)
+            # Among the neighbours with the minimal truncated distance the first color wins
+            ties = tree_dists == tree_dists[:, :1]
+            indices[start:start + len(chunk)] = numpy.where(ties, tree_indices, len(self)).min(axis=1)
+            dists[start:start + len(chunk)] = tree_dists[:, 0]
+            # All neighbours tie, there may be more, check these samples one by one
+            for pos in numpy.flatnonzero(ties[:, -1]):
+                indices[start + pos], dists[start + pos] = self.classify(chunk[pos])
+        return indices, dists
+
+    def get_color(self, index):
+        """ Returns name and rgb of the color with index """
+        return self.names[index], self.rgbs[index]
@@ -1,17 +1,24 @@
+import collections.abc
+import functools
+import hashlib
 import os.path
+import pickle
 import re
 import subprocess
+import types
 
 import TCS34725
-import yaml
-
-import RPi.GPIO as GPIO
 
 from helper import pr, prdbg, prwarn
+from mp3check import check_mp3, MP3CHECK_VERSION
+
+# numpy, yaml (configyaml) and concurrent.futures are imported on first use, to keep the
+# start of the subcommands fast
 
 DEF_CONFIG_FN = 'config_default.yaml'
 DEF_DESCRIPTION = 'DEFAULT DESCRIPTION'
 DEF_DET_THRESHOLD = 2
+DEF_DET_PERSISTENCE = TCS34725.TCS34725_PERS_1_CYCLE
 DEF_RGB_STABLE_CNT = 5
 DEF_RGB_STABLE_DIST = 10
 DEF_RGB_MAX_DIST = 200
@@ -53,6 +60,46 @@ DEF_COLORS = [
 
 DEF_SENSOR_INTEGRATIONTIME = TCS34725.TCS34725_INTEGRATIONTIME_50MS,
 DEF_SENSOR_GAIN = TCS34725.TCS34725_GAIN_16X,
+DEF_SENSOR_READY_MODE = TCS34725.READY_MODE_SLEEP
+# GPIO of the sensor INT pin, None: not connected. Detection then waits for the clear channel
+# interrupt, app2 pauses its sampler (see acquisition.py) meanwhile.
+DEF_SENSOR_INT_GPIO = None
+# Seconds to wait after the LED was switched until the sensor sees the new state. The minimum
+# safe value of a station is measured with ledsense.py cal holdoff. 0.053 s was measured with
+# test_speed, plus 10% margin.
+DEF_SENSOR_LED_HOLDOFF = 0.060
+# End the holdoff as soon as the samples show that the LED has settled. Needs two samples within
+# the holdoff, not the case with the default 50 ms integration time and 60 ms holdoff.
+DEF_SENSOR_LED_SETTLE_EARLY = False
+
+# Several sensors on one Pi (ledsense.py multi), one dict per sensor with
+#   bus: I2C bus number (default 1)
+#   mux_channel: channel of the TCA9548A multiplexer at mux_address (default 0x70) on that bus,
+#                None if the sensor is connected to the bus directly
+#   led_gpio: GPIO of its LED (default 4)
+#   station: station it serves (default: the one of the station GPIOs)
+#   name: shown in the log (default sensor<n>)
+# All sensors use the settings of the sensor section. Empty: the single sensor on bus 1.
+DEF_SENSORS = []
+
+# Simulation (backend sim), see sim.CubeSource and sim.TraceSource
+DEF_SIM_CONFIG = {
+    'source': 'cubes',          # cubes: simulated visitors, trace: replay a recorded trace
+    'trace': None,              # trace file for source trace
+    'loop': True,               # restart trace at its end
+    'speed': 1.0,               # simulated time runs speed times faster than the wall clock
+    'station': 1,               # simulated station GPIO wiring
+    'present': 2.0,             # seconds a cube stays on the station
+    'absent': 1.0,              # seconds between two cubes
+    'ambient': [300, 300, 300, 1000],
+    'led_settle': 0.02,         # seconds until an LED change is visible to the sensor
+    'noise': 1.0,               # standard deviation of the sensor noise
+    'repeat': 1,                # use each color repeat times before the next one
+    'shuffle': False,           # use colors in random order
+    'seed': None,
+    'transfer_rate': 100000,    # I2C bits/s, None for no bus delay
+    'track_time': 5.0,          # simulated length of a MP3 file
+}
 
 DEF_STATION_GPIOS = [21, 20, 26, 16, 19, 13, 12, 6, 5, 7]
 DEF_STATION_GPIO_MAP = (
@@ -153,7 +200,10 @@ DEF_STATION_COLOR_MP3_MAP = [
 
 DEF_CONFIG = {
     'desc': DEF_DESCRIPTION,
-    'det': {'threshold': DEF_DET_THRESHOLD},
+    'det': {
+        'threshold': DEF_DET_THRESHOLD,
+        'persistence': DEF_DET_PERSISTENCE
+    },
     'rgb': {
         'stable_cnt': DEF_RGB_STABLE_CNT,
         'stable_dist': DEF_RGB_STABLE_DIST,
@@ -162,30 +212,84 @@ DEF_CONFIG = {
     'color': DEF_COLORS,
     'sensor': {
         'integration_time': DEF_SENSOR_INTEGRATIONTIME,
-        'gain': DEF_SENSOR_GAIN
+        'gain': DEF_SENSOR_GAIN,
+        'ready_mode': DEF_SENSOR_READY_MODE,
+        'int_gpio': DEF_SENSOR_INT_GPIO,
+        'led_holdoff': DEF_SENSOR_LED_HOLDOFF,
+        'led_settle_early': DEF_SENSOR_LED_SETTLE_EARLY
     },
-    'map_station_mp3_color': DEF_STATION_COLOR_MP3_MAP
+    'sensors': DEF_SENSORS,
+    'map_station_mp3_color': DEF_STATION_COLOR_MP3_MAP,
+    'sim': DEF_SIM_CONFIG
 }
 
 
 DEF_PATH_MP3 = './mp3/'
 DEF_PATH_CAL = './cal/'
+DEF_PATH_TRACE = './trace/'
+
+# Results of check_valid_mp3_content by path, reused while size and mtime of the file are unchanged
+DEF_MP3_CHECK_CACHE_FN = './mp3_check_cache.yaml'
+# Checker of check_valid_mp3_content, stored in the cache, results of another checker are not reused
+MP3_CHECKER = 'mp3check %d' % MP3CHECK_VERSION
+# Number of processes checking MP3 files, None: one per CPU
+DEF_MP3_CHECK_PROCESSES = None
+# Less files are checked in this process, starting the pool would take longer than the check
+MP3_CHECK_POOL_MIN_FILES = 20
+
+# The parsed content of a YAML file is cached in a file with this suffix next to it, see load()
+CONFIG_CACHE_SUFFIX = '.cache'
 
 
 def save_default():
     pr('Saving default config to %s' % DEF_CONFIG_FN)
     with open(DEF_CONFIG_FN, 'w') as outfile:
-        yaml.dump(DEF_CONFIG, outfile, indent=4)
+        dump(DEF_CONFIG, outfile)
 
 
-def load(fname):
+def dump(data, outfile):
+    """ Writes data as YAML as the config and calibration files are written """
+    import configyaml
+    configyaml.dump(data, outfile, indent=4)
+
+
+def load(fname, cache=True):
+    """ Returns the Config of file fname, the default config if fname is None """
     if fname is None:
         pr('No config file given. Using default')
-        return DEF_CONFIG
+        return Config(DEF_CONFIG)
 
     pr('Trying to load config file: %s' % fname)
-    with open(fname, 'r') as infile:
-        return yaml.load(infile)
+    return Config(load_yaml(fname, cache))
+
+
+def load_yaml(fname, cache=True):
+    """ Returns the content of the YAML file fname. With cache the parsed content is kept in
+        fname + CONFIG_CACHE_SUFFIX together with the hash of the YAML text and reused as long
+        as the text is unchanged.
+    """
+    with open(fname, 'rb') as infile:
+        text = infile.read()
+    if not cache:
+        import configyaml
+        return configyaml.load(text)
+    digest = hashlib.sha1(text).hexdigest()
+    cache_fn = fname + CONFIG_CACHE_SUFFIX
+    try:
+        with open(cache_fn, 'rb') as infile:
+            cached_digest, data = pickle.load(infile)
+        if cached_digest == digest:
+            return data
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        pass
+    import configyaml
+    data = configyaml.load(text)
+    try:
+        with open(cache_fn, 'wb') as outfile:
+            pickle.dump((digest, data), outfile, pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        prdbg('Cannot write config cache %s: %s' % (cache_fn, e))
+    return data
 
 
 def check_color_vs_map_color_mp3(config_color, config_map_color_mp3):
@@ -196,17 +300,11 @@ def check_color_vs_map_color_mp3(config_color, config_map_color_mp3):
     :return: number of warnings
     """
     pr('Check colors from config colors are in map_color_mp3')
+    color_stations = get_color_stations(config_map_color_mp3)
     warn = 0
     for color_name, color_rgb in config_color:
-        stations = []
-        found = 0
-        for station, mp3_fn, map_color_name in config_map_color_mp3:
-            # prdbg('Color %s, Map: %s' % (str(color_name), str(map_color_name)))
-            if color_name == map_color_name:
-                # prdbg('Found color %s in map: %s for station %d' % (str(color_name), str(map_color_name), station))
-                stations.append(station)
-                found += 1
-        if found == 0:
+        stations = color_stations.get(color_name)
+        if stations is None:
             prwarn('Color %s not found' % (str(color_name)))
             warn += 1
         else:
@@ -226,29 +324,11 @@ def check_map_color_mp3_vs_color(config_color, config_map_color_mp3):
     :return: number of warnings
     """
     pr('Check colors from map_color_mp3 are in config_color')
+    color_names = set(color_name for color_name, color_rgb in config_color)
     warn = 0
-    # Get all available stations
-    stations = []
-    for station, mp3_fn, map_color_name in config_map_color_mp3:
-        if station not in stations:
-            stations.append(station)
-    # pr('Stations: %s' % str(stations))
-
-    for station in stations:
-        config_map_color_mp3_part = []
-        # Extract config for a single station
-        for map_station, mp3_fn, map_color_name in config_map_color_mp3:
-            if map_station == station:
-                config_map_color_mp3_part.append(map_color_name)
-        for map_color_name in config_map_color_mp3_part:
-            found = 0
-            for color_name, color_rgb in config_color:
-                # prdbg('Color %s, Map: %s' % (str(color_name), str(map_color_name)))
-                if color_name == map_color_name:
-                    # prdbg('Found color %s in map: %s for station %d' %
-                    #       (str(color_name), str(map_color_name), map_station))
-                    found += 1
-            if found == 0:
+    for station, map_color_names in get_station_colors(config_map_color_mp3).items():
+        for map_color_name in map_color_names:
+            if map_color_name not in color_names:
                 prwarn('Color %30s not found for station: %d' % (str(map_color_name), station))
                 warn += 1
     if warn == 0:
@@ -258,6 +338,32 @@ def check_map_color_mp3_vs_color(config_color, config_map_color_mp3):
     return warn
 
 
+def get_color_stations(config_map_color_mp3):
+    """ Returns a dict color -> list of the stations with an entry for it, in map order """
+    color_stations = {}
+    for station, mp3_fn, map_color_name in config_map_color_mp3:
+        color_stations.setdefault(map_color_name, []).append(station)
+    return color_stations
+
+
+def get_station_colors(config_map_color_mp3):
+    """ Returns a dict station -> list of the colors of its entries, in map order """
+    station_colors = {}
+    for station, mp3_fn, map_color_name in config_map_color_mp3:
+        station_colors.setdefault(station, []).append(map_color_name)
+    return station_colors
+
+
+def get_mp3_index(config_map_color_mp3):
+    """ Returns a dict (station, color) -> MP3 filename as given in the map. For duplicate
+        entries the first one wins, as a search in the map would.
+    """
+    index = {}
+    for station, mp3_fn, map_color_name in config_map_color_mp3:
+        index.setdefault((station, map_color_name), mp3_fn)
+    return index
+
+
 class MP3FileError(Exception):
     def __init__(self, message):
         self.message = message
@@ -267,15 +373,131 @@ def convert_fn(fn):
     return fn.split('_')[0] + '.mp3'
 
 
-def check_mp3_files(map_station_mp3_color):
-    pr('Check mp3 files in map station mp3 color')
-    errors = 0
-    for station, fn, color in map_station_mp3_color:
-        fn = convert_fn(fn)
-        path = DEF_PATH_MP3 + fn
+class Config(collections.abc.Mapping):
+    """ A loaded configuration. The sections are accessed like the dict from the YAML file
+        (config['det']) and must not be modified, indexes of the colors and the MP3 map are
+        built once:
+        colors: tuple of (name, (r, g, b))
+        color_index: name -> index into colors and color_matrix (first entry wins)
+        color_matrix: read only float64 array of the color RGBs, shape (N, 3), built on first use
+        stations: stations of the MP3 map, in map order
+        station_colors: station -> tuple of its colors
+        color_stations: color -> tuple of the stations having an entry for it
+        mp3_index: (station, color) -> MP3 filename as in the map
+    """
+    def __init__(self, config):
+        config = dict(config)
+        colors = []
+        for entry in config.get('color', ()):
+            name, rgb = entry
+            if len(rgb) != 3:
+                raise ValueError('Color %s: RGB value expected, got %s' % (name, str(rgb)))
+            colors.append((name, tuple(rgb)))
+        color_index = {}
+        for i, (name, rgb) in enumerate(colors):
+            color_index.setdefault(name, i)
+        map_station_mp3_color = config.get('map_station_mp3_color', ())
+        station_colors = get_station_colors(map_station_mp3_color)
+
+        self.__dict__.update({
+            '_config': config,
+            'colors': tuple(colors),
+            'color_index': types.MappingProxyType(color_index),
+            'stations': tuple(station_colors),
+            'station_colors': types.MappingProxyType(
+                {station: tuple(names) for station, names in station_colors.items()}),
+            'color_stations': types.MappingProxyType(
+                {name: tuple(stations) for name, stations in get_color_stations(map_station_mp3_color).items()}),
+            'mp3_index': types.MappingProxyType(get_mp3_index(map_station_mp3_color)),
+        })
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Config is immutable')
+
+    @functools.cached_property
+    def color_matrix(self):
+        import numpy
+        color_matrix = numpy.array([rgb for name, rgb in self.colors], dtype=numpy.float64).reshape(-1, 3)
+        color_matrix.setflags(write=False)
+        return color_matrix
+
+    def __getitem__(self, key):
+        return self._config[key]
+
+    def __iter__(self):
+        return iter(self._config)
+
+    def __len__(self):
+        return len(self._config)
+
+    def get_rgb(self, color_name):
+        return self.colors[self.color_index[color_name]][1]
+
+    def get_mp3_fn(self, station, color_name):
+        try:
+            return self.mp3_index[(station, color_name)]
+        except KeyError:
+            raise MP3FileError('Filename not defined for %s, %s' % (station, color_name))
+
+    def validate(self):
+        """ Checks the colors against the MP3 map in both directions, returns the number of warnings """
+        return check_color_vs_map_color_mp3(self._config['color'], self._config['map_station_mp3_color']) + \
+            check_map_color_mp3_vs_color(self._config['color'], self._config['map_station_mp3_color'])
+
+    def to_dict(self):
+        """ Returns the configuration as loaded from the YAML file """
+        return dict(self._config)
+
+    def save(self, fname):
+        pr('Saving config to %s' % fname)
+        with open(fname, 'w') as outfile:
+            dump(self.to_dict(), outfile)
+
+
+def check_mp3_files(map_station_mp3_color, station=None, cache_fn=None, processes=DEF_MP3_CHECK_PROCESSES):
+    """
+    Check the mp3 files of map_station_mp3_color, only the ones of station if given. Every file
+    is checked once, in parallel. With cache_fn the results are kept in that file and reused
+    for files with unchanged size and mtime, as long as MP3_CHECKER is unchanged.
+    :return: number of map entries with a bad file
+    """
+    if station is None:
+        pr('Check mp3 files in map station mp3 color')
+    else:
+        pr('Check mp3 files in map station mp3 color for station %s' % str(station))
+    paths = []
+    for map_station, fn, color in map_station_mp3_color:
+        if station is not None and map_station != station:
+            continue
+        path = DEF_PATH_MP3 + convert_fn(fn)
         if not (os.path.isfile(path)):
             raise MP3FileError('File %s does not exist' % path)
-        res = check_valid_mp3_content(path)
+        paths.append(path)
+
+    cache = load_mp3_check_cache(cache_fn, MP3_CHECKER) if cache_fn is not None else {}
+    results = {}
+    unchecked = []
+    for path in paths:
+        if path in results:
+            continue
+        stat = os.stat(path)
+        entry = cache.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            results[path] = entry['res']
+        else:
+            results[path] = None
+            unchecked.append(path)
+    pr('%d files, %d cached, checking %d' % (len(results), len(results) - len(unchecked), len(unchecked)))
+    if len(unchecked) >= MP3_CHECK_POOL_MIN_FILES and processes != 1:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            results.update(zip(unchecked, executor.map(check_valid_mp3_content, unchecked)))
+    else:
+        results.update((path, check_valid_mp3_content(path)) for path in unchecked)
+
+    errors = 0
+    for path in paths:
+        res = results[path]
         if 'result' not in res or res['result'] != 'Ok':
             errors += 1
             prwarn('File %s has errors: %s' % (path, str(res)))
@@ -283,14 +505,61 @@ def check_mp3_files(map_station_mp3_color):
         pr('Check passed. OK')
     else:
         prwarn('%d errors found.' % errors)
+
+    if cache_fn is not None and unchecked:
+        for path in unchecked:
+            # An empty result means the file could not be checked at all
+            if results[path]:
+                stat = os.stat(path)
+                cache[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'res': results[path]}
+        save_mp3_check_cache(cache_fn, cache, MP3_CHECKER)
     return errors
 
 
+def load_mp3_check_cache(fn, checker):
+    """ Returns the cached results by path, none if they were made by another checker """
+    import configyaml
+    try:
+        with open(fn, 'r') as infile:
+            cache = configyaml.load(infile)
+    except (OSError, configyaml.YAMLError) as e:
+        prdbg('No MP3 check cache %s: %s' % (fn, e))
+        return {}
+    if not isinstance(cache, dict) or cache.get('checker') != checker:
+        pr('MP3 check cache %s is not of %s, checking all files' % (fn, checker))
+        return {}
+    files = cache.get('files')
+    return files if isinstance(files, dict) else {}
+
+
+def save_mp3_check_cache(fn, cache, checker):
+    import configyaml
+    try:
+        with open(fn, 'w') as outfile:
+            configyaml.dump({'checker': checker, 'files': cache}, outfile, default_flow_style=False)
+    except OSError as e:
+        prwarn('Cannot write MP3 check cache %s: %s' % (fn, e))
+
+
 def check_valid_mp3_content(path):
+    """ Checks the frames of the MP3 file path, see mp3check.check_mp3 """
+    try:
+        return check_mp3(path)
+    except OSError as e:
+        prwarn('Cannot check %s: %s' % (path, e))
+        return {}
+
+
+def check_valid_mp3_content_mpck(path):
+    """ Checks the MP3 file path with the mpck binary, returns the same dict as check_valid_mp3_content """
     try:
         ret = subprocess.check_output(["./mpck", path])
     except subprocess.CalledProcessError as e:
         ret = e.output
+    except OSError as e:
+        # e.g. the bundled ARM binary on a development machine
+        prwarn('Cannot run mpck: %s' % e)
+        return {}
     ret = ret.decode("utf-8")
     # print(ret)
     PATTERN = r'bitrate\s*(\w*).*samplerate\s*(\w*).*frames\s*(\w*).*time\s*([\w\:\.]*).*unidentified\s*([^\n]*).*errors\s*([^\n]*).*result\s*(\w*)'
@@ -313,7 +582,14 @@ class UndefinedStation(Exception):
         self.message = message
 
 
-def get_station():
+def get_station(GPIO=None):
+    """
+    Determine the station number from the station GPIOs
+    :param GPIO: GPIO module, default RPi.GPIO
+    :return: station number
+    """
+    if GPIO is None:
+        import RPi.GPIO as GPIO
     GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BCM)
     for gpio in DEF_STATION_GPIOS:
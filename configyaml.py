@@ -0,0 +1,36 @@
+"""YAML reading and writing of the config and calibration files.
+
+config imports this module on first use, a config loaded from its cache does not need yaml.
+LibYAML is a lot faster than the pure Python implementation and used if available.
+"""
+
+import yaml
+
+try:
+    from yaml import CSafeDumper as _SafeDumper, CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeDumper as _SafeDumper, SafeLoader as _SafeLoader
+
+YAML_TAG_TUPLE = 'tag:yaml.org,2002:python/tuple'
+
+YAMLError = yaml.YAMLError
+
+
+class ConfigLoader(_SafeLoader):
+    """ Safe loader which also accepts the python tuples used in the config files """
+
+
+class ConfigDumper(_SafeDumper):
+    """ Safe dumper writing tuples as python tuples like yaml.dump does """
+
+
+ConfigLoader.add_constructor(YAML_TAG_TUPLE, lambda loader, node: tuple(loader.construct_sequence(node)))
+ConfigDumper.add_representer(tuple, lambda dumper, data: dumper.represent_sequence(YAML_TAG_TUPLE, data))
+
+
+def load(stream):
+    return yaml.load(stream, Loader=ConfigLoader)
+
+
+def dump(data, stream, **kwargs):
+    yaml.dump(data, stream, Dumper=ConfigDumper, **kwargs)
@@ -1,5 +1,10 @@
-import numpy
+import heapq
 import logging
+import logging.handlers
+import math
+import queue
+
+# numpy is imported where needed, the plain Python paths and most subcommands do not need it
 
 
 class DrawDiagram(object):
@@ -30,7 +35,7 @@ class DrawDiagram(object):
         """
 
         :param value:    current value to be added
-        :param expected: None = no expection for value
+        :param expected: None = no expection for value, good in either bin
                          0 = expected in the lower bin
                          1 = expected in the upper bin
         :return:
@@ -39,7 +44,11 @@ class DrawDiagram(object):
         self.stat_cnt += 1
         lower_limit = self.max * self.bin_size
         upper_limit = self.max * (1.0 - self.bin_size)
-        if value < lower_limit or value > upper_limit:
+        if expected is None:
+            good = value < lower_limit or value > upper_limit
+        else:
+            good = value < lower_limit if expected == 0 else value > upper_limit
+        if good:
             self.stat_good += 1
         else:
             if expected is not None and expected == 0:
@@ -72,13 +81,149 @@ class DrawDiagram(object):
     def get_stat_bad_dev(self):
         if len(self.stat_bad_dev) == 0:
             return 0
+        import numpy
         return numpy.mean(self.stat_bad_dev)
 
 
+class StableRgbWindow(object):
+    def __init__(self, count, dist_limit):
+        """ Sliding window over the last count RGB samples. The window is stable if the
+            distance between all neighbouring samples within the window is not larger
+            than dist_limit. Instead of checking all neighbours again for every new sample
+            only the position of the last neighbour pair exceeding the limit is kept, so
+            add() is O(1).
+        """
+        if count < 2:
+            raise ValueError('Count has to be larger than 2, is %d' % count)
+        self.count = count
+        self.dist_limit = dist_limit
+        self.samples = [None] * count
+        self.sample_cnt = 0
+        self.restarts = 0
+        self.last_exceeded = -1
+
+    def add(self, rgb):
+        """ Add a sample, returns True if the newest count samples are stable. """
+        pos = self.sample_cnt
+        if pos > 0:
+            dist = get_rgb_distance(self.samples[(pos - 1) % self.count], rgb)
+            if dist > self.dist_limit:
+                self.last_exceeded = pos
+                self.restarts += 1
+                prdbg('Dist: %d Dist Limit: %d Restarting... ', dist, self.dist_limit)
+        self.samples[pos % self.count] = rgb
+        self.sample_cnt += 1
+        return self.is_stable()
+
+    def is_stable(self):
+        # The first pair inside the window ends at the second oldest sample
+        oldest = self.sample_cnt - self.count
+        return oldest >= 0 and self.last_exceeded <= oldest
+
+    def get_median(self):
+        return get_rgb_median(self.samples)
+
+    def get_sample_cnt(self):
+        """ Number of samples added until now """
+        return self.sample_cnt
+
+    def get_restarts(self):
+        """ Number of neighbour pairs that exceeded the distance limit """
+        return self.restarts
+
+
+class RunningMedian(object):
+    def __init__(self):
+        """ Median of a stream of values with two heaps, the lower half in a max heap and
+            the upper half in a min heap. add() is O(log n), get() is O(1).
+        """
+        self.lower = []
+        self.upper = []
+
+    def add(self, value):
+        if self.lower and value > -self.lower[0]:
+            heapq.heappush(self.upper, value)
+        else:
+            heapq.heappush(self.lower, -value)
+        # Keep len(lower) == len(upper) or len(upper) + 1
+        if len(self.lower) > len(self.upper) + 1:
+            heapq.heappush(self.upper, -heapq.heappop(self.lower))
+        elif len(self.upper) > len(self.lower):
+            heapq.heappush(self.lower, -heapq.heappop(self.upper))
+
+    def get(self):
+        if len(self.lower) > len(self.upper):
+            return -self.lower[0]
+        return (-self.lower[0] + self.upper[0]) / 2
+
+
+class RunningRgbStats(object):
+    def __init__(self):
+        """ Running statistics of RGB samples: Welford's mean and variance and a running
+            median per channel. Gives the same results as get_rgb_median and get_rgb_std over
+            all samples added, but each add() is O(log n) instead of O(n).
+        """
+        self.cnt = 0
+        self.mean = [0.0, 0.0, 0.0]
+        self.m2 = [0.0, 0.0, 0.0]
+        self.medians = [RunningMedian(), RunningMedian(), RunningMedian()]
+
+    @classmethod
+    def from_values(cls, rgb_list):
+        stats = cls()
+        for rgb in rgb_list:
+            stats.add(rgb)
+        return stats
+
+    def add(self, rgb):
+        self.cnt += 1
+        for i in range(3):
+            delta = rgb[i] - self.mean[i]
+            self.mean[i] += delta / self.cnt
+            self.m2[i] += delta * (rgb[i] - self.mean[i])
+            self.medians[i].add(rgb[i])
+
+    def get_cnt(self):
+        return self.cnt
+
+    def get_mean(self):
+        return [int(mean) for mean in self.mean]
+
+    def get_median(self):
+        if self.cnt == 0:
+            return [0, 0, 0]
+        return [int(median.get()) for median in self.medians]
+
+    def get_std(self):
+        if self.cnt == 0:
+            return [0, 0, 0]
+        return [int(math.sqrt(m2 / self.cnt)) for m2 in self.m2]
+
+    def to_dict(self):
+        """ Summary for the calibration YAML file, only plain types """
+        return {
+            'cnt': self.cnt,
+            'mean': [float(mean) for mean in self.mean],
+            'm2': [float(m2) for m2 in self.m2],
+            'median': self.get_median(),
+            'std': self.get_std()
+        }
+
+
+# Lists up to this number of RGB samples are reduced in plain Python, larger ones with numpy
+RGB_LIST_PYTHON_MAX = 64
+
+
 def get_rgb_distance(rgb1, rgb2):
     """ This function expects two tuples with RGB values and calculates the distance between both
         vectors.
     """
+    if len(rgb1) == 3 and len(rgb2) == 3:
+        dr = rgb1[0] - rgb2[0]
+        dg = rgb1[1] - rgb2[1]
+        db = rgb1[2] - rgb2[2]
+        return int(math.sqrt(dr * dr + dg * dg + db * db))
+    import numpy
     rgb1 = numpy.array(rgb1)
     rgb2 = numpy.array(rgb2)
     return numpy.linalg.norm(rgb1 - rgb2).astype(int).tolist()
@@ -87,28 +232,110 @@ def get_rgb_distance(rgb1, rgb2):
 def get_rgb_length(rgb):
     """ This function expects one tuples with RGB values and calculates the length of the vector.
     """
+    if len(rgb) == 3:
+        return int(math.sqrt(rgb[0] * rgb[0] + rgb[1] * rgb[1] + rgb[2] * rgb[2]))
+    import numpy
     return numpy.linalg.norm(rgb).astype(int).tolist()
 
 
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2
+
+
+def _std(values):
+    mean = sum(values) / len(values)
+    return math.sqrt(sum((v - mean) * (v - mean) for v in values) / len(values))
+
+
 def get_rgb_median(rgb_list):
+    if isinstance(rgb_list, list) and 0 < len(rgb_list) <= RGB_LIST_PYTHON_MAX:
+        return [int(_median(channel)) for channel in zip(*rgb_list)]
+    import numpy
     return numpy.median(rgb_list, axis=0).astype(int).tolist()
 
 
 def get_rgb_std(rgb_list):
+    if isinstance(rgb_list, list) and 0 < len(rgb_list) <= RGB_LIST_PYTHON_MAX:
+        return [int(_std(channel)) for channel in zip(*rgb_list)]
+    import numpy
     return numpy.std(rgb_list, axis=0).astype(int).tolist()
 
 
-def pr(str2log):
-    logging.info(str2log)
+# Array variants: take and return numpy arrays, the last axis holds R, G and B
+
+
+def get_rgb_distance_array(rgb1, rgb2):
+    """ Distances between RGB arrays (broadcasting), as int array """
+    import numpy
+    diff = numpy.subtract(rgb1, rgb2, dtype=numpy.float64)
+    return numpy.sqrt(numpy.einsum('...i,...i->...', diff, diff)).astype(int)
+
+
+def get_rgb_length_array(rgb):
+    """ Lengths of RGB vectors, as int array """
+    import numpy
+    rgb = numpy.asarray(rgb, dtype=numpy.float64)
+    return numpy.sqrt(numpy.einsum('...i,...i->...', rgb, rgb)).astype(int)
+
+
+def get_rgb_median_array(rgb_array):
+    """ Median over the first axis, as int array """
+    import numpy
+    return numpy.median(rgb_array, axis=0).astype(int)
+
 
+def get_rgb_std_array(rgb_array):
+    """ Standard deviation over the first axis, as int array """
+    import numpy
+    return numpy.std(rgb_array, axis=0).astype(int)
 
-def prdbg(str2log):
-    logging.debug(str2log)
 
+# The log functions take the message like logging does, args are only merged into it if
+# the record is emitted: pr('RGB %s', rgb) instead of pr('RGB %s' % str(rgb))
 
-def prwarn(str2log):
-    logging.warning(str2log)
 
+def pr(str2log, *args):
+    logging.info(str2log, *args)
 
-def prerr(str2log):
-    logging.error(str2log)
+
+def prdbg(str2log, *args):
+    logging.debug(str2log, *args)
+
+
+def prwarn(str2log, *args):
+    logging.warning(str2log, *args)
+
+
+def prerr(str2log, *args):
+    logging.error(str2log, *args)
+
+
+def is_debug():
+    """ Guard for debug output per sample, to skip even building the arguments """
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """ Puts the records into the queue as they are, message and args are merged and
+        formatted by the listener thread. Logged args must not be modified afterwards.
+    """
+    def prepare(self, record):
+        return record
+
+
+def start_log_listener(logger, handlers):
+    """ Moves handlers of logger behind a queue, a QueueListener thread passes the records
+        on, so logging never blocks the caller on the output. Returns the listener, stop()
+        it to write out the pending records.
+    """
+    log_queue = queue.Queue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(LogQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,65 @@
+"""TCA9548A I2C multiplexer.
+
+Several TCS34725 share the fixed address 0x29, behind a TCA9548A each one sits on its own
+downstream channel. The multiplexer has a single control register, writing a byte with bit
+n set connects channel n. get_channel() returns an SMBus compatible object that connects
+its channel before every transfer, so TCS34725 can use it like a bus of its own.
+"""
+
+import threading
+
+TCA9548A_ADDRESS = 0x70
+TCA9548A_CHANNELS = 8
+
+
+class TCA9548A(object):
+    def __init__(self, bus, address=TCA9548A_ADDRESS):
+        """ bus is the SMBus compatible object of the upstream bus. All users of the
+            multiplexer have to share this object, it remembers the connected channel.
+        """
+        self.bus = bus
+        self.address = address
+        self.lock = threading.RLock()
+        self.selected = None
+        self.switches = 0
+
+    def select(self, channel):
+        """ Connects channel (None: no channel), the register is only written on a change """
+        with self.lock:
+            if channel == self.selected:
+                return
+            self.bus.write_byte(self.address, 0 if channel is None else 1 << channel)
+            self.selected = channel
+            self.switches += 1
+
+    def get_channel(self, channel):
+        if not 0 <= channel < TCA9548A_CHANNELS:
+            raise ValueError('TCA9548A channel %d out of range 0..%d' % (channel, TCA9548A_CHANNELS - 1))
+        return MuxChannel(self, channel)
+
+
+class MuxChannel(object):
+    """ SMBus interface of one downstream channel of a TCA9548A """
+    def __init__(self, mux, channel):
+        self.mux = mux
+        self.channel = channel
+
+    def read_byte_data(self, addr, cmd):
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            return self.mux.bus.read_byte_data(addr, cmd)
+
+    def read_i2c_block_data(self, addr, cmd, length):
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            return self.mux.bus.read_i2c_block_data(addr, cmd, length)
+
+    def write_byte_data(self, addr, cmd, value):
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            return self.mux.bus.write_byte_data(addr, cmd, value)
+
+    def write_byte(self, addr, cmd):
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            return self.mux.bus.write_byte(addr, cmd)
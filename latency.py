@@ -0,0 +1,117 @@
+"""Latency of the cube events in app2.
+
+For every placed cube the main loop marks the time each stage is reached, from the
+detection to the start of the audio output. The events are kept in a ring buffer of
+preallocated arrays that only the main loop writes, other threads may read summaries at
+any time without locking. Optionally every event is appended to a JSON lines file.
+"""
+
+import json
+import time
+
+import numpy
+
+from helper import pr
+
+STAGE_DETECTED = 'detected'        # clear channel below the threshold
+STAGE_LED_ON = 'led_on'            # LED switched on, after the holdoff
+STAGE_STABLE = 'stable'            # stable RGB found
+STAGE_CLASSIFIED = 'classified'    # color classified
+STAGE_PLAYING = 'playing'          # playback controller acknowledged the start
+STAGES = (STAGE_DETECTED, STAGE_LED_ON, STAGE_STABLE, STAGE_CLASSIFIED, STAGE_PLAYING)
+STAGE_INDEX = dict((stage, i) for i, stage in enumerate(STAGES))
+
+PERCENTILES = (50, 95, 99)
+
+DEF_LATENCY_BUFFER_SIZE = 1024
+
+# app2 logs a summary after this number of cube events
+LATENCY_SUMMARY_INT = 20
+
+
+class LatencyRecorder(object):
+    def __init__(self, size=DEF_LATENCY_BUFFER_SIZE, clock=time.monotonic, log_fn=None):
+        """ Keeps the last size events, clock gives the timestamps. With log_fn every
+            event is appended to that file as JSON object.
+        """
+        self.size = size
+        self.clock = clock
+        self.times = numpy.full((size, len(STAGES)), numpy.nan)
+        self.samples = numpy.zeros(size, dtype=int)
+        self.restarts = numpy.zeros(size, dtype=int)
+        self.count = 0
+        self._cur = [None] * len(STAGES)
+        self._cur_samples = 0
+        self._cur_restarts = 0
+        self._log = open(log_fn, 'a') if log_fn is not None else None
+
+    def start(self):
+        """ Starts a new event, the cube was just detected """
+        self._cur = [None] * len(STAGES)
+        self._cur_samples = 0
+        self._cur_restarts = 0
+        self._cur[0] = self.clock()
+
+    def mark(self, stage):
+        self._cur[STAGE_INDEX[stage]] = self.clock()
+
+    def set_window(self, samples, restarts):
+        """ Samples and restarts the stable window needed """
+        self._cur_samples = samples
+        self._cur_restarts = restarts
+
+    def finish(self, color=None, dist=None):
+        """ Stores the event. The log file gets color, dist and the stages in ms since the detection """
+        row = self.count % self.size
+        self.times[row] = [numpy.nan if t is None else t for t in self._cur]
+        self.samples[row] = self._cur_samples
+        self.restarts[row] = self._cur_restarts
+        # Publish the row only after it is complete
+        self.count += 1
+        if self._log is not None:
+            event = {'t': self._cur[0], 'color': color, 'dist': dist,
+                     'samples': self._cur_samples, 'restarts': self._cur_restarts}
+            for stage, t in zip(STAGES[1:], self._cur[1:]):
+                event[stage] = None if t is None else round(1000 * (t - self._cur[0]), 3)
+            self._log.write(json.dumps(event) + '\n')
+            self._log.flush()
+
+    def get_events(self):
+        """ Returns times, samples and restarts of the stored events, oldest first """
+        count = self.count
+        if count <= self.size:
+            order = numpy.arange(count)
+        else:
+            order = (numpy.arange(self.size) + count) % self.size
+        return self.times[order], self.samples[order], self.restarts[order]
+
+    def get_summary(self, percentiles=PERCENTILES):
+        """ Returns a dict with the percentiles (in ms) of the duration of each stage since the
+            previous one and from the detection to the last stage ('total'), and of the samples
+            and restarts of the stable window.
+        """
+        times, samples, restarts = self.get_events()
+        summary = {'events': len(times)}
+        if len(times) == 0:
+            return summary
+        durations = [(stage, times[:, i] - times[:, i - 1]) for i, stage in enumerate(STAGES) if i > 0]
+        durations.append(('total', numpy.nanmax(times, axis=1) - times[:, 0]))
+        for name, values in durations:
+            values = values[~numpy.isnan(values)]
+            if len(values):
+                summary[name] = [round(v, 1) for v in (1000 * numpy.percentile(values, percentiles)).tolist()]
+        summary['samples'] = numpy.percentile(samples, percentiles).tolist()
+        summary['restarts'] = numpy.percentile(restarts, percentiles).tolist()
+        return summary
+
+    def log_summary(self):
+        summary = self.get_summary()
+        pr('Latency of %d cube events, p%s:' % (summary['events'], '/p'.join(str(p) for p in PERCENTILES)))
+        for name in STAGES[1:] + ('total', 'samples', 'restarts'):
+            if name in summary:
+                pr('  %-12s %s' % (name, ' / '.join(str(v) for v in summary[name])))
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
@@ -4,22 +4,38 @@
 """LED Sensing.
 
 Usage:
-  led_sens.py app [CONFIG]
-  led_sens.py app2 [-l logfile] [CONFIG]
-  led_sens.py cal [-c count] [-l logfile] [CONFIG]
+  led_sens.py app [-b backend] [--profile-startup] [CONFIG]
+  led_sens.py app2 [-b backend] [-l logfile] [--check-all] [--latency-log file] [--profile-startup] [CONFIG]
+  led_sens.py multi [--asyncio] [-b backend] [-l logfile] [--check-all] [--profile-startup] [CONFIG]
+  led_sens.py cal holdoff [-b backend] [-c count] [-l logfile] [--profile-startup] [CONFIG]
+  led_sens.py cal [-b backend] [-c count] [-l logfile] [--profile-startup] [CONFIG]
   led_sens.py cal analysis FILES ...
   led_sens.py color analysis [CONFIG]
-  led_sens.py detect [CONFIG]
-  led_sens.py diff
-  led_sens.py meas (on|off|toggle) [CONFIG]
+  led_sens.py detect [-b backend] [--profile-startup] [CONFIG]
+  led_sens.py diff [-b backend] [--profile-startup]
+  led_sens.py meas (on|off|toggle) [-b backend] [--profile-startup] [CONFIG]
   led_sens.py play
+  led_sens.py record [-b backend] [-o file] [-l logfile] [--profile-startup] [CONFIG]
+  led_sens.py replay TRACE [-l logfile] [CONFIG]
+  led_sens.py trace analysis [-j jobs] [-o file] [-l logfile] [--config CONFIG] TRACES ...
   led_sens.py save_default
-  led_sens.py rgb stable [CONFIG]
-  led_sens.py test_speed
+  led_sens.py sweep [-b backend] [-n count] [-o file] [-l logfile] [--profile-startup] [CONFIG]
+  led_sens.py rgb stable [-b backend] [--profile-startup] [CONFIG]
+  led_sens.py test_speed [-b backend] [--profile-startup]
 
 Options:
+  -b backend    Hardware backend: rpi or sim (simulation, see sim section of config) [default: rpi]
   -c count      Number of calibration cycles [default: 1]
+  --config CONFIG  Configuration of trace analysis (the palette), default as for CONFIG
+  --asyncio     Run the sensors of multi as tasks of an asyncio event loop instead of threads (see aioapp.py)
+  --check-all   Check the MP3 files of all stations, not only the ones of this station
+  --profile-startup  Report the import time per module and the time until the first sample
+  --latency-log file  Append the stage timestamps of every cube to file (JSON lines)
+  -j jobs       Processes of trace analysis, 0: one per CPU [default: 0]
   -l logfile    Log addtionally to logfile
+  -n count      Measurements per combination of the sweep [default: 5]
+  -o file       Save the sweep or trace analysis results to file, as JSON if it ends with .json, otherwise as CSV.
+                Trace file of record, appended to if it exists, by default a new file in ./trace/
   -h --help     Show this screen.
   --version     Show version.
 
@@ -28,32 +44,59 @@ Options:
 import copy
 import datetime
 import logging
+import sys
 import threading
-import time
 
-import RPi.GPIO as GPIO
-import numpy
-import pprint
-import yaml
+# Has to be installed before the modules to profile are imported
+import startup
+if '--profile-startup' in sys.argv:
+    startup.install()
+
 from docopt import docopt
 
 import TCS34725
+import backend
 # Uncomment to remote debug
 # import pydevd; pydevd.settrace('192.168.178.80')
-import play_music
-from config import save_default, load, check_color_vs_map_color_mp3, check_map_color_mp3_vs_color, \
-    check_mp3_files, UndefinedStation, get_station, DEF_PATH_CAL
-from helper import DrawDiagram, get_rgb_distance, get_rgb_length, get_rgb_median, get_rgb_std, pr, prdbg, prerr, prwarn
+# numpy, yaml, pprint, classifier (scipy) and play_music (pygame) are imported by the subcommands
+# needing them, every start of the other subcommands would pay for them.
+from config import save_default, load, dump, \
+    check_mp3_files, UndefinedStation, get_station, DEF_PATH_CAL, DEF_SENSOR_READY_MODE, DEF_SENSOR_INT_GPIO, \
+    DEF_DET_PERSISTENCE, DEF_MP3_CHECK_CACHE_FN, DEF_SENSOR_LED_HOLDOFF, DEF_SENSOR_LED_SETTLE_EARLY, DEF_PATH_TRACE
+from helper import DrawDiagram, RunningRgbStats, StableRgbWindow, get_rgb_distance, get_rgb_length, \
+    get_rgb_median, get_rgb_std, is_debug, pr, prdbg, prerr, prwarn, start_log_listener
 
 GPIO_LED = 4
 
+# GPIO module of the selected backend
+GPIO = None
 tcs = None
 
-# Should be probably left this value. Because it add 10% margin to the determined threshold
-# 0.053 s = Threshold
-LED_TOGGLE_HOLDOFF = 0.060
-
-# LED_TOGGLE_HOLDOFF = 0.053
+# Maximum wait after switching the LED, setup() takes it from the sensor config (led_holdoff)
+LED_TOGGLE_HOLDOFF = DEF_SENSOR_LED_HOLDOFF
+# Sample during the holdoff and end it once the LED has settled (led_settle_early)
+LED_SETTLE_EARLY = DEF_SENSOR_LED_SETTLE_EARLY
+
+# The LED has settled once the clear channel changed by more than this fraction against the
+# last sample before the toggle and the next sample is within this fraction of it
+LED_SETTLE_TOLERANCE = 0.05
+# Lower limit of the allowed clear channel difference in counts, for dark readings
+LED_SETTLE_MIN_DIFF = 20
+
+# cal holdoff: the holdoff is reduced by this factor from LED_HOLDOFF_CAL_START down to
+# LED_HOLDOFF_CAL_MIN until a sample shows the old LED state. Every holdoff is tried for
+# LED_HOLDOFF_CAL_CYCLES on/off cycles (times -c) and the last good one plus 10% is stored.
+LED_HOLDOFF_CAL_START = 0.2
+LED_HOLDOFF_CAL_MIN = 0.002
+LED_HOLDOFF_CAL_FACTOR = 0.8
+LED_HOLDOFF_CAL_CYCLES = 20
+LED_HOLDOFF_CAL_MARGIN = 1.1
+# Bin size of the DrawDiagram evaluating the samples, see DrawDiagram
+LED_HOLDOFF_CAL_BIN = 0.05
+
+# If the sensor INT pin is connected detection waits for the clear channel interrupt.
+# After this timeout (seconds) the STATUS register is checked in case an edge was missed.
+DET_INT_TIMEOUT = 1.0
 
 # Setup logging
 rootLogger = logging.getLogger()
@@ -64,11 +107,20 @@ logFormatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s', '%Y.%m
 consoleHandler = logging.StreamHandler()
 consoleHandler.setFormatter(logFormatter)
 
+# main() moves the handlers behind a queue (see start_log_listener), the output is written
+# by a listener thread and the measurement loop does not wait for the console or log file
 rootLogger.addHandler(consoleHandler)
 
 LOG_RGB_INT = 10  # seconds
 log_rgb_exit = False
 last_rgb_measurement = [-1, -1, -1, -1]
+last_stable_rgb_window = None
+# acquisition.AcquisitionThread while app2 runs, measure() then takes the samples from its buffer
+sampler = None
+# rgbctrace.TraceWriter while recording, measure() appends every sample with the LED state
+trace_writer = None
+# True while wait_led_settled() runs, the samples are integrated partly with the old LED state
+led_settling = False
 
 
 def log_rgb():
@@ -76,30 +128,42 @@ def log_rgb():
     log_rgb_exit = False
     pr('log_rgb: Starting thread')
     while 42:
-        pr('RGBC : %s' % str(last_rgb_measurement))
+        if sampler is not None:
+            latest = sampler.buffer.latest()
+            pr('RGBC : %s - %d samples, %d dropped', list(latest[1:]) if latest is not None else None,
+               sampler.buffer.produced, sampler.buffer.dropped)
+        else:
+            pr('RGBC : %s', last_rgb_measurement)
         # Split wait time into smaller steps to make exiting thread more responsive
         steps = 100
         for i in range(steps):
             sleep_time = (1.0 * LOG_RGB_INT) / (1.0 * steps)
-            time.sleep(sleep_time)
+            backend.sleep(sleep_time)
             if log_rgb_exit:
                 pr('log_rgb: Exit thread')
                 return
 
 
 def measure(debug=False):
+    """ Returns the next sample of the sensor, from the buffer of the sampler unless it is paused """
     global last_rgb_measurement
-    r, g, b, c = tcs.get_raw_data()
-    last_rgb_measurement = [r, b, b, c]
-    if debug:
-        prdbg('R: %5d G: %5d B: %5d C: %5d' % (r, g, b, c))
+    t = None
+    if sampler is not None and not sampler.paused:
+        t, r, g, b, c = sampler.get()
+    else:
+        r, g, b, c = tcs.get_raw_data()
+    last_rgb_measurement = [r, g, b, c]
+    if trace_writer is not None and not led_settling:
+        trace_writer.write(r, g, b, c, GPIO.input(GPIO_LED), t)
+    if debug and is_debug():
+        prdbg('R: %5d G: %5d B: %5d C: %5d', r, g, b, c)
     return r, g, b, c
 
 
 def measure_rgb(debug=False):
     r, g, b, c = measure(False)
-    if debug:
-        prdbg('R: %5d G: %5d B: %5d' % (r, g, b))
+    if debug and is_debug():
+        prdbg('R: %5d G: %5d B: %5d', r, g, b)
     return r, g, b
 
 
@@ -111,112 +175,220 @@ def led(on_off):
 
 
 def led_on():
-    GPIO.output(GPIO_LED, GPIO.HIGH)
-    time.sleep(LED_TOGGLE_HOLDOFF)
+    switch_led(GPIO.HIGH)
 
 
 def led_off():
-    GPIO.output(GPIO_LED, GPIO.LOW)
-    time.sleep(LED_TOGGLE_HOLDOFF)
+    switch_led(GPIO.LOW)
+
+
+def switch_led(level):
+    """ Sets the LED and waits until it has settled. Nothing to wait for if it already is at level. """
+    if GPIO.input(GPIO_LED) == level:
+        return
+    # The clear reading the samples after the switch are compared against
+    before = get_clear_before_switch() if is_settle_early() else None
+    GPIO.output(GPIO_LED, level)
+    wait_led_settled(level == GPIO.HIGH, before)
+
+
+def is_settle_early():
+    """ True if the holdoff ends early once settled, LED_SETTLE_EARLY and two samples fit into it """
+    return LED_SETTLE_EARLY and 2 * tcs.get_sample_time() <= LED_TOGGLE_HOLDOFF
+
+
+def get_clear_before_switch():
+    """ Returns the clear reading of the newest sample of the sampler, without it a new one is taken """
+    if sampler is not None:
+        latest = sampler.buffer.latest()
+        if latest is not None:
+            return latest[4]
+    return measure()[3]
+
+
+def is_led_settled(on, before, prev, cur):
+    """ True if the clear reading rose (LED switched on) or fell (off) from before, the last
+        sample before the LED was switched, to prev and cur confirms prev
+    """
+    def limit(c1, c2):
+        return max(LED_SETTLE_MIN_DIFF, LED_SETTLE_TOLERANCE * max(c1, c2))
+    changed = prev - before if on else before - prev
+    return changed > limit(prev, before) and abs(cur - prev) <= limit(cur, prev)
+
+
+def wait_led_settled(on, before=None):
+    """ Waits LED_TOGGLE_HOLDOFF after switching the LED on or off. With before, the clear reading
+        taken right before the switch (see is_settle_early), the sensor is sampled meanwhile, as
+        long as a sample fits into the rest of the holdoff, and the wait ends as soon as
+        is_led_settled(). Without any visible change the full holdoff is waited.
+        Returns the time waited.
+        With the sampler running, the samples it took before the switch are skipped, and after
+        the full holdoff also the ones integrated during the holdoff. The samples taken meanwhile
+        are not recorded (see led_settling).
+    """
+    global led_settling
+    led_settling = True
+    try:
+        return _wait_led_settled(on, before)
+    finally:
+        led_settling = False
+
+
+def _wait_led_settled(on, before):
+    start = backend.monotonic()
+    deadline = start + LED_TOGGLE_HOLDOFF
+    sample_time = tcs.get_sample_time()
+    if sampler is not None:
+        sampler.buffer.skip_before(start + sample_time)
+    if before is not None:
+        prev = None
+        while backend.monotonic() + sample_time <= deadline:
+            c = measure()[3]
+            if prev is not None and is_led_settled(on, before, prev, c):
+                return backend.monotonic() - start
+            prev = c
+    remaining = deadline - backend.monotonic()
+    if remaining > 0:
+        backend.sleep(remaining)
+    if sampler is not None:
+        sampler.buffer.skip_before(deadline + sample_time)
+    return backend.monotonic() - start
+
+
+def wait_clear_threshold(below, thres, persistence=DEF_DET_PERSISTENCE):
+    """ Waits until the clear channel was below thres (above if not below) for the cycles of
+        persistence (a TCS34725_PERS_* constant), returns the clear reading of the next sample.
+        With a connected INT pin the sensor counts the cycles and we just wait for the
+        interrupt, it is armed again only after it fired and the sample disagrees. A running
+        sampler is paused meanwhile. Otherwise the clear channel is polled until persistence
+        consecutive samples passed.
+    """
+    def passed(c):
+        return c < thres if below else c > thres
+
+    if tcs.has_int_pin():
+        low, high = (thres, 0xFFFF) if below else (0, thres)
+        if sampler is not None:
+            sampler.pause()
+        try:
+            while 42:
+                tcs.arm_clear_threshold(low, high, persistence)
+                try:
+                    while not tcs.wait_clear_interrupt(DET_INT_TIMEOUT):
+                        pass
+                finally:
+                    tcs.disarm_clear_threshold()
+                c = measure()[3]
+                if passed(c):
+                    return c
+        finally:
+            if sampler is not None:
+                sampler.resume()
+    cycles = TCS34725.PERS_CYCLES[persistence]
+    count = 0
+    while 42:
+        c = measure()[3]
+        count = count + 1 if passed(c) else 0
+        if count >= cycles:
+            return c
 
 
-def detect_cube(thres):
+def detect_cube(thres, persistence=DEF_DET_PERSISTENCE):
     """ Cube is detected by measuring the clear brightness. If the brightness
         falls below the threshold it is assumed the the cube shields all
         surrounding light, returns the measured clear reading.
+        See wait_clear_threshold for persistence and the usage of the INT pin.
     """
     led_off()
-    while 42:
-        r, g, b, c = measure()
-        if c < thres:
-            prdbg('Cube detected: %4d < %4d' % (c, thres))
-            return c
+    c = wait_clear_threshold(True, thres, persistence)
+    prdbg('Cube detected: %4d < %4d', c, thres)
+    return c
 
 
-def detect_cube_removal(thres):
+def detect_cube_removal(thres, persistence=DEF_DET_PERSISTENCE):
     """ Cube is detected by measuring the clear brightness. If the brightness
         falls below the threshold it is assumed the the cube shields all
         surrounding light, returns the measured clear reading.
+        See wait_clear_threshold for persistence and the usage of the INT pin.
     """
     led_off()
-    while 42:
-        r, g, b, c = measure()
-        if c > thres:
-            prdbg('Cube removed:  %4d > %4d' % (c, thres))
-            return c
+    c = wait_clear_threshold(False, thres, persistence)
+    prdbg('Cube removed:  %4d > %4d', c, thres)
+    return c
 
 
 def get_stable_rgb(count, dist_limit):
     """ If a number of consecutive (count) RGB measurements is within a maximum
-        distance (dist_limit) the average of all measurements is calculated and returned.
+        distance (dist_limit) the median of all measurements is calculated and returned.
+        Measurements are evaluated in a sliding window, a single outlier only delays the
+        result until it left the window. The window is kept in last_stable_rgb_window.
     """
-    if count < 2:
-        raise ValueError('Count has to be larger than 2, is %d' % count)
-
-    while 42:
-        res = []
-        max_dist = 0
-        for i in range(count):
-            res.append(measure_rgb(False))
-        for i in range(count - 1):
-            act_dist = get_rgb_distance(res[i], res[i + 1])
-            if act_dist > max_dist:
-                max_dist = act_dist
-        if max_dist > dist_limit:
-            prdbg('Max Dist: %d Dist Limit: %d Restarting... ' % (max_dist, dist_limit))
-            continue
-        break
-    return get_rgb_median(res)
+    global last_stable_rgb_window
+    window = StableRgbWindow(count, dist_limit)
+    last_stable_rgb_window = window
+    while not window.add(measure_rgb(False)):
+        pass
+    prdbg('Stable after %d samples, %d restarts', window.get_sample_cnt(), window.get_restarts())
+    return window.get_median()
 
 
 def get_color(rgb, colors, max_rgb_dist):
-    """ Takes an RGB list as argument and matches against DEF_COLORS the closest
-        will be uses as match. Returns None if match distance is larger than
-        max_rgb_distance.
+    """ Takes an RGB list as argument and matches against colors (a list of color
+        names and RGBs or a ColorClassifier built from it) the closest will be
+        used as match. Returns None if match distance is larger than max_rgb_distance.
     """
-    min_dist = 999999999
-    match = 0
-    for color in colors:
-        color_rgb = color[1]
-        dist = get_rgb_distance(rgb, color_rgb)
-        if dist < min_dist:
-            min_dist = dist
-            match = color
-
-    pr('Found %-15s - Dist %d - Cur. RGB: %-20s RGB %-20s' %
-       (match[0], min_dist, str(rgb), str(match[1])))
+    from classifier import ColorClassifier
+    if not isinstance(colors, ColorClassifier):
+        colors = ColorClassifier(colors)
+    index, min_dist = colors.classify(rgb)
+    match = colors.get_color(index)
+
+    pr('Found %-15s - Dist %d - Cur. RGB: %-20s RGB %-20s', match[0], min_dist, rgb, match[1])
 
     if min_dist > max_rgb_dist:
-        prdbg('Max RGB color dist: %d Dist Limit: %d Exiting... ' % (min_dist, max_rgb_dist))
+        prdbg('Max RGB color dist: %d Dist Limit: %d Exiting... ', min_dist, max_rgb_dist)
         return None
     return match[0], match[1], min_dist
 
 
 def app(config_det, config_rgb, config_color):
+    from classifier import ColorClassifier
     global tcs
     det_threshold = config_det['threshold']
+    det_persistence = config_det.get('persistence', DEF_DET_PERSISTENCE)
     rgb_stable_cnt = config_rgb['stable_cnt']
     rgb_stable_dist = config_rgb['stable_dist']
     rgb_max_dist = config_rgb['max_dist']
     pr('Starting app with detection threshold: %d' % det_threshold)
     pr('Strating color detection with stable count: %d, stable_dist: %d using max distance: %d' %
        (rgb_stable_cnt, rgb_stable_dist, rgb_max_dist))
+    classifier = ColorClassifier(config_color)
     while 42:
-        detect_cube(det_threshold)
+        detect_cube(det_threshold, det_persistence)
         led_on()
         res = get_stable_rgb(rgb_stable_cnt, rgb_stable_dist)
         # print(res)
-        color = get_color(res, config_color, rgb_max_dist)
-        pr('%-15s - Distance: %5d - Cur. RGB: %-25s RGB %-20s' %
-           (color[0], color[2], str(res), str(color[1])))
-        detect_cube_removal(det_threshold)
+        color = get_color(res, classifier, rgb_max_dist)
+        pr('%-15s - Distance: %5d - Cur. RGB: %-25s RGB %-20s', color[0], color[2], res, color[1])
+        detect_cube_removal(det_threshold, det_persistence)
 
 
-def app2(config_det, config_rgb, config_color, map_station_mp3_color):
+def app2(config_det, config_rgb, config, check_all=False, latency_log=None):
+    """ config is the complete Config, for the color and MP3 map indexes. The latency of every
+        cube event is recorded (see latency.py), optionally logged to latency_log.
+        The sensor is read by the sampler thread (see acquisition.py), this thread consumes its samples.
+        With the INT pin the sampler is paused while waiting for a cube or its removal.
+    """
+    import acquisition
+    import latency
+    import play_music
+    from classifier import ColorClassifier
     global tcs
     global log_rgb_exit
+    global sampler
 
     det_threshold = config_det['threshold']
+    det_persistence = config_det.get('persistence', DEF_DET_PERSISTENCE)
     rgb_stable_cnt = config_rgb['stable_cnt']
     rgb_stable_dist = config_rgb['stable_dist']
     rgb_max_dist = config_rgb['max_dist']
@@ -224,54 +396,167 @@ def app2(config_det, config_rgb, config_color, map_station_mp3_color):
     pr('Starting color detection with stable count: %d, stable_dist: %d using max distance: %d' %
        (rgb_stable_cnt, rgb_stable_dist, rgb_max_dist))
 
-    check_color_vs_map_color_mp3(config_color, map_station_mp3_color)
-    check_map_color_mp3_vs_color(config_color, map_station_mp3_color)
-
-    check_mp3_files(map_station_mp3_color)
+    config.validate()
 
     try:
-        station = get_station()
+        station = get_station(GPIO)
     except UndefinedStation as e:
         prerr('UndefinedStationError: %s . Exiting ...' % e)
         return
 
-    # Start play_music and rbg_log threads
-    pm = threading.Thread(target=play_music.main, name='play_music.main', args=(map_station_mp3_color, station))
+    check_mp3_files(config['map_station_mp3_color'], None if check_all else station, DEF_MP3_CHECK_CACHE_FN)
+
+    classifier = ColorClassifier(config.colors, config.color_matrix)
+    # Opens latency_log, before any thread is started
+    recorder = latency.LatencyRecorder(clock=backend.monotonic, log_fn=latency_log)
+
+    # Start sampler, play_music and rbg_log threads
+    sampler = acquisition.AcquisitionThread(tcs.get_raw_data, acquisition.SampleBuffer(), backend.monotonic)
+    sampler.start()
+    pm = play_music.PlaybackController(config.mp3_index, station)
     pm.start()
     rgb_log = threading.Thread(target=log_rgb, name='log_rgb')
     rgb_log.start()
 
     try:
         while 42:
-            detect_cube(det_threshold)
+            detect_cube(det_threshold, det_persistence)
+            recorder.start()
             led_on()
+            recorder.mark(latency.STAGE_LED_ON)
             res = get_stable_rgb(rgb_stable_cnt, rgb_stable_dist)
-            color = get_color(res, config_color, rgb_max_dist)
+            recorder.mark(latency.STAGE_STABLE)
+            recorder.set_window(last_stable_rgb_window.get_sample_cnt(), last_stable_rgb_window.get_restarts())
+            color = get_color(res, classifier, rgb_max_dist)
+            recorder.mark(latency.STAGE_CLASSIFIED)
             if not pm.is_alive():
-                prerr('Thread %s unexpectedly died. Exiting...' % pm.getName())
+                prerr('Thread %s unexpectedly died. Exiting...' % pm.name)
                 break
             if not rgb_log.is_alive():
                 prerr('Thread %s unexpectedly died. Exiting...' % rgb_log.getName())
                 break
             if color is not None:
-                play_music.stop_playing = False
-                play_music.start_playing = color[0]
+                if pm.start_playing(color[0]):
+                    recorder.mark(latency.STAGE_PLAYING)
+                recorder.finish(color[0], color[2])
             else:
                 pr('Max RGB color distance exceeded. Not playing...')
-            detect_cube_removal(det_threshold)
-            play_music.stop_playing = True
+                recorder.finish()
+            if recorder.count % latency.LATENCY_SUMMARY_INT == 0:
+                recorder.log_summary()
+            detect_cube_removal(det_threshold, det_persistence)
+            pm.stop_playing()
     except KeyboardInterrupt:
         pr('Keyboard interrupt detected, Stopping threads ..')
 
     finally:
-        play_music.exit_thread = True
         log_rgb_exit = True
-        pm.join(3)
+        pm.exit(3)
         rgb_log.join(3)
+        sampler.exit(3)
+        pr('Sampler: %d samples, %d dropped, %d skipped', sampler.buffer.produced, sampler.buffer.dropped,
+           sampler.buffer.skipped)
+        sampler = None
+        recorder.log_summary()
+        recorder.close()
+
+
+def app_multi(config, sensors, check_all=False, duration=None):
+    """ app2 with several sensors, sensors as returned by setup_sensors(). Each sensor plays
+        the MP3 files of its station with its own playback controller, they split the audio
+        cache and share the one stream of pygame (see play_music.MusicStream). Runs for duration
+        seconds or until interrupted, returns the throughput per sensor.
+    """
+    import multisensor
+    import play_music
+    from classifier import ColorClassifier
+    config_det = config['det']
+    config_rgb = config['rgb']
+    pr('Starting %d sensors with detection threshold: %d', len(sensors), config_det['threshold'])
+    config.validate()
+
+    check_sensors_mp3_files(config, sensors, check_all)
+
+    players = {}
+
+    def on_color(head, color):
+        if color is None:
+            pr('%s: Max RGB color distance exceeded. Not playing...', head.name)
+            return
+        # Do not wait for the acknowledgement, the other sensors are due
+        players[head.name].start_playing(color[0], wait=False)
+
+    def on_removed(head):
+        players[head.name].stop_playing(wait=False)
+
+    classifier = ColorClassifier(config.colors, config.color_matrix)
+    # The players share the memory of one audio cache
+    cache_max_bytes = play_music.DEF_AUDIO_CACHE_MAX_BYTES // len(sensors)
+    heads = []
+    for name, head_tcs, led_pin, station in sensors:
+        players[name] = play_music.PlaybackController(config.mp3_index, station, cache_max_bytes=cache_max_bytes)
+        players[name].start()
+        heads.append(multisensor.SensorHead(name, head_tcs, GPIO, led_pin, station, config_det, config_rgb,
+                                            classifier, LED_TOGGLE_HOLDOFF, backend.monotonic, on_color, on_removed))
+    scheduler = multisensor.SensorScheduler(heads, backend.monotonic, backend.sleep)
+
+    def stop():
+        dead = [pm for pm in players.values() if not pm.is_alive()]
+        for pm in dead:
+            prerr('Thread %s unexpectedly died. Exiting...', pm.name)
+        return bool(dead)
+
+    try:
+        scheduler.run(duration, stop)
+    except KeyboardInterrupt:
+        pr('Keyboard interrupt detected, Stopping threads ..')
+    finally:
+        for pm in players.values():
+            pm.exit(3)
+        for head in heads:
+            GPIO.output(head.led_pin, GPIO.LOW)
+        scheduler.report()
+    return scheduler.get_throughput()
+
+
+def app_async(config, sensors, check_all=False, duration=None):
+    """ app_multi() as tasks of an asyncio event loop, see aioapp.py. Runs for duration seconds or
+        until interrupted, returns the throughput per sensor (None if interrupted).
+    """
+    import asyncio
+    import aioapp
+    from classifier import ColorClassifier
+    pr('Starting asyncio runtime, %d sensors with detection threshold: %d', len(sensors),
+       config['det']['threshold'])
+    config.validate()
+    check_sensors_mp3_files(config, sensors, check_all)
+
+    classifier = ColorClassifier(config.colors, config.color_matrix)
+    throughput = None
+    try:
+        throughput = asyncio.run(aioapp.run_station(sensors, config, GPIO, classifier, LED_TOGGLE_HOLDOFF, duration))
+    except KeyboardInterrupt:
+        pr('Keyboard interrupt detected, Stopping tasks ..')
+    finally:
+        for _, _, led_pin, _ in sensors:
+            GPIO.output(led_pin, GPIO.LOW)
+    return throughput
+
+
+def check_sensors_mp3_files(config, sensors, check_all=False):
+    """ check_mp3_files() for the stations of sensors (as returned by setup_sensors()) or all """
+    if check_all:
+        check_mp3_files(config['map_station_mp3_color'], None, DEF_MP3_CHECK_CACHE_FN)
+        return
+    for station in sorted(set(station for _, _, _, station in sensors)):
+        check_mp3_files(config['map_station_mp3_color'], station, DEF_MP3_CHECK_CACHE_FN)
 
 
 def cal(config_det, config_rgb, config_color, config_sensor, cnt):
+    import numpy
+    import yaml
     det_threshold = config_det['threshold']
+    det_persistence = config_det.get('persistence', DEF_DET_PERSISTENCE)
     rgb_stable_cnt = config_rgb['stable_cnt']
     rgb_stable_dist = config_rgb['stable_dist']
     rgb_max_dist = config_rgb['max_dist']
@@ -281,7 +566,7 @@ def cal(config_det, config_rgb, config_color, config_sensor, cnt):
        (rgb_stable_cnt, rgb_stable_dist, rgb_max_dist))
 
     try:
-        station = get_station()
+        station = get_station(GPIO)
     except UndefinedStation as e:
         prerr('UndefinedStationError: %s . Exiting ...' % e)
         return
@@ -292,6 +577,7 @@ def cal(config_det, config_rgb, config_color, config_sensor, cnt):
         res[color_name] = {}
         res[color_name]['config'] = config_rgb
         res[color_name]['values'] = []
+        res[color_name]['stats'] = RunningRgbStats()
         res[color_name]['mean'] = [0, 0, 0]
         res[color_name]['std'] = [0, 0, 0]
 
@@ -303,11 +589,11 @@ def cal(config_det, config_rgb, config_color, config_sensor, cnt):
         print('Put color %s on detector' % color_name)
         for cycle in range(cnt):
             while 42:
-                detect_cube(det_threshold)
+                detect_cube(det_threshold, det_persistence)
                 led_on()
                 rgb = get_stable_rgb(rgb_stable_cnt, rgb_stable_dist)
                 pr('Remove cube')
-                detect_cube_removal(det_threshold)
+                detect_cube_removal(det_threshold, det_persistence)
 
                 # Check if the cube color has really changed
                 dist_last_rgb = get_rgb_distance(last_color_rgb, rgb)
@@ -327,8 +613,9 @@ def cal(config_det, config_rgb, config_color, config_sensor, cnt):
             dist_config = get_rgb_distance(config_rgb, rgb)
             dist_mean = get_rgb_distance(res[color_name]['mean'], rgb)
             res[color_name]['values'].append(rgb)
-            res[color_name]['mean'] = get_rgb_median(res[color_name]['values'])
-            res[color_name]['std'] = get_rgb_std(res[color_name]['values'])
+            res[color_name]['stats'].add(rgb)
+            res[color_name]['mean'] = res[color_name]['stats'].get_median()
+            res[color_name]['std'] = res[color_name]['stats'].get_std()
             pr('%-15s Distances: Config %d, Mean %d (%d of %d)' %
                (color_name, dist_config, dist_mean, cycle + 1, cnt))
         last_color_rgb = res[color_name]['mean']
@@ -345,11 +632,13 @@ def cal(config_det, config_rgb, config_color, config_sensor, cnt):
     # Print YAML file
     res_yaml = []
     res_yaml_values = []
+    res_yaml_stats = []
     for color_name, _ in config_color:
         rgb = res[color_name]['mean']
         values = res[color_name]['values']
         res_yaml.append([color_name, rgb])
         res_yaml_values.append([color_name, values])
+        res_yaml_stats.append([color_name, res[color_name]['stats'].to_dict()])
     print(80 * '*')
     print('Printing YAML config')
     print(yaml.dump(res_yaml))
@@ -365,15 +654,87 @@ def cal(config_det, config_rgb, config_color, config_sensor, cnt):
         'sensor': config_sensor,
         'color': res_yaml,
         'values': res_yaml_values,
+        'stats': res_yaml_stats,
         'station': station
     }
 
     pr('Also saving to %s' % path)
     with open(path, 'w') as outfile:
-        yaml.dump(cfg, outfile, indent=4)
+        dump(cfg, outfile)
+
+
+def cal_holdoff(config, cnt):
+    """ Measures the minimum safe LED holdoff of this station like test_speed does: with a cube
+        on the sensor the LED is toggled and a DrawDiagram evaluates if the sample after each
+        toggle shows the new LED state (see LED_HOLDOFF_CAL_*). A copy of config with the
+        result as sensor led_holdoff is saved as calibration file, returns the holdoff or None.
+    """
+    det_threshold = config['det']['threshold']
+    det_persistence = config['det'].get('persistence', DEF_DET_PERSISTENCE)
+    cycle_cnt = LED_HOLDOFF_CAL_CYCLES * int(cnt)
+    settle_early = LED_SETTLE_EARLY
+
+    try:
+        station = get_station(GPIO)
+    except UndefinedStation as e:
+        prerr('UndefinedStationError: %s . Exiting ...', e)
+        return None
+
+    pr('Put a cube on the detector')
+    detect_cube(det_threshold, det_persistence)
+
+    dd = DrawDiagram(40, LED_HOLDOFF_CAL_BIN)
+    res = []
+    safe_holdoff = None
+    holdoff = LED_HOLDOFF_CAL_START
+    set_led_holdoff(holdoff, False)
+    # Find the maximum of the diagram
+    led_on()
+    dd.add(measure()[0])
+    while holdoff >= LED_HOLDOFF_CAL_MIN:
+        set_led_holdoff(holdoff, False)
+        dd.stat_reset()
+        for _ in range(cycle_cnt):
+            led_off()
+            dd.add(measure()[0], expected=0)
+            led_on()
+            dd.add(measure()[0], expected=1)
+        if dd.get_stat_cnt() == 0:
+            # The maximum was updated by the last sample, repeat
+            continue
+        res.append((1000 * holdoff, dd.get_stat_cnt(), dd.get_stat_good_percent(), dd.get_stat_bad_dev()))
+        pr('Holdoff: %6.1f ms Cnt: %3d Good: %6.2f%% Bad Dev: %6.1f', *res[-1])
+        if dd.get_stat_good_percent() < 100.0:
+            break
+        safe_holdoff = holdoff
+        holdoff *= LED_HOLDOFF_CAL_FACTOR
+
+    if safe_holdoff is None:
+        prerr('Even %.1f ms are too short, is a cube on the detector? Exiting ...', 1000 * LED_HOLDOFF_CAL_START)
+        set_led_holdoff(LED_HOLDOFF_CAL_START, settle_early)
+        led_off()
+        return None
+    holdoff = round(LED_HOLDOFF_CAL_MARGIN * safe_holdoff, 4)
+    pr('Minimum safe LED holdoff: %.1f ms, using %.1f ms', 1000 * safe_holdoff, 1000 * holdoff)
+    set_led_holdoff(holdoff, settle_early)
+    led_off()
+
+    timestamp = str(datetime.datetime.now())
+    path = DEF_PATH_CAL + '%s_station_%d.yaml' % (timestamp, station)
+    cfg = config.to_dict()
+    cfg['desc'] = 'Automatically created with LED holdoff calibration date: %s, station: %d' % (timestamp, station)
+    cfg['sensor'] = dict(cfg['sensor'], led_holdoff=holdoff)
+    cfg['station'] = station
+    pr('Saving to %s', path)
+    with open(path, 'w') as outfile:
+        dump(cfg, outfile)
+    return holdoff
 
 
 def cal_analysis(files):
+    import pprint
+    import numpy
+    from classifier import ColorClassifier
     configs = []
     for file in files:
         configs.append(load(file))
@@ -418,22 +779,29 @@ def cal_analysis(files):
 
     # pprint.pprint(colors)
 
+    # Collect all values of all files in one array, in order color, file, value
+    all_values = []
+    all_color_idx = []
+    all_config_idx = []
+    for j, color_name in enumerate(colors):
+        for i, config in enumerate(configs):
+            cur_values = config['values'][j][1]
+            all_values.extend(cur_values)
+            all_color_idx.extend([j] * len(cur_values))
+            all_config_idx.extend([i] * len(cur_values))
+    all_values = numpy.array(all_values, dtype=numpy.float64).reshape(-1, 3)
+    all_color_idx = numpy.array(all_color_idx, dtype=int)
+    all_config_idx = numpy.array(all_config_idx, dtype=int)
+
     # Calc overall means
+    # TODO: if the files contain different numbers of measures values the mean is calculated wrong!!!
+    # TODO: solution, calc the mean of means on a per station basis
     over_all_means = []
     over_all_std = []
-    over_all_values = []
     for j, color_name in enumerate(colors):
-        pr('Starting with %s' % color_name)
-        cur_values_all = []
-        for i, config in enumerate(configs):
-            cur_values = config['values'][j][1]
-            for values in cur_values:
-                cur_values_all.append(values)
-        # TODO: if the files contain different numbers of measures values the mean is calculated wrong!!!
-        # TODO: solution, calc the mean of means on a per station basis
+        cur_values_all = all_values[all_color_idx == j]
         over_all_means.append([color_name, get_rgb_median(cur_values_all)])
         over_all_std.append([color_name, get_rgb_std(cur_values_all)])
-        over_all_values.append([color_name, cur_values_all])
 
     pprint.pprint(over_all_means)
     pprint.pprint(over_all_std)
@@ -451,32 +819,24 @@ def cal_analysis(files):
     # Color 2           9/ 10    3/ 10
     # ...
 
-    over_all_stats = []
-    over_all_dists = []
+    # Classify all values at once and reduce per (color, file)
+    classifier = ColorClassifier(over_all_means)
+    indices, dists = classifier.classify_batch(all_values)
+    ok = indices == all_color_idx
+    cell = all_color_idx * len(configs) + all_config_idx
+    cell_cnt = len(colors) * len(configs)
+    stats_cnt = numpy.bincount(cell, minlength=cell_cnt).reshape(len(colors), len(configs))
+    stats_ok = numpy.bincount(cell, weights=ok, minlength=cell_cnt).reshape(len(colors), len(configs))
+    dists_sum = numpy.bincount(cell, weights=dists * ok, minlength=cell_cnt).reshape(len(colors), len(configs))
+    dists_max = numpy.zeros(cell_cnt, dtype=int)
+    numpy.maximum.at(dists_max, cell[ok], dists[ok])
+    dists_max = dists_max.reshape(len(colors), len(configs))
+
     nok_stats = []
-    for j, color_name in enumerate(colors):
-        pr('Starting with %s' % color_name)
-        station_stats = []
-        station_dists = []
-        for i, config in enumerate(configs):
-            ok = 0
-            cnt = 0
-            color_values = config['values'][j][1]
-            station_name = config['station']
-            print('Station: %s' % station_name)
-            dists = []
-            for color_value in color_values:
-                cnt += 1
-                color_res, _, dist = get_color(color_value, over_all_means, 100000)
-                if color_res == color_name:
-                    ok += 1
-                    dists.append(dist)
-                else:
-                    nok_stats.append([station_name, color_name, color_res])
-            station_stats.append([ok, cnt])
-            station_dists.append(dists)
-        over_all_stats.append([color_name, station_stats])
-        over_all_dists.append([color_name, station_dists])
+    for pos in numpy.flatnonzero(~ok):
+        nok_stats.append([configs[all_config_idx[pos]]['station'],
+                          colors[all_color_idx[pos]],
+                          classifier.get_color(indices[pos])[0]])
 
     # and print it out in a nice table (OK/NOK)
     print(80 * '*')
@@ -488,12 +848,10 @@ def cal_analysis(files):
     for config in configs:
         print('   OK/CNT', end='')
     print()
-    for color_name, results in over_all_stats:
+    for j, color_name in enumerate(colors):
         print('%35s' % color_name, end='')
-        for result in results:
-            ok = result[0]
-            cnt = result[1]
-            print('  %3d/%3d' % (ok, cnt), end='')
+        for i in range(len(configs)):
+            print('  %3d/%3d' % (stats_ok[j, i], stats_cnt[j, i]), end='')
         print()
 
     # and print it out in a nice table (distances)
@@ -506,15 +864,15 @@ def cal_analysis(files):
     for config in configs:
         print('  AVG/ MAX', end='')
     print()
-    for color_name, results in over_all_dists:
+    for j, color_name in enumerate(colors):
         print('%35s' % color_name, end='')
-        for result in results:
-            if len(result) == 0:
+        for i in range(len(configs)):
+            if stats_ok[j, i] == 0:
                 max_dist = '----'
                 avg_dist = '----'
             else:
-                max_dist = max(result)
-                avg_dist = int(numpy.mean(result))
+                max_dist = dists_max[j, i]
+                avg_dist = int(dists_sum[j, i] / stats_ok[j, i])
             print(' %4s/%4s' % (avg_dist, max_dist), end='')
         print()
 
@@ -540,10 +898,11 @@ def cal_analysis(files):
 
     pr('Also saving to %s' % path)
     with open(path, 'w') as outfile:
-        yaml.dump(cfg, outfile, indent=4)
+        dump(cfg, outfile)
 
 
 def color_analyse(config_color):
+    import numpy
     def get_key(item):
         return item[0]
 
@@ -616,9 +975,10 @@ def color_analyse(config_color):
 def detect(config):
     global tcs
     threshold = config['threshold']
+    persistence = config.get('persistence', DEF_DET_PERSISTENCE)
     while 42:
-        value = detect_cube(threshold)
-        value = detect_cube_removal(threshold)
+        value = detect_cube(threshold, persistence)
+        value = detect_cube_removal(threshold, persistence)
 
 
 def diff():
@@ -627,10 +987,10 @@ def diff():
     while 42:
         led_on()
         r, g, b, c = measure()
-        prdbg('R: %5d G: %5d B: %5d C: %5d' % (r, g, b, c))
+        prdbg('R: %5d G: %5d B: %5d C: %5d', r, g, b, c)
         led_off()
         r2, g2, b2, c2 = measure()
-        prdbg('R: %5d G: %5d B: %5d C: %5d' % (r2, g2, b2, c2))
+        prdbg('R: %5d G: %5d B: %5d C: %5d', r2, g2, b2, c2)
         rgb = (r, g, b)
         rgb2 = (r2, g2, b2)
         rgb_len = get_rgb_length(rgb)
@@ -666,7 +1026,119 @@ def meas(conf_led_on, toggle):
 
     while 42:
         r, g, b, c = measure()
-        pr('R: %5d G: %5d B: %5d C: %5d' % (r, g, b, c))
+        pr('R: %5d G: %5d B: %5d C: %5d', r, g, b, c)
+
+
+def record(config, out_fn=None, duration=None):
+    """ Runs the detection of app (without audio) and appends every sample with the LED state to
+        the binary trace out_fn (see rgbctrace.py), by default a new file in DEF_PATH_TRACE. The
+        samples taken while the LED settles are left out, their LED state is unclear.
+        Stops after the first cube removal past duration seconds or when interrupted, returns
+        the found colors like replay().
+    """
+    import os
+    import rgbctrace
+    from classifier import ColorClassifier
+    global trace_writer
+    det_threshold = config['det']['threshold']
+    det_persistence = config['det'].get('persistence', DEF_DET_PERSISTENCE)
+    config_rgb = config['rgb']
+
+    try:
+        station = get_station(GPIO)
+    except UndefinedStation as e:
+        prerr('UndefinedStationError: %s . Exiting ...', e)
+        return None
+
+    timestamp = str(datetime.datetime.now())
+    if out_fn is None:
+        os.makedirs(DEF_PATH_TRACE, exist_ok=True)
+        out_fn = DEF_PATH_TRACE + '%s_station_%d%s' % (timestamp, station, rgbctrace.TRACE_SUFFIX)
+    info = {'desc': 'Recorded with ledsense.py record date: %s, station: %d' % (timestamp, station),
+            'station': station, 'backend': backend.name, 'sensor': config['sensor'],
+            'sample_time': tcs.get_sample_time(), 'led_holdoff': LED_TOGGLE_HOLDOFF, 'rgb': config['rgb']}
+    classifier = ColorClassifier(config.colors, config.color_matrix)
+    colors = []
+    pr('Recording to %s', out_fn)
+    trace_writer = rgbctrace.TraceWriter(out_fn, info, backend.monotonic)
+    start = backend.monotonic()
+    try:
+        while duration is None or backend.monotonic() - start < duration:
+            detect_cube(det_threshold, det_persistence)
+            led_on()
+            res = get_stable_rgb(config_rgb['stable_cnt'], config_rgb['stable_dist'])
+            color = get_color(res, classifier, config_rgb['max_dist'])
+            colors.append((backend.monotonic(),) + ((color[0], color[2]) if color is not None else (None, None)))
+            detect_cube_removal(det_threshold, det_persistence)
+            trace_writer.flush()
+    except KeyboardInterrupt:
+        pr('Keyboard interrupt detected, Stopping recording ..')
+    finally:
+        pr('Recorded %d samples to %s', trace_writer.count, out_fn)
+        trace_writer.close()
+        trace_writer = None
+    return colors
+
+
+def replay(config, path):
+    """ Feeds the samples of the binary trace path through detect_cube, get_stable_rgb and get_color
+        as fast as they are read, in the time of the trace (see rgbctrace.ReplaySensor). Returns
+        the found colors as list of (t, name, dist), name and dist are None if max_dist was exceeded.
+    """
+    import time
+    import rgbctrace
+    from classifier import ColorClassifier
+    global GPIO
+    global tcs
+    det_threshold = config['det']['threshold']
+    det_persistence = config['det'].get('persistence', DEF_DET_PERSISTENCE)
+    config_rgb = config['rgb']
+
+    trace = rgbctrace.load(path)
+    pr('Replaying %s: %d samples, %.1f s, %s', path, len(trace), trace.get_duration(), trace.info.get('desc'))
+    tcs = rgbctrace.ReplaySensor(trace)
+    backend.select(backend.BACKEND_SIM, config.get('sim'))
+    backend.set_clock(tcs.monotonic, tcs.sleep)
+    GPIO = backend.get_gpio()
+    GPIO.setup(GPIO_LED, GPIO.OUT)
+    set_led_holdoff(trace.info.get('led_holdoff', DEF_SENSOR_LED_HOLDOFF),
+                    config['sensor'].get('led_settle_early', DEF_SENSOR_LED_SETTLE_EARLY))
+
+    classifier = ColorClassifier(config.colors, config.color_matrix)
+    colors = []
+    start = time.monotonic()
+    try:
+        while 42:
+            detect_cube(det_threshold, det_persistence)
+            led_on()
+            res = get_stable_rgb(config_rgb['stable_cnt'], config_rgb['stable_dist'])
+            color = get_color(res, classifier, config_rgb['max_dist'])
+            colors.append((backend.monotonic(),) + ((color[0], color[2]) if color is not None else (None, None)))
+            detect_cube_removal(det_threshold, det_persistence)
+    except rgbctrace.TraceEnd as e:
+        pr(e)
+    elapsed = time.monotonic() - start
+    pr('Replayed %.1f s of samples in %.2f s (%.0fx real time), %d cubes', trace.get_duration(), elapsed,
+       trace.get_duration() / elapsed if elapsed > 0 else 0.0, len(colors))
+    return colors
+
+
+def trace_analysis(config, files, out_fn=None, processes=None):
+    """ Analyses the detection and stable RGB parameters over the binary traces files (see
+        traceanalysis.py) with the palette of config and prints the Pareto front. processes:
+        number of worker processes, None: one per CPU. Returns the results.
+    """
+    import time
+    import paramsweep
+    import traceanalysis
+    start = time.monotonic()
+    results = traceanalysis.analyse(files, config.colors, processes=processes)
+    pr('Analysed %d combinations in %.1f s', len(results), time.monotonic() - start)
+    traceanalysis.report(results)
+    if out_fn is not None:
+        pr('Saving trace analysis results to %s', out_fn)
+        paramsweep.save(results, out_fn, traceanalysis.FIELDS, traceanalysis.pick)
+    return results
 
 
 def rgb_stable(config_rgb):
@@ -679,7 +1151,7 @@ def rgb_stable(config_rgb):
     while 42:
         res = get_stable_rgb(rgb_stable_cnt, rgb_stable_dist)
         prdbg(res)
-        pr('RGB: %25s' % str(res))
+        pr('RGB: %25s', res)
 
 
 def test_speed():
@@ -700,7 +1172,7 @@ def test_speed():
             # LED_TOGGLE_HOLDOFF = sleep_duration
             tcs.set_sleep_factor(sleep_duration)
 
-            start = datetime.datetime.now()
+            start = backend.monotonic()
             for i in range(cycle_cnt):
                 led_on()
                 for _ in range(rep_cnt):
@@ -715,8 +1187,8 @@ def test_speed():
                     dd.add(r, expected=0)
                     print('R: %5d G: %5d B: %5d C: %5d | %-40s' %
                           (r, g, b, c, dd.getstr()))
-            duration = datetime.datetime.now() - start
-            duration_ms = int(duration.total_seconds() * 1000)
+            duration = backend.monotonic() - start
+            duration_ms = int(duration * 1000)
             meas_cnt = cycle_cnt * 2 * rep_cnt
             meas_avg_duration = duration_ms / meas_cnt
             print('**** Summary ****')
@@ -729,25 +1201,201 @@ def test_speed():
                         dd.get_stat_bad_dev(),
                         meas_avg_duration))
             dd.stat_reset()
-            time.sleep(2)
+            backend.sleep(2)
     except KeyboardInterrupt:
         print('**** Stats for series ****')
         for i in res:
             print('Setting: %5.4fms Cnt: %3d Good: %6.2f%% Bad Dev: %6.1f Avg. Dura: %5.2f' % i)
 
 
-def setup(config):
+def sweep(config, count, out_fn=None, grid=None):
+    """ Measures every combination of grid (default: paramsweep.get_grid()) count times with the cube(s) on the
+        sensor, prints the results with the Pareto front marked and the recommended settings.
+        Every cube is first classified with the reference settings of config, the combinations
+        have to find its color. out_fn gets the results as CSV or JSON (see paramsweep.save).
+        Returns the results.
+    """
+    import paramsweep
+    from classifier import ColorClassifier
+    det_threshold = config['det']['threshold']
+    det_persistence = config['det'].get('persistence', DEF_DET_PERSISTENCE)
+    rgb_max_dist = config['rgb']['max_dist']
+    reference = (config['sensor']['integration_time'][0], config['sensor']['gain'][0])
+    count = int(count)
+    classifier = ColorClassifier(config.colors, config.color_matrix)
+    if grid is None:
+        grid = paramsweep.get_grid()
+    pr('Sweeping %d combinations with %d measurements each, put a cube on the detector', len(grid), count)
+
+    def set_settings(integration_time, gain):
+        tcs.set_integration_time(integration_time)
+        tcs.set_gain(gain)
+        # The first sample may still be integrated with the previous settings
+        measure()
+
+    def get_stable_window(stable_cnt, stable_dist):
+        """ Returns the window and whether it got stable within SWEEP_MAX_STABLE_SAMPLES """
+        window = StableRgbWindow(stable_cnt, stable_dist)
+        stable = False
+        while not stable and window.get_sample_cnt() < paramsweep.SWEEP_MAX_STABLE_SAMPLES:
+            stable = window.add(measure_rgb(False))
+        return window, stable
+
+    results = []
+    try:
+        for params in grid:
+            set_settings(params['integration_time'], params['gain'])
+            # The palette and the detection threshold are for the reference settings
+            count_scale = TCS34725.get_count_scale(params['integration_time'], params['gain'], *reference)
+            threshold = max(1, int(round(det_threshold * count_scale)))
+
+            led_on()
+            start = backend.monotonic()
+            for _ in range(paramsweep.SWEEP_RATE_SAMPLES):
+                measure()
+            samples_per_s = paramsweep.SWEEP_RATE_SAMPLES / (backend.monotonic() - start)
+
+            stable_times = []
+            dists = []
+            correct = 0
+            for _ in range(count):
+                detect_cube(threshold, det_persistence)
+                led_on()
+                # The color of the cube with the reference settings is the one to find
+                set_settings(*reference)
+                window, stable = get_stable_window(config['rgb']['stable_cnt'], config['rgb']['stable_dist'])
+                expected = classifier.classify(window.get_median())[0] if stable else None
+                set_settings(params['integration_time'], params['gain'])
+
+                start = backend.monotonic()
+                window, stable = get_stable_window(params['stable_cnt'], params['stable_dist'])
+                stable_times.append(backend.monotonic() - start)
+                if stable:
+                    index, dist = classifier.classify([v / count_scale for v in window.get_median()])
+                    dists.append(dist)
+                    if dist <= rgb_max_dist and index == expected:
+                        correct += 1
+            stable_times.sort()
+            res = dict(params)
+            res.update({
+                'integration_ms': 1000 * TCS34725.INTEGRATION_TIME_DELAY[params['integration_time']],
+                'gain_factor': TCS34725.GAIN_FACTOR[params['gain']],
+                'samples_per_s': round(samples_per_s, 2),
+                'stable_ms': round(1000 * stable_times[len(stable_times) // 2], 1),
+                'accuracy': 1.0 * correct / count,
+                'dist': int(sum(dists) / len(dists)) if dists else None,
+            })
+            results.append(res)
+            pr('Sweep %3d/%d: %s', len(results), len(grid), paramsweep.format_result(res))
+    except KeyboardInterrupt:
+        pr('Keyboard interrupt detected, evaluating %d of %d combinations', len(results), len(grid))
+    finally:
+        led_off()
+        tcs.set_integration_time(reference[0])
+        tcs.set_gain(reference[1])
+
+    front = paramsweep.mark_pareto(results)
+    print(paramsweep.RESULT_HEADER)
+    for res in results:
+        print(paramsweep.format_result(res))
+    best = paramsweep.pick(front)
+    if best is not None:
+        print('Pareto front: %d of %d combinations (*)' % (len(front), len(results)))
+        print('Recommended: integration_time %d (%.1f ms), gain %d (%dx), stable_cnt %d, stable_dist %d' %
+              (best['integration_time'], best['integration_ms'], best['gain'], best['gain_factor'],
+               best['stable_cnt'], best['stable_dist']))
+    if out_fn is not None:
+        pr('Saving sweep results to %s', out_fn)
+        paramsweep.save(results, out_fn)
+    return results
+
+
+def setup(config, config_color, backend_name=backend.BACKEND_RPI, config_sim=None):
+    global GPIO
+    global tcs
+    backend.select(backend_name, config_sim)
+    pr('Using backend: %s' % backend_name)
+    GPIO = backend.get_gpio()
     GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(GPIO_LED, GPIO.OUT)
-    time.sleep(0.05)
-    global tcs
+    backend.sleep(0.05)
     integration_time = config['integration_time'][0]
     gain = config['gain'][0]
+    # Older config files have no LED holdoff, use the default
+    set_led_holdoff(config.get('led_holdoff', DEF_SENSOR_LED_HOLDOFF),
+                    config.get('led_settle_early', DEF_SENSOR_LED_SETTLE_EARLY))
+    pr('LED holdoff: %.1f ms%s', 1000 * LED_TOGGLE_HOLDOFF, ', ends early once settled' if LED_SETTLE_EARLY else '')
+    # Older config files have no ready mode and INT pin, use the sleep based default and polling
+    ready_mode = config.get('ready_mode', DEF_SENSOR_READY_MODE)
+    int_gpio = config.get('int_gpio', DEF_SENSOR_INT_GPIO)
     pr('Setting TCS config: Integration time: %5d Gain: %5d' % (integration_time, gain))
     tcs = TCS34725.TCS34725(integration_time=integration_time,
                             gain=gain,
-                            i2c=1)
+                            i2c=backend.get_i2c(1, config_color, GPIO_LED, int_gpio, (integration_time, gain)),
+                            monotonic=backend.monotonic,
+                            sleep=backend.sleep)
+    pr('Setting TCS ready mode: %s (INT GPIO: %s)' % (ready_mode, str(int_gpio)))
+    if int_gpio is not None:
+        tcs.set_int_pin(GPIO, int_gpio)
+    tcs.set_ready_mode(ready_mode)
+    if LED_SETTLE_EARLY and not is_settle_early():
+        prwarn('led_settle_early has no effect, two samples of %.1f ms do not fit into the LED holdoff',
+               1000 * tcs.get_sample_time())
+    if startup.is_installed():
+        tcs.get_raw_data = startup.report_after_call(tcs.get_raw_data, 'first sample')
+
+
+def setup_sensors(config, backend_name=backend.BACKEND_RPI):
+    """ setup() for the sensors of config['sensors'] (see config.DEF_SENSORS), all with the
+        settings of config['sensor']. Returns a list of (name, TCS34725, LED pin, station).
+    """
+    import i2cmux
+    global GPIO
+    backend.select(backend_name, config.get('sim'))
+    pr('Using backend: %s', backend_name)
+    GPIO = backend.get_gpio()
+    GPIO.setwarnings(False)
+    GPIO.setmode(GPIO.BCM)
+    config_sensor = config['sensor']
+    integration_time = config_sensor['integration_time'][0]
+    gain = config_sensor['gain'][0]
+    set_led_holdoff(config_sensor.get('led_holdoff', DEF_SENSOR_LED_HOLDOFF), False)
+    pr('Setting TCS config: Integration time: %5d Gain: %5d LED holdoff: %.1f ms',
+       integration_time, gain, 1000 * LED_TOGGLE_HOLDOFF)
+
+    sensors = []
+    for i, sensor in enumerate(config.get('sensors') or [{}]):
+        name = sensor.get('name', 'sensor%d' % (i + 1))
+        bus = sensor.get('bus', 1)
+        led_pin = sensor.get('led_gpio', GPIO_LED)
+        GPIO.setup(led_pin, GPIO.OUT)
+        if sensor.get('mux_channel') is None:
+            i2c = backend.get_i2c(bus, config['color'], led_pin, None, (integration_time, gain))
+            connection = 'bus %d' % bus
+        else:
+            mux_address = sensor.get('mux_address', i2cmux.TCA9548A_ADDRESS)
+            i2c = backend.get_mux_i2c(bus, sensor['mux_channel'], mux_address, config['color'], led_pin,
+                                      (integration_time, gain))
+            connection = 'bus %d, TCA9548A 0x%02x channel %d' % (bus, mux_address, sensor['mux_channel'])
+        head_tcs = TCS34725.TCS34725(integration_time=integration_time, gain=gain, i2c=i2c,
+                                     monotonic=backend.monotonic, sleep=backend.sleep)
+        station = sensor.get('station')
+        if station is None:
+            station = get_station(GPIO)
+        pr('%s: %s, LED GPIO %d, station %d', name, connection, led_pin, station)
+        if startup.is_installed():
+            # The heads read with read_raw_data, the report comes once after the first of them
+            head_tcs.read_raw_data = startup.report_after_call(head_tcs.read_raw_data, 'first sample')
+        sensors.append((name, head_tcs, led_pin, station))
+    return sensors
+
+
+def set_led_holdoff(holdoff, settle_early):
+    global LED_TOGGLE_HOLDOFF
+    global LED_SETTLE_EARLY
+    LED_TOGGLE_HOLDOFF = holdoff
+    LED_SETTLE_EARLY = settle_early
 
 
 def endprogram():
@@ -759,20 +1407,29 @@ def main():
     # prdbg(args)
 
     # Check if we want also to log to a file
+    log_handlers = [consoleHandler]
     if args['-l'] is not None:
         filehandler = logging.FileHandler(args['-l'])
         filehandler.setFormatter(logFormatter)
-        rootLogger.addHandler(filehandler)
-
-    config = load(args['CONFIG'])
-    # pprint.pprint(config)
-    setup(config['sensor'])
+        log_handlers.append(filehandler)
+    log_listener = start_log_listener(rootLogger, log_handlers)
 
     try:
+        config = load(args['CONFIG'] if args['CONFIG'] is not None else args['--config'])
+        # pprint.pprint(config)
+        if not (args['multi'] or args['replay'] or args['trace']):
+            setup(config['sensor'], config['color'], args['-b'], config.get('sim'))
+
         if args['app']:
             app(config['det'], config['rgb'], config['color'])
         elif args['app2']:
-            app2(config['det'], config['rgb'], config['color'], config['map_station_mp3_color'])
+            app2(config['det'], config['rgb'], config, args['--check-all'], args['--latency-log'])
+        elif args['multi'] and args['--asyncio']:
+            app_async(config, setup_sensors(config, args['-b']), args['--check-all'])
+        elif args['multi']:
+            app_multi(config, setup_sensors(config, args['-b']), args['--check-all'])
+        elif args['cal'] and args['holdoff']:
+            cal_holdoff(config, args['-c'])
         elif args['cal'] and not args['analysis']:
             cal(config['det'], config['rgb'], config['color'], config['sensor'], args['-c'])
         elif args['cal'] and args['analysis']:
@@ -785,10 +1442,18 @@ def main():
             diff()
         elif args['meas']:
             meas(args['on'], args['toggle'])
+        elif args['record']:
+            record(config, args['-o'])
+        elif args['replay']:
+            replay(config, args['TRACE'])
+        elif args['trace'] and args['analysis']:
+            trace_analysis(config, args['TRACES'], args['-o'], int(args['-j']) or None)
         elif args['rgb'] and args['stable']:
             rgb_stable(config['rgb'])
         elif args['save_default']:
             save_default()
+        elif args['sweep']:
+            sweep(config, args['-n'], args['-o'])
         elif args['test_speed']:
             test_speed()
         else:
@@ -796,6 +1461,9 @@ def main():
 
     except KeyboardInterrupt:
         endprogram()
+    finally:
+        # Writes out the pending records
+        log_listener.stop()
 
 
 if __name__ == '__main__':
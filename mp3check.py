@@ -0,0 +1,214 @@
+"""MP3 integrity check without the mpck binary.
+
+Walks the MPEG audio frames of a memory mapped file like mpck does: frame sync, valid and
+consistent header values, frame lengths, CRC of protected Layer III frames and truncation.
+ID3v2 tags at the start and an ID3v1 tag at the end are skipped, every other byte outside
+of a frame is reported as unidentified.
+"""
+
+import mmap
+import os
+
+MPEG_VERSION_2_5 = 0
+MPEG_VERSION_2 = 2
+MPEG_VERSION_1 = 3
+MPEG_VERSION_NAMES = {MPEG_VERSION_1: '1.0', MPEG_VERSION_2: '2.0', MPEG_VERSION_2_5: '2.5'}
+
+# kbit/s by bitrate index, for MPEG 1 and MPEG 2/2.5 and layer 1 to 3. Index 0 (free format) is not supported.
+BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+SAMPLERATES = {
+    MPEG_VERSION_1: (44100, 48000, 32000),
+    MPEG_VERSION_2: (22050, 24000, 16000),
+    MPEG_VERSION_2_5: (11025, 12000, 8000),
+}
+
+ID3V1_LEN = 128
+ID3V2_HEADER_LEN = 10
+FRAME_HEADER_LEN = 4
+CRC_LEN = 2
+CRC16_POLY = 0x8005
+
+# Files with less frames are reported as bad
+MIN_FRAMES = 2
+
+# Increase with every change of the results, cached results of another version are not reused
+MP3CHECK_VERSION = 1
+
+# Error descriptions as reported by mpck, in the order they are listed
+ERROR_UNIDENTIFIED = 'unidentified bytes'
+ERROR_INCONSISTENT = 'inconsistent frame headers'
+ERROR_CRC = 'CRC error'
+ERROR_NO_FRAMES = 'no frames found'
+ERROR_NOT_ENOUGH_FRAMES = 'not enough frames found'
+ERROR_EMPTY_FILE = 'empty file'
+ERRORS = (ERROR_UNIDENTIFIED, ERROR_INCONSISTENT, ERROR_CRC, ERROR_NO_FRAMES, ERROR_NOT_ENOUGH_FRAMES,
+          ERROR_EMPTY_FILE)
+
+
+class FrameHeader(object):
+    __slots__ = ('version', 'layer', 'bitrate', 'samplerate', 'padding', 'protected', 'mono', 'length', 'samples')
+
+    def __init__(self, version, layer, bitrate, samplerate, padding, protected, mono):
+        self.version = version
+        self.layer = layer
+        self.bitrate = bitrate
+        self.samplerate = samplerate
+        self.padding = padding
+        self.protected = protected
+        self.mono = mono
+        if layer == 1:
+            self.length = (12000 * bitrate // samplerate + padding) * 4
+            self.samples = 384
+        elif layer == 3 and version != MPEG_VERSION_1:
+            self.length = 72000 * bitrate // samplerate + padding
+            self.samples = 576
+        else:
+            self.length = 144000 * bitrate // samplerate + padding
+            self.samples = 1152
+
+    def get_side_info_len(self):
+        """ Length of the Layer III side info following the header (and CRC) """
+        if self.version == MPEG_VERSION_1:
+            return 17 if self.mono else 32
+        return 9 if self.mono else 17
+
+
+def parse_frame_header(buf, pos):
+    """ Returns the FrameHeader at pos or None if there is no valid frame header """
+    if buf[pos] != 0xFF:
+        return None
+    b1 = buf[pos + 1]
+    if b1 & 0xE0 != 0xE0:
+        return None
+    version = (b1 >> 3) & 0x3
+    layer = 4 - ((b1 >> 1) & 0x3)
+    if version == 1 or layer == 4:
+        return None
+    b2 = buf[pos + 2]
+    bitrate_index = b2 >> 4
+    samplerate_index = (b2 >> 2) & 0x3
+    if bitrate_index in (0, 15) or samplerate_index == 3:
+        return None
+    return FrameHeader(version, layer,
+                       BITRATES[(version == MPEG_VERSION_1, layer)][bitrate_index],
+                       SAMPLERATES[version][samplerate_index],
+                       (b2 >> 1) & 0x1, not (b1 & 0x1), buf[pos + 3] >> 6 == 3)
+
+
+def crc16(data, crc=0xFFFF):
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x10000:
+                crc ^= CRC16_POLY
+        crc &= 0xFFFF
+    return crc
+
+
+def check_crc(buf, pos, header):
+    """ Checks the CRC of a protected Layer III frame, it covers the last two header bytes
+        and the side info. Other layers are not checked.
+    """
+    if header.layer != 3:
+        return True
+    side_info_pos = pos + FRAME_HEADER_LEN + CRC_LEN
+    crc = crc16(buf[pos + 2:pos + FRAME_HEADER_LEN])
+    crc = crc16(buf[side_info_pos:side_info_pos + header.get_side_info_len()], crc)
+    return crc == (buf[pos + FRAME_HEADER_LEN] << 8 | buf[pos + FRAME_HEADER_LEN + 1])
+
+
+def get_id3v2_len(buf):
+    if len(buf) < ID3V2_HEADER_LEN or buf[:3] != b'ID3':
+        return 0
+    size = 0
+    for byte in buf[6:10]:
+        size = size << 7 | (byte & 0x7F)
+    footer = ID3V2_HEADER_LEN if buf[5] & 0x10 else 0
+    return ID3V2_HEADER_LEN + size + footer
+
+
+def find_frame(buf, pos, end):
+    """ Returns the position of the next frame at or after pos. To not sync to 0xFF bytes
+        in the audio data the frame has to be followed by another frame or the end.
+    """
+    while True:
+        pos = buf.find(b'\xff', pos, end - FRAME_HEADER_LEN + 1)
+        if pos < 0:
+            return end
+        header = parse_frame_header(buf, pos)
+        if header is not None:
+            next_pos = pos + header.length
+            if next_pos == end or \
+                    (next_pos + FRAME_HEADER_LEN <= end and parse_frame_header(buf, next_pos) is not None):
+                return pos
+        pos += 1
+
+
+def check_mp3(path):
+    """ Checks the MP3 file path. Returns the same dict check_valid_mp3_content returns for
+        the output of mpck: bitrate, samplerate, frames, time, unidentified, errors and
+        result (Ok or Bad).
+    """
+    size = os.path.getsize(path)
+    errors = set()
+    frames = 0
+    samples = 0
+    bitrate_sum = 0
+    unidentified = 0
+    first = None
+    if size == 0:
+        errors.add(ERROR_EMPTY_FILE)
+    else:
+        with open(path, 'rb') as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            pos = min(get_id3v2_len(buf), size)
+            end = size
+            if end - pos >= ID3V1_LEN and buf[end - ID3V1_LEN:end - ID3V1_LEN + 3] == b'TAG':
+                end -= ID3V1_LEN
+            while pos < end:
+                header = parse_frame_header(buf, pos) if pos + FRAME_HEADER_LEN <= end else None
+                if header is None:
+                    next_pos = find_frame(buf, pos + 1, end)
+                    unidentified += next_pos - pos
+                    pos = next_pos
+                    continue
+                if pos + header.length > end:
+                    # Truncated last frame
+                    unidentified += end - pos
+                    break
+                if first is None:
+                    first = header
+                elif (header.version, header.layer, header.samplerate) != \
+                        (first.version, first.layer, first.samplerate):
+                    errors.add(ERROR_INCONSISTENT)
+                if header.protected and not check_crc(buf, pos, header):
+                    errors.add(ERROR_CRC)
+                frames += 1
+                samples += header.samples
+                bitrate_sum += header.bitrate
+                pos += header.length
+        if unidentified:
+            errors.add(ERROR_UNIDENTIFIED)
+        if frames == 0:
+            errors.add(ERROR_NO_FRAMES)
+        elif frames < MIN_FRAMES:
+            errors.add(ERROR_NOT_ENOUGH_FRAMES)
+
+    samplerate = first.samplerate if first is not None else 0
+    msecs = 1000 * samples // samplerate if samplerate else 0
+    return {
+        'bitrate': str(1000 * bitrate_sum // frames if frames else 0),
+        'samplerate': str(samplerate),
+        'frames': str(frames),
+        'time': '%d:%02d.%03d' % (msecs // 60000, msecs // 1000 % 60, msecs % 1000),
+        'unidentified': '%d b (%d%%)' % (unidentified, 100 * unidentified // size if size else 0),
+        'errors': ', '.join(error for error in ERRORS if error in errors) or 'none',
+        'result': 'Bad' if errors else 'Ok',
+    }
@@ -0,0 +1,147 @@
+"""Several sensor heads on one Pi (ledsense.py multi).
+
+Every SensorHead is a TCS34725 with its own LED, serving a station. Its detection runs as a
+state machine advanced by sample(), which never waits: detect a cube (LED off, clear channel
+below the threshold), find a stable RGB (LED on), wait for the removal (LED off).
+
+The sensors integrate continuously on their own. Instead of waiting for each sensor in turn,
+SensorScheduler reads the heads from one thread in the order their next sample is due, so
+the integration periods of all sensors overlap and N sensors deliver about N times the
+samples of one.
+"""
+
+import heapq
+
+from helper import StableRgbWindow, pr, prdbg
+
+STATE_DETECT = 'detect'      # LED off, waiting for a cube
+STATE_STABLE = 'stable'      # LED on, waiting for a stable RGB
+STATE_REMOVAL = 'removal'    # LED off, waiting until the cube is removed
+
+# Seconds between two throughput reports of SensorScheduler.run()
+MULTI_REPORT_INT = 60
+
+
+class SensorHead(object):
+    def __init__(self, name, tcs, gpio, led_pin, station, config_det, config_rgb, classifier, holdoff, clock,
+                 on_color=None, on_removed=None):
+        """ classifier is the ColorClassifier of the palette. After a switch of the LED the
+            next sample is taken holdoff plus an integration time later.
+            on_color(head, color) is called with the found (name, rgb, dist) or None if the
+            distance exceeds max_dist, on_removed(head) after the removal of the cube.
+        """
+        self.name = name
+        self.tcs = tcs
+        self.gpio = gpio
+        self.led_pin = led_pin
+        self.station = station
+        self.threshold = config_det['threshold']
+        self.stable_cnt = config_rgb['stable_cnt']
+        self.stable_dist = config_rgb['stable_dist']
+        self.max_dist = config_rgb['max_dist']
+        self.classifier = classifier
+        self.holdoff = holdoff
+        self.clock = clock
+        self.on_color = on_color
+        self.on_removed = on_removed
+        self.sample_time = tcs.get_sample_time()
+        self.state = STATE_DETECT
+        self.window = None
+        self.samples = 0
+        self.cubes = 0
+        self.last_rgbc = None
+        self._switch_led(False, clock())
+
+    def _switch_led(self, on, now):
+        self.gpio.output(self.led_pin, self.gpio.HIGH if on else self.gpio.LOW)
+        # The next sample has to be integrated completely with the settled LED
+        self.next_due = now + self.holdoff + self.sample_time
+
+    def sample(self, now):
+        """ Reads the sample that is due and advances the state machine """
+        self.process(now, self.tcs.read_raw_data())
+
+    def process(self, now, rgbc):
+        """ Advances the state machine with rgbc, the sample due at now """
+        r, g, b, c = self.last_rgbc = rgbc
+        self.samples += 1
+        self.next_due = now + self.sample_time
+        if self.state == STATE_DETECT:
+            if c < self.threshold:
+                prdbg('%s: Cube detected: %4d < %4d', self.name, c, self.threshold)
+                self.state = STATE_STABLE
+                self.window = StableRgbWindow(self.stable_cnt, self.stable_dist)
+                self._switch_led(True, now)
+        elif self.state == STATE_STABLE:
+            if self.window.add([r, g, b]):
+                self.state = STATE_REMOVAL
+                self._switch_led(False, now)
+                self.cubes += 1
+                self._classify(self.window.get_median())
+        elif self.state == STATE_REMOVAL:
+            if c > self.threshold:
+                prdbg('%s: Cube removed:  %4d > %4d', self.name, c, self.threshold)
+                self.state = STATE_DETECT
+                if self.on_removed is not None:
+                    self.on_removed(self)
+
+    def _classify(self, rgb):
+        index, dist = self.classifier.classify(rgb)
+        name, color_rgb = self.classifier.get_color(index)
+        pr('%s: Found %-15s - Dist %d - Cur. RGB: %-20s RGB %-20s', self.name, name, dist, rgb, color_rgb)
+        color = (name, color_rgb, dist) if dist <= self.max_dist else None
+        if self.on_color is not None:
+            self.on_color(self, color)
+
+
+class SensorScheduler(object):
+    def __init__(self, heads, clock, sleep, report_int=MULTI_REPORT_INT):
+        self.heads = heads
+        self.clock = clock
+        self.sleep = sleep
+        self.report_int = report_int
+        self.start = None
+
+    def run(self, duration=None, stop=None):
+        """ Samples the heads until duration seconds passed or stop() returns True, forever
+            if neither is given
+        """
+        heap = [(head.next_due, i) for i, head in enumerate(self.heads)]
+        heapq.heapify(heap)
+        self.start = self.clock()
+        next_report = self.start + self.report_int
+        while not (stop is not None and stop()):
+            due, i = heapq.heappop(heap)
+            wait = due - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+            now = self.clock()
+            if duration is not None and now - self.start >= duration:
+                break
+            head = self.heads[i]
+            head.sample(now)
+            heapq.heappush(heap, (head.next_due, i))
+            if now >= next_report:
+                self.report()
+                next_report += self.report_int
+
+    def get_throughput(self):
+        return get_throughput(self.heads, self.clock() - self.start if self.start is not None else 0.0)
+
+    def report(self):
+        report(self.get_throughput())
+
+
+def get_throughput(heads, elapsed):
+    """ Returns per head a dict with name, station, samples, samples_per_s and cubes, elapsed
+        seconds after the start
+    """
+    return [{'name': head.name, 'station': head.station, 'samples': head.samples,
+             'samples_per_s': head.samples / elapsed if elapsed > 0 else 0.0, 'cubes': head.cubes}
+            for head in heads]
+
+
+def report(throughput):
+    for entry in throughput:
+        pr('%s (station %d): %d samples, %.1f samples/s, %d cubes', entry['name'], entry['station'],
+           entry['samples'], entry['samples_per_s'], entry['cubes'])
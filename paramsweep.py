@@ -0,0 +1,114 @@
+"""Sensor parameter sweep for ledsense.py sweep.
+
+Every combination of integration time, gain, stable_cnt and stable_dist is measured on the
+station (real sensor or sim backend, e.g. replaying a trace): samples per second, the time
+until the RGB is stable and the accuracy: the share of the stable RGBs classified within
+max_dist as the color the cube has with the reference settings (the ones the palette was
+calibrated with). The readings are scaled to the reference settings before they are
+classified. The combinations no other one beats in all of
+these form the Pareto front.
+"""
+
+import csv
+import itertools
+import json
+
+import TCS34725
+
+SWEEP_INTEGRATION_TIMES = tuple(sorted(TCS34725.INTEGRATION_TIME_DELAY, key=TCS34725.INTEGRATION_TIME_DELAY.get))
+SWEEP_GAINS = tuple(sorted(TCS34725.GAIN_FACTOR))
+SWEEP_STABLE_CNTS = (3, 5, 8)
+SWEEP_STABLE_DISTS = (10, 30, 100)
+
+# Samples read per combination to measure the sample rate
+SWEEP_RATE_SAMPLES = 10
+# A measurement gives up if the RGB is not stable after this number of samples
+SWEEP_MAX_STABLE_SAMPLES = 50
+
+# Columns of the CSV file
+FIELDS = ('integration_time', 'integration_ms', 'gain', 'gain_factor', 'stable_cnt', 'stable_dist',
+          'samples_per_s', 'stable_ms', 'accuracy', 'dist', 'pareto')
+
+# The Pareto front is built from these fields, True: larger is better
+OBJECTIVES = (('samples_per_s', True), ('stable_ms', False), ('accuracy', True))
+
+# Rows compared at once by mark_pareto(), limits the memory to rows * all results
+PARETO_CHUNK = 256
+
+
+def get_grid(integration_times=SWEEP_INTEGRATION_TIMES, gains=SWEEP_GAINS, stable_cnts=SWEEP_STABLE_CNTS,
+             stable_dists=SWEEP_STABLE_DISTS):
+    """ Returns all combinations as dicts with integration_time, gain, stable_cnt and stable_dist """
+    return [{'integration_time': integration_time, 'gain': gain, 'stable_cnt': stable_cnt, 'stable_dist': stable_dist}
+            for integration_time, gain, stable_cnt, stable_dist in
+            itertools.product(integration_times, gains, stable_cnts, stable_dists)]
+
+
+def dominates(res1, res2, objectives=OBJECTIVES):
+    """ True if res1 is nowhere worse than res2 and better in at least one objective """
+    better = False
+    for field, larger in objectives:
+        value1, value2 = (res1[field], res2[field]) if larger else (res2[field], res1[field])
+        if value1 < value2:
+            return False
+        if value1 > value2:
+            better = True
+    return better
+
+
+def mark_pareto(results, objectives=OBJECTIVES):
+    """ Sets 'pareto' of all results (see dominates()), returns the ones on the Pareto front.
+        Compares whole arrays, thousands of results (see traceanalysis.py) are too many to
+        compare pair by pair. Missing values (None) are worst.
+    """
+    import numpy
+    values = numpy.array([[numpy.inf if res[field] is None else -res[field] if larger else res[field]
+                           for field, larger in objectives] for res in results], dtype=numpy.float64)
+    values[numpy.isnan(values)] = numpy.inf
+    # Many combinations give the same objectives, only the different ones are compared
+    values, inverse = numpy.unique(values.reshape(-1, len(objectives)), axis=0, return_inverse=True)
+    dominated = numpy.zeros(len(values), dtype=bool)
+    for start in range(0, len(values), PARETO_CHUNK):
+        chunk = values[start:start + PARETO_CHUNK, numpy.newaxis, :]
+        # Smaller is better for all columns now
+        better = (values <= chunk).all(axis=2) & (values < chunk).any(axis=2)
+        dominated[start:start + PARETO_CHUNK] = better.any(axis=1)
+    for res, dom in zip(results, dominated[inverse.reshape(-1)]):
+        res['pareto'] = not dom
+    return [res for res in results if res['pareto']]
+
+
+def pick(front):
+    """ Returns the recommended result of the Pareto front: the most accurate one, of those
+        the fastest to a stable RGB. None if front is empty.
+    """
+    if not front:
+        return None
+    return min(front, key=lambda res: (-res['accuracy'], res['stable_ms'], -res['samples_per_s']))
+
+
+def format_result(res):
+    return '%6.1f ms %3dx %3d %4d | %8.1f %9.1f %7.1f%% %6s %s' % (
+        res['integration_ms'], res['gain_factor'], res['stable_cnt'], res['stable_dist'], res['samples_per_s'],
+        res['stable_ms'], 100 * res['accuracy'], '-' if res['dist'] is None else '%d' % res['dist'],
+        '*' if res.get('pareto') else '')
+
+
+RESULT_HEADER = '%9s %4s %3s %4s | %8s %9s %8s %6s' % ('Int.', 'Gain', 'Cnt', 'Dist', 'Samp./s', 'Stable ms',
+                                                       'Accuracy', 'Dist')
+
+
+def save(results, fn, fields=FIELDS, pick=pick):
+    """ Writes the results to fn, as JSON if fn ends with .json, otherwise as CSV with the
+        columns fields. The JSON file also holds the result pick() recommends of the Pareto front
+        (see mark_pareto).
+    """
+    if fn.endswith('.json'):
+        with open(fn, 'w') as outfile:
+            json.dump({'results': results, 'pick': pick([res for res in results if res.get('pareto')])},
+                      outfile, indent=2)
+    else:
+        with open(fn, 'w', newline='') as outfile:
+            writer = csv.DictWriter(outfile, fields)
+            writer.writeheader()
+            writer.writerows(results)
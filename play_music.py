@@ -1,84 +1,331 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-
+import collections
+import queue
+import threading
 import time
 
-import alsaaudio
-import pygame
-
+import backend
 from config import DEF_PATH_MP3, MP3FileError, convert_fn
-from helper import pr, prerr
+from helper import pr, prerr, prwarn
 
 DEF_AUDIO_DEVICE = 'PCM'
 
-exit_thread = False
-stop_playing = False
-start_playing = False
+# While a track is playing the sink is asked this often (in s) whether it has finished
+BUSY_POLL_INTERVAL = 0.05
 
+# Default time (in s) to wait for the acknowledgement of a command
+DEF_ACK_TIMEOUT = 1.0
 
-def get_mp3_filename(map_station_mp3_color, cur_station, cur_color):
-    for station, fn, color in map_station_mp3_color:
-        if cur_station == station and \
-                cur_color == color:
-            return fn
-    raise MP3FileError('Filename not defined for %s, %s' % (cur_station, cur_color))
+# Upper limit (in bytes) of the decoded audio kept in memory by AudioCache. Tracks that
+# do not fit are streamed from the file.
+DEF_AUDIO_CACHE_MAX_BYTES = 128 * 1024 * 1024
 
+CMD_START = 'start'
+CMD_STOP = 'stop'
+CMD_EXIT = 'exit'
 
-def play(fn):
-    global stop_playing
-    pygame.mixer.music.load(fn)
-    pygame.mixer.music.set_volume(1)  # Set to max
-    pr('Playing %s with volume %d' % (fn, 100 * pygame.mixer.music.get_volume()))
-    pygame.mixer.music.play()
-    while pygame.mixer.music.get_busy():
-        if stop_playing or exit_thread:
-            pr('Stopping to play')
-            pygame.mixer.music.stop()
-            stop_playing = False
+
+def get_mp3_filename(mp3_index, cur_station, cur_color):
+    """ Returns the path of the MP3 file for cur_color, mp3_index is Config.mp3_index """
+    try:
+        return DEF_PATH_MP3 + convert_fn(mp3_index[(cur_station, cur_color)])
+    except KeyError:
+        raise MP3FileError('Filename not defined for %s, %s' % (cur_station, cur_color))
+
+
+class AudioCache(object):
+    """ Decoded sounds by (station, color), least recently used ones are evicted once
+        more than max_bytes are used. loader(fn) returns the sound and its size in
+        bytes or (None, 0) if fn can not be decoded.
+    """
+    def __init__(self, loader, max_bytes=DEF_AUDIO_CACHE_MAX_BYTES):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._sounds = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._sounds)
+
+    def __contains__(self, key):
+        return key in self._sounds
+
+    def get(self, key, fn):
+        """ Returns the sound of key, loads it from fn if not cached. None means fn
+            has to be streamed.
+        """
+        if key in self._sounds:
+            self.hits += 1
+            self._sounds.move_to_end(key)
+            return self._sounds[key][0]
+        self.misses += 1
+        return self._load(key, fn)
+
+    def preload(self, items):
+        """ Loads the sounds of items, (key, fn) pairs, in that order """
+        for key, fn in items:
+            if key not in self._sounds:
+                self._load(key, fn)
+        pr('Audio cache: %d sounds, %.1f MB' % (len(self._sounds), self.size / 1048576.0))
+
+    def _load(self, key, fn):
+        sound, nbytes = self.loader(fn)
+        if sound is None:
+            return None
+        if nbytes > self.max_bytes:
+            prwarn('Audio cache: %s needs %d bytes, more than the limit of %d, streaming it' %
+                   (fn, nbytes, self.max_bytes))
+            return None
+        while self.size + nbytes > self.max_bytes:
+            _, (_, evicted_bytes) = self._sounds.popitem(last=False)
+            self.size -= evicted_bytes
+        self._sounds[key] = (sound, nbytes)
+        self.size += nbytes
+        return sound
+
+
+class MusicStream(object):
+    """ The one music stream of the process (pygame.mixer.music), shared by all PygameSinks.
+        A sink owns it from its play() until another sink plays or it stops, stop() and
+        is_busy() of the other sinks leave it alone. music is the pygame.mixer.music module,
+        imported on first use if None.
+    """
+    def __init__(self, music=None):
+        self.owner = None
+        self._music = music
+        self._lock = threading.Lock()
+
+    def _get_music(self):
+        if self._music is None:
+            import pygame
+            self._music = pygame.mixer.music
+        return self._music
+
+    def play(self, sink, fn):
+        with self._lock:
+            music = self._get_music()
+            if self.owner is not None and self.owner is not sink and music.get_busy():
+                prwarn('Only one track can be streamed, %s cuts off the one of another station' % fn)
+            self.owner = sink
+            music.load(fn)
+            music.set_volume(1)  # Set to max
+            pr('Playing %s with volume %d' % (fn, 100 * music.get_volume()))
+            music.play()
+
+    def stop(self, sink):
+        with self._lock:
+            if self.owner is sink:
+                self._get_music().stop()
+                self.owner = None
+
+    def is_busy(self, sink):
+        with self._lock:
+            return self.owner is sink and self._get_music().get_busy()
+
+
+MUSIC_STREAM = MusicStream()
+
+
+class PygameSink(object):
+    """ Audio output with pygame and the Alsa mixer. Preloaded sounds are played on a
+        mixer channel of their own, everything else is streamed with stream (see MusicStream).
+        stop() stops only what this sink started, several sinks may play at once.
+    """
+    def __init__(self, stream=MUSIC_STREAM):
+        self.channel = None
+        self.stream = stream
+
+    def setup(self):
+        import alsaaudio
+        import pygame
+        pygame.init()
+        pygame.mixer.init()
+        m = alsaaudio.Mixer(DEF_AUDIO_DEVICE)
+        vol_before = m.getvolume()[0]
+        m.setvolume(100)
+        vol_after = m.getvolume()[0]
+        pr('Setting Alsa volume for %s to %d (was: %d)' % (DEF_AUDIO_DEVICE, vol_after, vol_before))
+
+    def load(self, fn):
+        import pygame
+        try:
+            sound = pygame.mixer.Sound(fn)
+        except pygame.error as e:
+            prwarn('Could not decode %s: %s' % (fn, e))
+            return None, 0
+        frequency, size, channels = pygame.mixer.get_init()
+        return sound, int(sound.get_length() * frequency) * channels * abs(size) // 8
+
+    def play(self, fn, sound=None):
+        if sound is not None:
+            sound.set_volume(1)  # Set to max
+            pr('Playing preloaded %s' % fn)
+            self.channel = sound.play()
             return
-        pygame.time.Clock().tick(10)
+        self.channel = None
+        self.stream.play(self, fn)
 
-    pr('Finished playing')
+    def stop(self):
+        if self.channel is not None:
+            self.channel.stop()
+            self.channel = None
+        self.stream.stop(self)
 
+    def is_busy(self):
+        if self.channel is not None:
+            return self.channel.get_busy()
+        return self.stream.is_busy(self)
 
-def setup():
-    pygame.init()
-    pygame.mixer.init()
-    m = alsaaudio.Mixer(DEF_AUDIO_DEVICE)
-    vol_before = m.getvolume()[0]
-    m.setvolume(100)
-    vol_after = m.getvolume()[0]
-    pr('Setting Alsa volume for %s to %d (was: %d)' % (DEF_AUDIO_DEVICE, vol_after, vol_before))
 
+class NullSink(object):
+    """ Audio output that only pretends to play each file for track_time seconds of clock.
+        The played files are recorded in played.
+    """
+    def __init__(self, track_time=0.0, clock=time.monotonic):
+        self.track_time = track_time
+        self.clock = clock
+        self.played = []
+        self.loaded = []
+        self.stopped = 0
+        self._end = 0.0
 
-def main(map_station_mp3_color, station):
-    global exit_thread
-    global stop_playing
-    global start_playing
-    pr('play_music.main: Starting thread')
-    setup()
+    def setup(self):
+        pr('No audio output')
 
-    try:
+    def load(self, fn):
+        self.loaded.append(fn)
+        return fn, 0
+
+    def play(self, fn, sound=None):
+        pr('Null sink: Playing %s' % fn)
+        self.played.append(fn)
+        self._end = self.clock() + self.track_time
+
+    def stop(self):
+        self.stopped += 1
+        self._end = 0.0
+
+    def is_busy(self):
+        return self.clock() < self._end
+
+
+def get_sink():
+    """ Returns the audio output of the selected backend """
+    if backend.is_sim():
+        return NullSink(backend.config_sim['track_time'], backend.monotonic)
+    return PygameSink()
+
+
+class PlaybackCommand(object):
+    def __init__(self, name, color=None):
+        self.name = name
+        self.color = color
+        self.result = None
+        self.done = threading.Event()
+
+
+class Player(object):
+    """ Plays the MP3 file of a color for the station on sink, setup() decodes the tracks of
+        the station. mp3_index maps (station, color) to the MP3 filename (see Config.mp3_index).
+        The methods block, PlaybackController calls them from its thread, the asyncio runtime
+        (see aioapp.py) from its executor.
+    """
+    def __init__(self, mp3_index, station, sink=None, cache_max_bytes=DEF_AUDIO_CACHE_MAX_BYTES):
+        self.mp3_index = mp3_index
+        self.station = station
+        self.sink = sink if sink is not None else get_sink()
+        self.cache = AudioCache(self.sink.load, cache_max_bytes)
+        self.playing = None
+
+    def setup(self):
+        self.sink.setup()
+        self.cache.preload((key, get_mp3_filename(self.mp3_index, *key))
+                           for key in self.mp3_index if key[0] == self.station)
+
+    def stop_track(self):
+        if self.playing is not None:
+            pr('Stopping to play')
+            self.sink.stop()
+            self.playing = None
+
+    def start_track(self, color):
+        """ Stops the current track and plays the one of color, returns False if there is no file for color """
+        self.stop_track()
+        try:
+            pr('Trying to find fn to play %s' % str(color))
+            fn = get_mp3_filename(self.mp3_index, self.station, color)
+        except MP3FileError as e:
+            pr(e)
+            return False
+        self.sink.play(fn, self.cache.get((self.station, color), fn))
+        self.playing = color
+        return True
+
+    def check_finished(self):
+        """ Returns True if the playing track has just finished """
+        if self.playing is None or self.sink.is_busy():
+            return False
+        pr('Finished playing')
+        self.playing = None
+        return True
+
+
+class PlaybackController(Player, threading.Thread):
+    """ Player in a thread of its own. The commands are queued and executed by the thread
+        as soon as they arrive, the caller may wait for the acknowledgement. Only while a
+        track is playing the sink is polled to notice its end, an idle controller just
+        blocks on the queue. The tracks of the station are decoded when the thread starts.
+    """
+    def __init__(self, mp3_index, station, sink=None, cache_max_bytes=DEF_AUDIO_CACHE_MAX_BYTES):
+        threading.Thread.__init__(self, name='play_music')
+        Player.__init__(self, mp3_index, station, sink, cache_max_bytes)
+        self._queue = queue.Queue()
+
+    def start_playing(self, color, wait=True, timeout=DEF_ACK_TIMEOUT):
+        """ Stops the current track and plays the one of color. Returns True if it
+            started, False if there is no file for color and None if not acknowledged.
+        """
+        return self._send(PlaybackCommand(CMD_START, color), wait, timeout)
+
+    def stop_playing(self, wait=True, timeout=DEF_ACK_TIMEOUT):
+        return self._send(PlaybackCommand(CMD_STOP), wait, timeout)
+
+    def exit(self, timeout=DEF_ACK_TIMEOUT):
+        """ Stops playing and ends the thread """
+        self._send(PlaybackCommand(CMD_EXIT), False, None)
+        self.join(timeout)
+
+    def _send(self, cmd, wait, timeout):
+        self._queue.put(cmd)
+        if wait:
+            cmd.done.wait(timeout)
+        return cmd.result
+
+    def run(self):
+        pr('play_music: Starting thread')
+        self.setup()
         while 42:
-            while not start_playing:
-                time.sleep(0.1)
-                if exit_thread:
-                    pr('play_music.main: Exit thread')
-                    return
             try:
-                pr('Trying to find fn to play %s' % str(start_playing))
-                fn = get_mp3_filename(map_station_mp3_color, station, start_playing)
-                fn = DEF_PATH_MP3 + convert_fn(fn)
-                play(fn)
-                if exit_thread:
-                    pr('play_music.main: Exit thread')
+                cmd = self._queue.get(timeout=BUSY_POLL_INTERVAL if self.playing is not None else None)
+            except queue.Empty:
+                self.check_finished()
+                continue
+            try:
+                if cmd.name == CMD_START:
+                    cmd.result = self.start_track(cmd.color)
+                elif cmd.name == CMD_STOP:
+                    self.stop_track()
+                    cmd.result = True
+                elif cmd.name == CMD_EXIT:
+                    self.stop_track()
+                    cmd.result = True
+                    pr('play_music: Exit thread')
                     return
-                time.sleep(1)
-            except MP3FileError as e:
-                pr(e)
-                pass
-            start_playing = False
-
-    except KeyboardInterrupt:
-        pass
+                else:
+                    prerr('play_music: Unknown command %s' % cmd.name)
+            finally:
+                cmd.done.set()
@@ -0,0 +1,199 @@
+"""Binary RGBC traces (ledsense.py record and replay).
+
+A trace file starts with a header and is followed by fixed-width records, one per sample:
+
+  header  magic b'RGBCTRC1', version (uint16), record size (uint16), length of the info (uint32),
+          info: JSON object with the sensor configuration, padded with blanks to a multiple of 8 bytes
+  record  t (float64, seconds since the epoch), r, g, b, c (uint16), led (uint8, 1: LED on)
+
+All numbers are little endian. The file is only ever appended to, by recordings with the same
+info, t never goes backwards. A record cut short by a crash is dropped by the next TraceWriter
+or ignored by load(), which maps the records into memory as numpy structured array.
+ReplaySensor feeds the records to the detection of ledsense.py as fast as they are read.
+"""
+
+import json
+import os
+import struct
+import time
+
+TRACE_MAGIC = b'RGBCTRC1'
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct('<8sHHI')
+TRACE_RECORD = struct.Struct('<dHHHHB')
+# numpy dtype of TRACE_RECORD
+TRACE_DTYPE = [('t', '<f8'), ('r', '<u2'), ('g', '<u2'), ('b', '<u2'), ('c', '<u2'), ('led', 'u1')]
+
+# File name extension of the traces
+TRACE_SUFFIX = '.rgbc'
+
+# Entries of the info that may differ between the recordings appended to one trace
+TRACE_INFO_IGNORED = ('desc',)
+# Minimal seconds between the last record of a trace and the first one appended to it
+TRACE_APPEND_GAP = 1.0
+
+
+class TraceEnd(Exception):
+    """ The replayed trace has no more samples """
+
+
+def is_trace(path):
+    """ True if path starts with the magic of a binary trace """
+    with open(path, 'rb') as infile:
+        return infile.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+
+
+def read_header(infile):
+    """ Returns the info dict and the offset of the first record, raises ValueError if infile
+        is no trace of this version
+    """
+    data = infile.read(TRACE_HEADER.size)
+    if len(data) < TRACE_HEADER.size:
+        raise ValueError('%s: Not a RGBC trace, too short' % infile.name)
+    magic, version, record_size, info_len = TRACE_HEADER.unpack(data)
+    if magic != TRACE_MAGIC:
+        raise ValueError('%s: Not a RGBC trace' % infile.name)
+    if version != TRACE_VERSION or record_size != TRACE_RECORD.size:
+        raise ValueError('%s: Unsupported trace version %d with records of %d bytes' %
+                         (infile.name, version, record_size))
+    info = json.loads(infile.read(info_len).decode('utf-8'))
+    return info, TRACE_HEADER.size + info_len
+
+
+def check_info(path, stored, info):
+    """ Raises ValueError if the info of a new recording differs from the stored one of path """
+    info = json.loads(json.dumps(info))
+    keys = set(stored) | set(info)
+    differ = sorted(key for key in keys if key not in TRACE_INFO_IGNORED and stored.get(key) != info.get(key))
+    if differ:
+        raise ValueError('%s: Recorded with other %s, use another trace file' % (path, ', '.join(differ)))
+
+
+class TraceWriter(object):
+    def __init__(self, path, info, clock=time.monotonic):
+        """ Appends to the trace path, a new file gets info (a JSON serializable dict) in its
+            header. Raises ValueError if path exists with another info, apart from the entries
+            of TRACE_INFO_IGNORED. The timestamps of clock are stored as seconds since the epoch,
+            at least TRACE_APPEND_GAP after the last stored one (a sim clock may run ahead).
+        """
+        self.path = path
+        self.clock = clock
+        self.count = 0
+        last_t = None
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            with open(path, 'rb') as infile:
+                self.info, offset = read_header(infile)
+            check_info(path, self.info, info)
+            # Drop a record cut short
+            size = os.path.getsize(path)
+            size -= (size - offset) % TRACE_RECORD.size
+            with open(path, 'r+b') as outfile:
+                outfile.truncate(size)
+                if size > offset:
+                    outfile.seek(size - TRACE_RECORD.size)
+                    last_t = TRACE_RECORD.unpack(outfile.read(TRACE_RECORD.size))[0]
+        else:
+            self.info = info
+        self._file = open(path, 'ab')
+        if not exists:
+            data = json.dumps(info).encode('utf-8')
+            data += b' ' * (-(TRACE_HEADER.size + len(data)) % 8)
+            self._file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size, len(data)) + data)
+        self._epoch = time.time() - clock()
+        if last_t is not None:
+            self._epoch = max(self._epoch, last_t + TRACE_APPEND_GAP - clock())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, r, g, b, c, led, t=None):
+        """ Appends a sample, t is a time of clock (default: now) """
+        if t is None:
+            t = self.clock()
+        self._file.write(TRACE_RECORD.pack(self._epoch + t, r, g, b, c, 1 if led else 0))
+        self.count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Trace(object):
+    """ A trace as loaded by load(), records is the numpy array of the samples (see TRACE_DTYPE) """
+    def __init__(self, path, info, records):
+        self.path = path
+        self.info = info
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_duration(self):
+        return float(self.records['t'][-1] - self.records['t'][0]) if len(self.records) else 0.0
+
+
+def load(path):
+    """ Returns the Trace of path, the records are memory mapped (read only). Raises ValueError
+        if t goes backwards, replay and analysis rely on the order.
+    """
+    import numpy
+    with open(path, 'rb') as infile:
+        info, offset = read_header(infile)
+    count = (os.path.getsize(path) - offset) // TRACE_RECORD.size
+    if count == 0:
+        return Trace(path, info, numpy.zeros(0, dtype=TRACE_DTYPE))
+    records = numpy.memmap(path, dtype=TRACE_DTYPE, mode='r', offset=offset, shape=(count,))
+    backwards = numpy.flatnonzero(numpy.diff(records['t']) < 0)
+    if len(backwards):
+        raise ValueError('%s: Time goes back by %.3f s at record %d' %
+                         (path, records['t'][backwards[0]] - records['t'][backwards[0] + 1], backwards[0] + 1))
+    return Trace(path, info, records)
+
+
+class ReplaySensor(object):
+    """ Replaces TCS34725 and the time base (see backend.set_clock) to replay a trace as fast
+        as it is read. Time is the one of the trace: get_raw_data() returns the next sample
+        taken at or after the current time and advances the time to it, sleep() just advances
+        the time. Raises TraceEnd after the last sample.
+    """
+    def __init__(self, trace):
+        import numpy
+        self.trace = trace
+        self._t = numpy.ascontiguousarray(trace.records['t'])
+        self._pos = 0
+        self.now = float(self._t[0]) if len(self._t) else 0.0
+        self.sample_time = trace.info.get('sample_time', 0.0)
+        self.samples = 0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def get_sample_time(self):
+        return self.sample_time
+
+    def has_int_pin(self):
+        return False
+
+    def get_raw_data(self):
+        import numpy
+        pos = self._pos + int(numpy.searchsorted(self._t[self._pos:], self.now))
+        if pos >= len(self._t):
+            raise TraceEnd('%s: End of trace after %d samples' % (self.trace.path, self.samples))
+        record = self.trace.records[pos]
+        self._pos = pos + 1
+        self.now = float(self._t[pos])
+        self.samples += 1
+        return int(record['r']), int(record['g']), int(record['b']), int(record['c'])
+
+    read_raw_data = get_raw_data
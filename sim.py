@@ -0,0 +1,450 @@
+import bisect
+import random
+import threading
+import time
+
+import TCS34725
+
+# Duration of one TCS34725 integration cycle in seconds
+SIM_CYCLE_TIME = 0.0024
+
+# Number of integration cycles needed to raise an interrupt per persistence setting
+SIM_PERS_CYCLES = TCS34725.PERS_CYCLES
+
+# Do not evaluate more than this number of missed cycles at once
+SIM_MAX_CYCLES_PER_UPDATE = 64
+
+# Approximate number of bits on the bus per byte (8 data + ACK)
+SIM_BITS_PER_BYTE = 9
+
+
+class SimClock(object):
+    """ Simulated time running speed times faster than the wall clock. """
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self._start = time.monotonic()
+
+    def monotonic(self):
+        return self._start + (time.monotonic() - self._start) * self.speed
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.speed)
+
+
+def const_source(r=0, g=0, b=0, c=0):
+    """ Returns a source for SimTCS34725Bus that always delivers the same reading. """
+    def source(t):
+        return r, g, b, c
+    return source
+
+
+class ScriptSource(object):
+    """ Source for SimTCS34725Bus replaying a list of (duration, (r, g, b, c)) steps.
+        Time starts with the first call, the last step is held forever.
+    """
+    def __init__(self, steps):
+        self.steps = steps
+        self.start = None
+
+    def __call__(self, t):
+        if self.start is None:
+            self.start = t
+        elapsed = t - self.start
+        for duration, rgbc in self.steps:
+            if elapsed < duration:
+                return rgbc
+            elapsed -= duration
+        return self.steps[-1][1]
+
+
+class CubeSource(object):
+    """ Source for SimTCS34725Bus simulating visitors putting cubes on the station.
+        A cube stays present seconds, then the sensor sees the ambient light for absent
+        seconds. colors is a list of [name, [r, g, b]] (as config['color']) and is used
+        in order, each color repeat times, or randomly. Covered by a cube the sensor
+        sees the cube color with LED on and darkness with LED off. The LED state is
+        taken from led_pin of gpio, changes take effect after led_settle seconds.
+        noise is the standard deviation added to every channel.
+    """
+    def __init__(self, colors, gpio, led_pin, present=2.0, absent=1.0, ambient=(300, 300, 300, 1000),
+                 led_settle=0.02, noise=1.0, repeat=1, shuffle=False, seed=None):
+        self.colors = colors
+        self.gpio = gpio
+        self.led_pin = led_pin
+        self.present = present
+        self.absent = absent
+        self.ambient = ambient
+        self.led_settle = led_settle
+        self.noise = noise
+        self.repeat = repeat
+        self.shuffle = shuffle
+        self.random = random.Random(seed)
+        self.start = None
+        self.placements = []
+
+    def cube(self, t):
+        """ Returns the index of the cube color at time t or None if no cube is present. """
+        if self.start is None:
+            self.start = t
+        period = self.present + self.absent
+        placement, pos = divmod(t - self.start, period)
+        # Start with an empty station
+        if pos < self.absent:
+            return None
+        placement = int(placement)
+        while len(self.placements) <= placement:
+            if self.shuffle:
+                self.placements.append(self.random.randrange(len(self.colors)))
+            else:
+                self.placements.append((len(self.placements) // self.repeat) % len(self.colors))
+        return self.placements[placement]
+
+    def __call__(self, t):
+        cube = self.cube(t)
+        led_on = self.gpio.input_at(self.led_pin, t - self.led_settle)
+        if cube is None:
+            rgbc = self.ambient
+            if led_on:
+                rgbc = [2 * v for v in rgbc]
+        elif led_on:
+            r, g, b = self.colors[cube][1]
+            rgbc = (r, g, b, r + g + b)
+        else:
+            rgbc = (0, 0, 0, 0)
+        return [v + self.random.gauss(0, self.noise) for v in rgbc]
+
+
+class TraceSource(object):
+    """ Source for SimTCS34725Bus replaying a recorded trace. Either a binary trace (see
+        rgbctrace.py, e.g. of ledsense.py record) or a text file with 't r g b c' per
+        line (t in seconds, separated by blanks or commas), lines starting with # are
+        ignored. With loop the trace restarts at its end, otherwise the last sample is held.
+    """
+    def __init__(self, path, loop=True):
+        import rgbctrace
+        self.times = []
+        self.samples = []
+        if rgbctrace.is_trace(path):
+            records = rgbctrace.load(path).records
+            self.times = records['t'].tolist()
+            self.samples = list(zip(*(records[channel].tolist() for channel in 'rgbc')))
+        else:
+            with open(path, 'r') as infile:
+                for line in infile:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    t, r, g, b, c = [float(v) for v in line.replace(',', ' ').split()]
+                    self.times.append(t)
+                    self.samples.append((r, g, b, c))
+        if not self.samples:
+            raise ValueError('Trace %s contains no samples' % path)
+        self.loop = loop
+        self.start = None
+
+    def __call__(self, t):
+        if self.start is None:
+            self.start = t - self.times[0]
+        elapsed = t - self.start
+        if self.loop and elapsed > self.times[-1]:
+            elapsed = self.times[0] + (elapsed - self.times[0]) % (self.times[-1] - self.times[0] or 1)
+        pos = bisect.bisect_right(self.times, elapsed) - 1
+        return self.samples[max(pos, 0)]
+
+
+class SimGPIO(object):
+    """ Simulated RPi.GPIO module. Inputs are driven by set_input(), which calls
+        registered event callbacks on matching edges like RPi.GPIO does. With a
+        clock the output history is kept, see input_at().
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.modes = {}
+        self.levels = {}
+        self.events = {}
+        self.changes = {}
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=PUD_OFF, initial=LOW):
+        with self.lock:
+            self.modes[pin] = mode
+            if pin in self.levels:
+                return
+            if mode == self.OUT:
+                self.levels[pin] = initial
+            else:
+                self.levels[pin] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+
+    def output(self, pin, value):
+        value = int(bool(value))
+        with self.lock:
+            old = self.levels.get(pin, self.LOW)
+            self.levels[pin] = value
+            if old != value:
+                self.changes[pin] = (self.clock(), old)
+
+    def input(self, pin):
+        with self.lock:
+            return self.levels.get(pin, self.LOW)
+
+    def input_at(self, pin, t):
+        """ Level of an output pin at time t, only the last change is remembered. """
+        with self.lock:
+            level = self.levels.get(pin, self.LOW)
+            changed, old = self.changes.get(pin, (None, level))
+        if changed is not None and t < changed:
+            return old
+        return level
+
+    def set_input(self, pin, value):
+        """ Drive an input pin from the outside and fire edge callbacks. """
+        value = int(bool(value))
+        with self.lock:
+            old = self.levels.get(pin, self.LOW)
+            self.levels[pin] = value
+            edge, callback = self.events.get(pin, (None, None))
+        if old == value or callback is None:
+            return
+        if edge == self.BOTH or (edge == self.FALLING and value == self.LOW) or \
+                (edge == self.RISING and value == self.HIGH):
+            callback(pin)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.lock:
+            self.events[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.events.pop(pin, None)
+
+    def cleanup(self):
+        with self.lock:
+            self.modes = {}
+            self.levels = {}
+            self.events = {}
+            self.changes = {}
+
+
+class SimTCS34725Bus(object):
+    """ Simulated SMBus with a TCS34725 attached. The sensor integrates continuously
+        while enabled, each completed cycle latches source(t) into the data registers.
+        STATUS, clear channel interrupt (thresholds and persistence) and the special
+        function interrupt clear behave like the real chip. Bus transfer time is
+        emulated with transfer_rate (bits/s), None disables the delay.
+        With reference, the (integration_time, gain) the source values are meant for, the
+        readings are scaled to the current integration time and gain and saturate like
+        the real chip. Without, the source values are used as they are.
+    """
+    def __init__(self, source=None, transfer_rate=100000, clock=time.monotonic, sleep=time.sleep,
+                 reference=None):
+        self.source = source or const_source()
+        self.transfer_rate = transfer_rate
+        self.reference = reference
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.RLock()
+        self.regs = [0] * 0x20
+        self.regs[TCS34725.TCS34725_ID] = 0x44
+        self.regs[TCS34725.TCS34725_ATIME] = 0xFF
+        self.transactions = 0
+        self.cycles = 0
+        self._start = None
+        self._pers_cnt = 0
+        self._gpio = None
+        self._int_pin = None
+        self._int_thread = None
+
+    def _transfer(self, nbytes):
+        self.transactions += 1
+        if self.transfer_rate:
+            # address + command + data
+            self.sleep((2 + nbytes) * SIM_BITS_PER_BYTE / self.transfer_rate)
+
+    def cycle_time(self):
+        return (256 - self.regs[TCS34725.TCS34725_ATIME]) * SIM_CYCLE_TIME
+
+    def _running(self):
+        enable = self.regs[TCS34725.TCS34725_ENABLE]
+        return (enable & TCS34725.TCS34725_ENABLE_PON) and (enable & TCS34725.TCS34725_ENABLE_AEN)
+
+    def _int_limits(self):
+        low = self.regs[TCS34725.TCS34725_AILTL] + 256 * self.regs[TCS34725.TCS34725_AILTH]
+        high = self.regs[TCS34725.TCS34725_AIHTL] + 256 * self.regs[TCS34725.TCS34725_AIHTH]
+        return low, high
+
+    def _update(self):
+        """ Evaluate all integration cycles completed until now. """
+        with self.lock:
+            if not self._running() or self._start is None:
+                return
+            cycle_time = self.cycle_time()
+            done = int((self.clock() - self._start) / cycle_time)
+            if done <= self.cycles:
+                return
+            first = max(self.cycles + 1, done - SIM_MAX_CYCLES_PER_UPDATE + 1)
+            low, high = self._int_limits()
+            pers = SIM_PERS_CYCLES[self.regs[TCS34725.TCS34725_PERS] & 0x0F]
+            status = self.regs[TCS34725.TCS34725_STATUS]
+            scale, max_count = self._get_scale()
+            for cycle in range(first, done + 1):
+                r, g, b, c = [int(min(max(scale * v, 0), max_count))
+                              for v in self.source(self._start + cycle * cycle_time)]
+                if self.regs[TCS34725.TCS34725_PERS] & 0x0F == TCS34725.TCS34725_PERS_NONE:
+                    self._pers_cnt = pers
+                elif c < low or c > high:
+                    self._pers_cnt += 1
+                else:
+                    self._pers_cnt = 0
+                if self.regs[TCS34725.TCS34725_ENABLE] & TCS34725.TCS34725_ENABLE_AIEN and \
+                        self._pers_cnt >= pers:
+                    status |= TCS34725.TCS34725_STATUS_AINT
+            for reg, value in ((TCS34725.TCS34725_CDATAL, c), (TCS34725.TCS34725_RDATAL, r),
+                               (TCS34725.TCS34725_GDATAL, g), (TCS34725.TCS34725_BDATAL, b)):
+                self.regs[reg] = value & 0xFF
+                self.regs[reg + 1] = value >> 8
+            self.regs[TCS34725.TCS34725_STATUS] = status | TCS34725.TCS34725_STATUS_AVALID
+            self.cycles = done
+            self._drive_int()
+
+    def _get_scale(self):
+        if self.reference is None:
+            return 1.0, 0xFFFF
+        integration_time = self.regs[TCS34725.TCS34725_ATIME]
+        return TCS34725.get_count_scale(integration_time, self.regs[TCS34725.TCS34725_CONTROL] & 0x03,
+                                        *self.reference), TCS34725.get_max_count(integration_time)
+
+    def _drive_int(self):
+        if self._gpio is None:
+            return
+        asserted = self.regs[TCS34725.TCS34725_STATUS] & TCS34725.TCS34725_STATUS_AINT
+        # INT is active low
+        self._gpio.set_input(self._int_pin, 0 if asserted else 1)
+
+    def connect_int(self, gpio, pin):
+        """ Wire the INT output to pin of a SimGPIO. A background thread evaluates the
+            integration cycles in time, so edges arrive without any bus access.
+        """
+        self._gpio = gpio
+        self._int_pin = pin
+        gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+        if self._int_thread is None:
+            self._int_thread = threading.Thread(target=self._int_loop, name='sim_tcs_int', daemon=True)
+            self._int_thread.start()
+
+    def _int_loop(self):
+        while 42:
+            with self.lock:
+                cycle_time = self.cycle_time()
+                if self._running() and self._start is not None:
+                    wait = self._start + (self.cycles + 1) * cycle_time - self.clock()
+                else:
+                    wait = cycle_time
+            self.sleep(max(wait, 0.0001))
+            self._update()
+
+    # SMBus interface
+
+    def read_byte_data(self, addr, cmd):
+        self._transfer(1)
+        self._update()
+        with self.lock:
+            return self.regs[cmd & 0x1F]
+
+    def read_i2c_block_data(self, addr, cmd, length):
+        self._transfer(length)
+        self._update()
+        reg = cmd & 0x1F
+        with self.lock:
+            return self.regs[reg:reg + length]
+
+    def write_byte_data(self, addr, cmd, value):
+        self._transfer(1)
+        self._update()
+        reg = cmd & 0x1F
+        with self.lock:
+            was_running = self._running()
+            changed = self.regs[reg] != value & 0xFF
+            self.regs[reg] = value & 0xFF
+            if reg == TCS34725.TCS34725_ENABLE and self._running() and not was_running:
+                self._start = self.clock()
+                self.cycles = 0
+                self.regs[TCS34725.TCS34725_STATUS] &= ~TCS34725.TCS34725_STATUS_AVALID
+            elif reg == TCS34725.TCS34725_ATIME and changed and self._running():
+                # The cycles completed so far were counted with the old cycle time
+                self._start = self.clock()
+                self.cycles = 0
+            if reg in (TCS34725.TCS34725_PERS, TCS34725.TCS34725_AILTL, TCS34725.TCS34725_AILTH,
+                       TCS34725.TCS34725_AIHTL, TCS34725.TCS34725_AIHTH):
+                self._pers_cnt = 0
+
+    def write_byte(self, addr, cmd):
+        self._transfer(0)
+        self._update()
+        with self.lock:
+            if cmd & TCS34725.TCS34725_COMMAND_SPECIAL == TCS34725.TCS34725_COMMAND_SPECIAL and \
+                    cmd & 0x1F == TCS34725.TCS34725_SPECIAL_INT_CLEAR:
+                self.regs[TCS34725.TCS34725_STATUS] &= ~TCS34725.TCS34725_STATUS_AINT
+                self._drive_int()
+
+
+class SimTCA9548A(object):
+    """ Simulated upstream SMBus with a TCA9548A multiplexer at address, the simulated
+        buses of the downstream channels are added with attach(). Transfers to other
+        addresses go to the bus of the connected channel, like the real chip they fail
+        if no channel or several channels with the same device are connected.
+    """
+    def __init__(self, address=0x70, transfer_rate=100000, sleep=time.sleep):
+        self.address = address
+        self.transfer_rate = transfer_rate
+        self.sleep = sleep
+        self.channels = {}
+        self.mask = 0
+        self.transactions = 0
+
+    def attach(self, channel, bus):
+        self.channels[channel] = bus
+
+    def _target(self):
+        buses = [bus for channel, bus in self.channels.items() if self.mask & (1 << channel)]
+        if len(buses) != 1:
+            raise OSError(121, 'Remote I/O error, %d devices connected by mask 0x%02x' % (len(buses), self.mask))
+        return buses[0]
+
+    # SMBus interface
+
+    def read_byte_data(self, addr, cmd):
+        return self._target().read_byte_data(addr, cmd)
+
+    def read_i2c_block_data(self, addr, cmd, length):
+        return self._target().read_i2c_block_data(addr, cmd, length)
+
+    def write_byte_data(self, addr, cmd, value):
+        return self._target().write_byte_data(addr, cmd, value)
+
+    def write_byte(self, addr, cmd):
+        if addr != self.address:
+            return self._target().write_byte(addr, cmd)
+        self.transactions += 1
+        if self.transfer_rate:
+            # address + control register
+            self.sleep(2 * SIM_BITS_PER_BYTE / self.transfer_rate)
+        self.mask = cmd & 0xFF
@@ -0,0 +1,82 @@
+"""Startup profile for ledsense.py --profile-startup.
+
+install() wraps the import statement and records how long every module takes to import,
+including the modules it imports itself. report() logs the slowest ones and the time since
+the process was started.
+"""
+
+import builtins
+import os
+import sys
+import time
+
+# Number of modules listed by report()
+REPORT_MODULES = 15
+
+_orig_import = None
+_imports = []
+_depth = 0
+_reported = False
+
+
+def get_process_age():
+    """ Returns the seconds since the process was started (Linux only, 10 ms resolution)
+        or None if unknown.
+    """
+    try:
+        with open('/proc/self/stat') as infile:
+            # Field 22 is the start time in clock ticks after boot, the name (field 2) may contain spaces
+            start_ticks = int(infile.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as infile:
+            uptime = float(infile.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - 1.0 * start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+def _import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _depth
+    if level or name in sys.modules:
+        return _orig_import(name, globals, locals, fromlist, level)
+    start = time.perf_counter()
+    _depth += 1
+    try:
+        return _orig_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth -= 1
+        _imports.append((name, _depth, time.perf_counter() - start))
+
+
+def install():
+    global _orig_import
+    if _orig_import is None:
+        _orig_import = builtins.__import__
+        builtins.__import__ = _import
+
+
+def is_installed():
+    return _orig_import is not None
+
+
+def report(event):
+    """ Logs the import times and the time since the process start at event """
+    from helper import pr
+    age = get_process_age()
+    top = [entry for entry in _imports if entry[1] == 0]
+    pr('Startup profile: %s after %s' % (event, '%.0f ms' % (1000 * age) if age is not None else 'unknown time'))
+    pr('Startup profile: %d modules imported in %.0f ms' %
+       (len(_imports), 1000 * sum(duration for _, _, duration in top)))
+    for name, _, duration in sorted(top, key=lambda entry: -entry[2])[:REPORT_MODULES]:
+        pr('Startup profile: %8.1f ms %s' % (1000 * duration, name))
+
+
+def report_after_call(func, event):
+    """ Returns func, reporting once after its first call """
+    def wrapper(*args, **kwargs):
+        global _reported
+        res = func(*args, **kwargs)
+        if not _reported:
+            _reported = True
+            report(event)
+        return res
+    return wrapper
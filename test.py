@@ -1,19 +1,42 @@
 import unittest
 
+import concurrent.futures
 import numpy
 import pprint
 import os
 import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
+import yaml
+
+import acquisition
+import aioapp
+import asyncio
+import backend
+import classifier
 import ledsense
 import config
+import helper
+import i2cmux
+import json
+import latency
+import logging
+import mp3check
+import paramsweep
+import play_music
+import rgbctrace
+import sim
+import startup
 import TCS34725
+import traceanalysis
 
 #########################################################
-# IT'S NOT POSSIBLE TO CROSS DEVELOP THE TEST CASES!!!!!#
-#                                                       #
-# TEST NEED TO RUN ON TARGET (import RPi.GPIO as GPIO   #
+# Tests run off target against the simulated sensor     #
+# (sim.py).                                             #
 #########################################################
 
 MP3_TEST_FILE = 'test.mp3'
@@ -89,6 +112,742 @@ class CreateRGBMeasurement(object):
         return (tmp, tmp, tmp, tmp)
 
 
+class FakeSMBus(object):
+    """ Minimal register file of a TCS34725 that counts the I2C transactions """
+    def __init__(self):
+        self.regs = [0] * 0x20
+        self.regs[TCS34725.TCS34725_ID] = 0x44
+        self.transactions = 0
+
+    def set_rgbc(self, r, g, b, c):
+        for reg, value in ((TCS34725.TCS34725_RDATAL, r), (TCS34725.TCS34725_GDATAL, g),
+                           (TCS34725.TCS34725_BDATAL, b), (TCS34725.TCS34725_CDATAL, c)):
+            self.regs[reg] = value & 0xFF
+            self.regs[reg + 1] = value >> 8
+
+    def read_byte_data(self, addr, cmd):
+        self.transactions += 1
+        return self.regs[cmd & 0x1F]
+
+    def read_i2c_block_data(self, addr, cmd, length):
+        self.transactions += 1
+        reg = cmd & 0x1F
+        return self.regs[reg:reg + length]
+
+    def write_byte_data(self, addr, cmd, value):
+        self.transactions += 1
+        self.regs[cmd & 0x1F] = value
+
+
+class TestCaseTCS34725BurstRead(unittest.TestCase):
+    def setUp(self):
+        self.bus = FakeSMBus()
+        self.tcs = TCS34725.TCS34725(integration_time=TCS34725.TCS34725_INTEGRATIONTIME_2_4MS, i2c=self.bus)
+        self.tcs.set_sleep_factor(0)
+
+    def test_single_transaction(self):
+        self.bus.set_rgbc(0x1234, 0x5678, 0x9ABC, 0xDEF0)
+        self.bus.transactions = 0
+        ret = self.tcs.get_raw_data()
+        self.assertEqual(ret, (0x1234, 0x5678, 0x9ABC, 0xDEF0))
+        self.assertEqual(self.bus.transactions, 1, 'Expected one I2C transaction per sample')
+
+    def test_many(self):
+        self.bus.set_rgbc(1, 2, 65535, 4)
+        ret = self.tcs.get_raw_data_many(5)
+        self.assertEqual(ret.shape, (5, 4))
+        self.assertEqual(ret.tolist(), 5 * [[1, 2, 65535, 4]])
+
+
+class TestCaseTCS34725ReadyMode(unittest.TestCase):
+    INT_GPIO = 17
+
+    def setUp(self):
+        integration_time = TCS34725.TCS34725_INTEGRATIONTIME_24MS
+        self.cycle_time = TCS34725.INTEGRATION_TIME_DELAY[integration_time]
+        self.bus = sim.SimTCS34725Bus(source=self.cycle_source, transfer_rate=None)
+        self.gpio = sim.SimGPIO()
+        self.bus.connect_int(self.gpio, self.INT_GPIO)
+        self.tcs = TCS34725.TCS34725(integration_time=integration_time, i2c=self.bus)
+
+    def cycle_source(self, t):
+        return 0, 0, 0, int(t / self.cycle_time) & 0xFFFF
+
+    def check_fresh_samples(self):
+        last = self.tcs.get_raw_data()[3]
+        for _ in range(5):
+            c = self.tcs.get_raw_data()[3]
+            self.assertNotEqual(c, last, 'Expected a new integration cycle for every sample')
+            last = c
+
+    def test_status(self):
+        self.tcs.set_ready_mode(TCS34725.READY_MODE_STATUS)
+        self.check_fresh_samples()
+
+    def test_interrupt(self):
+        self.tcs.set_ready_mode(TCS34725.READY_MODE_INTERRUPT, gpio=self.gpio, int_pin=self.INT_GPIO)
+        self.check_fresh_samples()
+
+    def test_interrupt_needs_pin(self):
+        self.assertRaises(ValueError, self.tcs.set_ready_mode, TCS34725.READY_MODE_INTERRUPT)
+
+    def test_interrupt_limits(self):
+        self.tcs.set_interrupt_limits(0x1234, 0xABCD)
+        regs = self.bus.regs[TCS34725.TCS34725_AILTL:TCS34725.TCS34725_AIHTH + 1]
+        self.assertEqual(regs, [0x34, 0x12, 0xCD, 0xAB])
+
+    def test_clear_interrupt(self):
+        self.tcs.set_ready_mode(TCS34725.READY_MODE_STATUS)
+        self.assertTrue(self.tcs.wait_data_ready())
+        self.tcs.clear_interrupt()
+        status = self.bus.regs[TCS34725.TCS34725_STATUS]
+        self.assertFalse(status & TCS34725.TCS34725_STATUS_AINT)
+
+
+class TestCaseDetectCubeInterrupt(unittest.TestCase):
+    INT_GPIO = 17
+    THRESHOLD = 10
+    NO_CUBE = (100, 100, 100, 500)
+    CUBE = (50, 50, 50, 5)
+
+    def setUp(self):
+        self.source = sim.ScriptSource([(0.3, self.NO_CUBE), (0.3, self.CUBE), (1.0, self.NO_CUBE)])
+        self.bus = sim.SimTCS34725Bus(source=self.source, transfer_rate=None)
+        self.gpio = sim.SimGPIO()
+        self.bus.connect_int(self.gpio, self.INT_GPIO)
+        ledsense.GPIO = self.gpio
+        ledsense.tcs = TCS34725.TCS34725(integration_time=TCS34725.TCS34725_INTEGRATIONTIME_2_4MS, i2c=self.bus)
+        ledsense.tcs.set_ready_mode(TCS34725.READY_MODE_STATUS)
+
+    def detect(self):
+        c = ledsense.detect_cube(self.THRESHOLD)
+        self.assertLess(c, self.THRESHOLD)
+        c = ledsense.detect_cube_removal(self.THRESHOLD)
+        self.assertGreater(c, self.THRESHOLD)
+
+    def test_interrupt(self):
+        ledsense.tcs.set_int_pin(self.gpio, self.INT_GPIO)
+        self.detect()
+        # 0.6s at 2.4ms integration time, polling would need more than 250 reads
+        self.assertLess(self.bus.transactions, 100, 'Expected no polling while waiting for the cube')
+
+    def test_interrupt_sampler_paused(self):
+        ledsense.tcs.set_int_pin(self.gpio, self.INT_GPIO)
+        ledsense.sampler = acquisition.AcquisitionThread(ledsense.tcs.get_raw_data, acquisition.SampleBuffer(),
+                                                         time.monotonic)
+        ledsense.sampler.start()
+        try:
+            self.detect()
+            self.assertLess(self.bus.transactions, 200, 'Expected the sampler to be paused while waiting')
+            self.assertFalse(ledsense.sampler.paused)
+            # The samples are taken by the sampler again
+            consumed = ledsense.sampler.buffer.consumed
+            self.assertGreater(ledsense.measure()[3], self.THRESHOLD)
+            self.assertEqual(ledsense.sampler.buffer.consumed, consumed + 1)
+        finally:
+            ledsense.sampler.exit(3)
+            ledsense.sampler = None
+
+    def test_interrupt_persistence(self):
+        ledsense.tcs.set_int_pin(self.gpio, self.INT_GPIO)
+        self.source.steps = [(0.3, self.NO_CUBE), (0.01, self.CUBE), (0.3, self.NO_CUBE), (0.3, self.CUBE),
+                             (1.0, self.NO_CUBE)]
+        start = time.monotonic()
+        ledsense.detect_cube(self.THRESHOLD, TCS34725.TCS34725_PERS_10_CYCLE)
+        # The short dip must be ignored by the sensor
+        self.assertGreater(time.monotonic() - start, 0.6)
+
+    def test_interrupt_timeout(self):
+        ledsense.tcs.set_int_pin(self.gpio, self.INT_GPIO)
+        self.source.steps = [(0.01, self.CUBE), (0.02, self.NO_CUBE)] * 20 + [(0.3, self.CUBE), (1.0, self.NO_CUBE)]
+        saved = ledsense.DET_INT_TIMEOUT
+        ledsense.DET_INT_TIMEOUT = 0.005
+        try:
+            start = time.monotonic()
+            ledsense.detect_cube(self.THRESHOLD, TCS34725.TCS34725_PERS_10_CYCLE)
+        finally:
+            ledsense.DET_INT_TIMEOUT = saved
+        # Neither a timeout nor re-arming may turn a short dip into a detection
+        self.assertGreater(time.monotonic() - start, 0.6)
+
+    def test_polling_fallback(self):
+        self.assertFalse(ledsense.tcs.has_int_pin())
+        self.detect()
+
+    def test_polling_persistence(self):
+        self.source.steps = [(0.01, self.CUBE), (0.02, self.NO_CUBE)] * 20 + [(0.3, self.CUBE), (1.0, self.NO_CUBE)]
+        start = time.monotonic()
+        ledsense.detect_cube(self.THRESHOLD, TCS34725.TCS34725_PERS_10_CYCLE)
+        self.assertGreater(time.monotonic() - start, 0.6)
+
+
+class TestCaseSimBackend(unittest.TestCase):
+    def setUp(self):
+        self.config_color = [['red', [3000, 1000, 1000]], ['green', [1000, 3000, 1000]],
+                             ['blue', [1000, 1000, 3000]]]
+        self.config_sim = {'speed': 10.0, 'station': 3, 'present': 1.0, 'absent': 0.5, 'seed': 42}
+
+    def test_station(self):
+        backend.select(backend.BACKEND_SIM, self.config_sim)
+        station = config.get_station(backend.get_gpio())
+        self.assertEqual(station, 3)
+
+    def test_cube_sequence(self):
+        ledsense.setup(config.DEF_CONFIG['sensor'], self.config_color, backend.BACKEND_SIM, self.config_sim)
+        for color_name, _ in 2 * self.config_color:
+            ledsense.detect_cube(config.DEF_DET_THRESHOLD)
+            ledsense.led_on()
+            rgb = ledsense.get_stable_rgb(config.DEF_RGB_STABLE_CNT, config.DEF_RGB_STABLE_DIST)
+            color = ledsense.get_color(rgb, self.config_color, config.DEF_RGB_MAX_DIST)
+            self.assertEqual(color[0], color_name)
+            ledsense.detect_cube_removal(config.DEF_DET_THRESHOLD)
+
+    def tearDown(self):
+        backend.select(backend.BACKEND_RPI)
+
+
+class TestCaseLedHoldoff(unittest.TestCase):
+    LED_SETTLE = 0.02
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.saved = (ledsense.DEF_PATH_CAL, ledsense.LED_HOLDOFF_CAL_START, ledsense.LED_HOLDOFF_CAL_CYCLES)
+        ledsense.DEF_PATH_CAL = self.path + '/'
+        ledsense.LED_HOLDOFF_CAL_START = 0.05
+        ledsense.LED_HOLDOFF_CAL_CYCLES = 5
+        sensor = dict(config.DEF_CONFIG['sensor'], integration_time=(TCS34725.TCS34725_INTEGRATIONTIME_2_4MS,),
+                      led_settle_early=True)
+        config_sim = dict(config.DEF_SIM_CONFIG, speed=2.0, present=1000.0, absent=0.1, led_settle=self.LED_SETTLE)
+        self.config = config.Config(dict(config.DEF_CONFIG, sensor=sensor, sim=config_sim))
+        ledsense.setup(self.config['sensor'], self.config['color'], backend.BACKEND_SIM, config_sim)
+
+    def tearDown(self):
+        ledsense.DEF_PATH_CAL, ledsense.LED_HOLDOFF_CAL_START, ledsense.LED_HOLDOFF_CAL_CYCLES = self.saved
+        ledsense.set_led_holdoff(config.DEF_SENSOR_LED_HOLDOFF, config.DEF_SENSOR_LED_SETTLE_EARLY)
+        backend.select(backend.BACKEND_RPI)
+        shutil.rmtree(self.path)
+
+    def test_is_led_settled(self):
+        self.assertTrue(ledsense.is_led_settled(True, 0, 9700, 9710))
+        self.assertFalse(ledsense.is_led_settled(True, 0, 5000, 9710))
+        self.assertFalse(ledsense.is_led_settled(True, 0, 5, 3))
+        self.assertTrue(ledsense.is_led_settled(False, 9700, 2, 0))
+        # A change in the wrong direction is an old sample
+        self.assertFalse(ledsense.is_led_settled(False, 0, 9700, 9710))
+
+    def test_settle_early(self):
+        ledsense.detect_cube(config.DEF_DET_THRESHOLD)
+        for _ in range(3):
+            start = backend.monotonic()
+            ledsense.led_on()
+            waited = backend.monotonic() - start
+            self.assertGreater(waited, self.LED_SETTLE)
+            self.assertLess(waited, config.DEF_SENSOR_LED_HOLDOFF)
+            self.assertGreater(ledsense.measure()[3], 500)
+            # The reading before the switch is taken by switch_led(), not an old one
+            ledsense.last_rgb_measurement = [0, 0, 0, 0]
+            start = backend.monotonic()
+            ledsense.led_off()
+            self.assertLess(backend.monotonic() - start, config.DEF_SENSOR_LED_HOLDOFF)
+            self.assertLess(ledsense.measure()[3], 100)
+
+    def test_settle_early_needs_two_samples(self):
+        sensor = dict(self.config['sensor'], integration_time=(TCS34725.TCS34725_INTEGRATIONTIME_50MS,))
+        ledsense.setup(sensor, self.config['color'], backend.BACKEND_SIM, self.config['sim'])
+        self.assertTrue(ledsense.LED_SETTLE_EARLY)
+        self.assertFalse(ledsense.is_settle_early())
+        measure = ledsense.measure
+        ledsense.measure = None
+        try:
+            self.assertAlmostEqual(ledsense.wait_led_settled(True), config.DEF_SENSOR_LED_HOLDOFF, places=2)
+            ledsense.GPIO.output(ledsense.GPIO_LED, ledsense.GPIO.LOW)
+            ledsense.led_on()
+        finally:
+            ledsense.measure = measure
+
+    def test_cal_holdoff(self):
+        holdoff = ledsense.cal_holdoff(self.config, 1)
+        self.assertGreater(holdoff, self.LED_SETTLE - TCS34725.INTEGRATION_TIME_DELAY[0xFF])
+        self.assertLess(holdoff, 2 * self.LED_SETTLE)
+        self.assertEqual(ledsense.LED_TOGGLE_HOLDOFF, holdoff)
+        fns = os.listdir(self.path)
+        self.assertEqual(len(fns), 1)
+        cal = config.load(os.path.join(self.path, fns[0]), cache=False)
+        self.assertEqual(cal['sensor']['led_holdoff'], holdoff)
+        self.assertEqual(cal['station'], 1)
+
+
+class TestCaseAcquisition(unittest.TestCase):
+    def tearDown(self):
+        if ledsense.sampler is not None:
+            ledsense.sampler.exit(3)
+            ledsense.sampler = None
+        ledsense.set_led_holdoff(config.DEF_SENSOR_LED_HOLDOFF, config.DEF_SENSOR_LED_SETTLE_EARLY)
+        backend.select(backend.BACKEND_RPI)
+
+    def test_buffer_drops_oldest(self):
+        buf = acquisition.SampleBuffer(3)
+        for i in range(5):
+            buf.put((i, i, i, i, i))
+        self.assertEqual(len(buf), 3)
+        self.assertEqual((buf.produced, buf.dropped), (5, 2))
+        self.assertEqual(buf.latest()[0], 4)
+        self.assertEqual([buf.get(0)[0] for _ in range(3)], [2, 3, 4])
+        self.assertIsNone(buf.get(0.01))
+        self.assertEqual(buf.consumed, 3)
+
+    def test_buffer_skip_before(self):
+        buf = acquisition.SampleBuffer(8)
+        for i in range(5):
+            buf.put((i, i, i, i, i))
+        buf.skip_before(3)
+        self.assertEqual(buf.get(0)[0], 3)
+        self.assertEqual(buf.skipped, 3)
+
+    def test_pause(self):
+        reads = []
+
+        def read():
+            reads.append(time.monotonic())
+            time.sleep(0.001)
+            return 1, 2, 3, 4
+        thread = acquisition.AcquisitionThread(read, acquisition.SampleBuffer(), time.monotonic)
+        thread.start()
+        thread.get()
+        thread.pause()
+        paused = len(reads)
+        time.sleep(0.05)
+        self.assertEqual(len(reads), paused)
+        thread.resume()
+        t, r, g, b, c = thread.get()
+        self.assertGreater(len(reads), paused)
+        self.assertGreaterEqual(t, reads[paused])
+        thread.pause()
+        thread.exit(1)
+        self.assertFalse(thread.is_alive())
+
+    def test_thread_error(self):
+        def read():
+            raise OSError(121, 'Remote I/O error')
+        thread = acquisition.AcquisitionThread(read, acquisition.SampleBuffer(), time.monotonic)
+        thread.start()
+        with self.assertRaises(RuntimeError):
+            thread.get()
+        self.assertIsInstance(thread.error, OSError)
+
+    def test_cube_cycle(self):
+        sensor = dict(config.DEF_CONFIG['sensor'], integration_time=(TCS34725.TCS34725_INTEGRATIONTIME_2_4MS,))
+        config_sim = dict(config.DEF_SIM_CONFIG, speed=2.0, present=1000.0, absent=0.1, led_settle=0.02)
+        ledsense.setup(sensor, config.DEF_CONFIG['color'], backend.BACKEND_SIM, config_sim)
+        ledsense.sampler = acquisition.AcquisitionThread(ledsense.tcs.get_raw_data, acquisition.SampleBuffer(),
+                                                         backend.monotonic)
+        ledsense.sampler.start()
+        ledsense.detect_cube(config.DEF_DET_THRESHOLD)
+        # The samples integrated during the full holdoff are skipped
+        ledsense.set_led_holdoff(config.DEF_SENSOR_LED_HOLDOFF, False)
+        for _ in range(3):
+            ledsense.led_on()
+            r, g, b, c = ledsense.measure()
+            self.assertGreater(c, 500)
+            self.assertEqual(ledsense.last_rgb_measurement, [r, g, b, c])
+            ledsense.led_off()
+            self.assertLess(ledsense.measure()[3], 100)
+        self.assertGreater(ledsense.sampler.buffer.skipped, 0)
+        self.assertIsNotNone(ledsense.sampler.buffer.latest())
+
+    def test_app2_latency_log_error(self):
+        cfg = config.Config(config.DEF_CONFIG)
+        ledsense.setup(cfg['sensor'], cfg['color'], backend.BACKEND_SIM, cfg['sim'])
+        path = tempfile.mkdtemp()
+        threads = threading.active_count()
+        with self.assertRaises(OSError):
+            ledsense.app2(cfg['det'], cfg['rgb'], cfg, latency_log=os.path.join(path, 'no', 'log'))
+        self.assertEqual(threading.active_count(), threads)
+        shutil.rmtree(path)
+        self.assertIsNone(ledsense.sampler)
+
+
+class TestCaseRgbcTrace(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.fn = os.path.join(self.path, 'test.rgbc')
+
+    def tearDown(self):
+        ledsense.set_led_holdoff(config.DEF_SENSOR_LED_HOLDOFF, config.DEF_SENSOR_LED_SETTLE_EARLY)
+        backend.select(backend.BACKEND_RPI)
+        shutil.rmtree(self.path)
+
+    def test_write_load(self):
+        with rgbctrace.TraceWriter(self.fn, {'sample_time': 0.1}, clock=lambda: 0.0) as writer:
+            for i in range(3):
+                writer.write(i, 2 * i, 3 * i, 65535, i == 1, t=0.1 * i)
+        # A record cut short is dropped when appending
+        with open(self.fn, 'ab') as outfile:
+            outfile.write(b'\x01\x02\x03')
+        self.assertEqual(len(rgbctrace.load(self.fn)), 3)
+        # Recorded with another sample time
+        self.assertRaises(ValueError, rgbctrace.TraceWriter, self.fn, {'sample_time': 1.0})
+        with rgbctrace.TraceWriter(self.fn, {'sample_time': 0.1, 'desc': 'second'}, clock=lambda: 0.0) as writer:
+            writer.write(7, 8, 9, 10, False, t=0.3)
+        self.assertTrue(rgbctrace.is_trace(self.fn))
+        trace = rgbctrace.load(self.fn)
+        self.assertEqual(trace.info, {'sample_time': 0.1})
+        self.assertEqual(trace.records['r'].tolist(), [0, 1, 2, 7])
+        self.assertEqual(trace.records['c'].tolist(), [65535, 65535, 65535, 10])
+        self.assertEqual(trace.records['led'].tolist(), [0, 1, 0, 0])
+        # Appended at least TRACE_APPEND_GAP after the last record
+        self.assertGreaterEqual(trace.records['t'][3] - trace.records['t'][2], rgbctrace.TRACE_APPEND_GAP)
+        self.assertLess(trace.get_duration(), rgbctrace.TRACE_APPEND_GAP + 1.0)
+
+        sensor = rgbctrace.ReplaySensor(trace)
+        self.assertEqual(sensor.get_raw_data(), (0, 0, 0, 65535))
+        sensor.sleep(0.15)
+        self.assertEqual(sensor.get_raw_data(), (2, 4, 6, 65535))
+        self.assertEqual(sensor.get_raw_data(), (7, 8, 9, 10))
+        self.assertRaises(rgbctrace.TraceEnd, sensor.get_raw_data)
+
+    def test_time_backwards(self):
+        with rgbctrace.TraceWriter(self.fn, {}, clock=lambda: 0.0) as writer:
+            writer.write(1, 2, 3, 4, False, t=1.0)
+            writer.write(1, 2, 3, 4, False, t=0.5)
+        self.assertRaises(ValueError, rgbctrace.load, self.fn)
+
+    def test_settling_not_recorded(self):
+        sensor = dict(config.DEF_CONFIG['sensor'], integration_time=(TCS34725.TCS34725_INTEGRATIONTIME_2_4MS,),
+                      led_settle_early=True)
+        config_sim = dict(config.DEF_SIM_CONFIG, present=1000.0, absent=0.1, led_settle=0.02)
+        ledsense.setup(sensor, config.DEF_CONFIG['color'], backend.BACKEND_SIM, config_sim)
+        ledsense.detect_cube(config.DEF_DET_THRESHOLD)
+        ledsense.trace_writer = rgbctrace.TraceWriter(self.fn, {}, backend.monotonic)
+        try:
+            ledsense.led_on()
+            ledsense.measure()
+            ledsense.led_off()
+        finally:
+            ledsense.trace_writer.close()
+            ledsense.trace_writer = None
+        # The readings before the two switches and the sample in between, none while settling
+        self.assertEqual(rgbctrace.load(self.fn).records['led'].tolist(), [0, 1, 1])
+
+    def test_not_a_trace(self):
+        with open(self.fn, 'w') as outfile:
+            outfile.write('0.0 1 2 3 4\n')
+        self.assertFalse(rgbctrace.is_trace(self.fn))
+        self.assertRaises(ValueError, rgbctrace.load, self.fn)
+        self.assertEqual(sim.TraceSource(self.fn)(0.0), (1.0, 2.0, 3.0, 4.0))
+
+    def test_record_replay(self):
+        colors = [['red', [4000, 1000, 1000]], ['green', [1000, 4000, 1000]], ['blue', [1000, 1000, 4000]]]
+        sensor = dict(config.DEF_CONFIG['sensor'], integration_time=(TCS34725.TCS34725_INTEGRATIONTIME_24MS,))
+        config_sim = dict(config.DEF_SIM_CONFIG, speed=4.0, present=1.0, absent=0.5)
+        cfg = config.Config(dict(config.DEF_CONFIG, color=colors, sensor=sensor, sim=config_sim))
+        ledsense.setup(cfg['sensor'], cfg['color'], backend.BACKEND_SIM, config_sim)
+        recorded = ledsense.record(cfg, self.fn, duration=4.0)
+        self.assertGreaterEqual(len(recorded), 2)
+        trace = rgbctrace.load(self.fn)
+        self.assertEqual(trace.info['station'], 1)
+        self.assertEqual(trace.info['rgb']['stable_cnt'], cfg['rgb']['stable_cnt'])
+        self.assertEqual(set(trace.records['led'].tolist()), {0, 1})
+
+        found = ledsense.replay(cfg, self.fn)
+        self.assertEqual([(name, dist) for _, name, dist in found], [(name, dist) for _, name, dist in recorded])
+        self.assertEqual(found[0][1], 'red')
+        times = [t for t, _, _ in found]
+        self.assertEqual(times, sorted(times))
+        self.assertLessEqual(times[-1], trace.records['t'][-1])
+
+        # The sim backend replays it in real time
+        source = sim.TraceSource(self.fn, loop=False)
+        self.assertEqual(source(0.0), tuple(int(v) for v in trace.records[0][['r', 'g', 'b', 'c']].tolist()))
+
+    def test_record_append_fast(self):
+        # The sim clock runs ahead of the wall clock and starts again with every setup
+        colors = [['red', [4000, 1000, 1000]], ['green', [1000, 4000, 1000]]]
+        sensor = dict(config.DEF_CONFIG['sensor'], integration_time=(TCS34725.TCS34725_INTEGRATIONTIME_24MS,))
+        config_sim = dict(config.DEF_SIM_CONFIG, speed=20.0, present=1.0, absent=0.5)
+        cfg = config.Config(dict(config.DEF_CONFIG, color=colors, sensor=sensor, sim=config_sim))
+        recorded = []
+        for _ in range(2):
+            ledsense.setup(cfg['sensor'], cfg['color'], backend.BACKEND_SIM, config_sim)
+            recorded += ledsense.record(cfg, self.fn, duration=10.0)
+        trace = rgbctrace.load(self.fn)
+        self.assertTrue((numpy.diff(trace.records['t']) >= 0).all())
+        # The replay gets through both recordings
+        found = ledsense.replay(cfg, self.fn)
+        self.assertEqual([name for _, name, _ in found], [name for _, name, _ in recorded])
+
+
+class TestCaseTraceAnalysis(unittest.TestCase):
+    COLORS = [['red', [4000, 1000, 1000]], ['green', [1000, 4000, 1000]]]
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.fn = os.path.join(self.path, 'test.rgbc')
+        # 0.1 s per sample. Each event: cube detected after 2 covered samples, LED on with one
+        # sample while the LED settles, then the stable color; after the LED is switched off one
+        # sample sees the LED within the holdoff, the cube stays for 3 samples.
+        samples = [(1000, 0)] * 5
+        for rgb, shadow in (([4000, 1000, 1000], False), ([1000, 4000, 1000], True), ([4010, 990, 1000], False)):
+            if shadow:
+                samples += [(400, 0)] * 2 + [(1000, 0)] * 3
+            samples += [(300, 0), (0, 0)]
+            samples += [([2000, 2000, 2000], 1)] + [(rgb, 1)] * 6
+            samples += [(9000, 0)] + [(0, 0)] * 3 + [(1000, 0)] * 5
+        self.data = self.write_trace(self.fn, samples)
+
+    def write_trace(self, fn, samples):
+        """ Writes samples of (clear or RGB, LED) 0.1 s apart, returns the TraceData of them """
+        info = {'sample_time': 0.1, 'led_holdoff': 0.15, 'rgb': {'stable_cnt': 7}}
+        with rgbctrace.TraceWriter(fn, info, clock=lambda: 0.0) as writer:
+            for i, (value, led) in enumerate(samples):
+                r, g, b = value if led else (0, 0, 0)
+                writer.write(r, g, b, sum(value) if led else value, led, t=0.1 * i)
+        return traceanalysis.TraceData(rgbctrace.load(fn), classifier.ColorClassifier(self.COLORS))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_detection(self):
+        self.assertEqual(len(self.data), 3)
+        detected, latency, false_triggers, merged = traceanalysis.analyse_detection(self.data, 100)
+        self.assertEqual((detected.tolist(), false_triggers), ([True] * 3, 0))
+        self.assertEqual(merged.tolist(), [False] * 3)
+        numpy.testing.assert_allclose(latency, [0.0] * 3, atol=1e-5)
+        # The shadow triggers, the cube is detected one sample earlier
+        detected, latency, false_triggers, merged = traceanalysis.analyse_detection(self.data, 500)
+        self.assertEqual((detected.tolist(), false_triggers), ([True] * 3, 1))
+        numpy.testing.assert_allclose(latency, [-0.1] * 3, atol=1e-5)
+        # The cube is never removed
+        detected, latency, false_triggers, merged = traceanalysis.analyse_detection(self.data, 2000)
+        self.assertEqual(detected.tolist(), [True, False, False])
+        self.assertEqual((merged.tolist(), false_triggers), ([False, True, True], 0))
+
+    def test_redetection(self):
+        # The recording detects the red cube again after a reading of 150, then the green one
+        samples = [(1000, 0)] * 5 + [(300, 0), (0, 0)] + [([4000, 1000, 1000], 1)] * 7
+        samples += [(9000, 0), (0, 0), (0, 0), (150, 0), (0, 0)] + [([4000, 1000, 1000], 1)] * 7
+        samples += [(9000, 0)] + [(0, 0)] * 3 + [(1000, 0)] * 5
+        samples += [(300, 0), (0, 0)] + [([1000, 4000, 1000], 1)] * 7 + [(9000, 0)] + [(0, 0)] * 3 + [(1000, 0)] * 5
+        fn = os.path.join(self.path, 'redetection.rgbc')
+        data = self.write_trace(fn, samples)
+        self.assertEqual(len(data), 3)
+        detected, _, false_triggers, merged = traceanalysis.analyse_detection(data, 100)
+        self.assertEqual((detected.tolist(), merged.tolist(), false_triggers), ([True] * 3, [False] * 3, 0))
+        detected, _, false_triggers, merged = traceanalysis.analyse_detection(data, 500)
+        self.assertEqual((detected.tolist(), merged.tolist(), false_triggers),
+                         ([True, False, True], [False, True, False], 0))
+
+        # Most thresholds merge the second event, it is a false trigger of 100 and no miss of the others
+        results = traceanalysis.analyse([fn], self.COLORS, thresholds=[100, 500, 800], stable_cnts=(3,),
+                                        stable_dists=(50,), max_dists=(50,), processes=1)
+        self.assertEqual([(res['threshold'], res['events'], res['false_triggers'], res['missed'], res['accuracy'])
+                          for res in results], [(100, 2, 1, 0.0, 1.0), (500, 2, 0, 0.0, 1.0), (800, 2, 0, 0.0, 1.0)])
+
+    def test_time_backwards(self):
+        trace = rgbctrace.load(self.fn)
+        records = numpy.array(trace.records)
+        records['t'][3] = records['t'][2] - 1.0
+        self.assertRaises(ValueError, traceanalysis.TraceData, rgbctrace.Trace(self.fn, trace.info, records),
+                          classifier.ColorClassifier(self.COLORS))
+
+    def test_stable(self):
+        cls = classifier.ColorClassifier(self.COLORS)
+        self.assertEqual(self.data.ref_index.tolist(), [0, 1, 0])
+        latency, index, dist = traceanalysis.analyse_stable(self.data, cls, 3, 50)
+        self.assertEqual(index.tolist(), [0, 1, 0])
+        self.assertEqual(dist.tolist(), [0, 0, 14])
+        # Detection, the settling sample and three stable ones
+        numpy.testing.assert_allclose(latency, [0.4] * 3, atol=1e-5)
+        # The settling sample is no neighbour within the limit
+        latency, index, dist = traceanalysis.analyse_stable(self.data, cls, 7, 50)
+        self.assertTrue(numpy.isnan(latency).all())
+        self.assertEqual(traceanalysis.analyse_stable(self.data, cls, 7, 5000)[1].tolist(), [0, 1, 0])
+
+    def test_analyse(self):
+        kwargs = dict(thresholds=[100, 500, 2000], stable_cnts=(3, 7), stable_dists=(50,), max_dists=(10, 20))
+        results = traceanalysis.analyse([self.fn], self.COLORS, processes=1, **kwargs)
+        self.assertEqual(len(results), 3 * 2 * 2)
+        self.assertEqual(results, traceanalysis.analyse([self.fn], self.COLORS, processes=2, **kwargs))
+        res = results[0]
+        self.assertEqual((res['threshold'], res['stable_cnt'], res['max_dist']), (100, 3, 10))
+        self.assertEqual((res['events'], res['false_triggers'], res['rejected']), (3, 0, round(1 / 3.0, 4)))
+        self.assertEqual(res['accuracy'], round(2 / 3.0, 4))
+        self.assertEqual(results[1]['accuracy'], 1.0)
+        self.assertEqual(results[2]['unstable'], 1.0)
+        self.assertIsNone(results[2]['total_ms'])
+
+        front = paramsweep.mark_pareto(results, traceanalysis.OBJECTIVES)
+        for res in results:
+            dominated = any(paramsweep.dominates(other, res, traceanalysis.OBJECTIVES) for other in results
+                            if other['total_ms'] is not None and res['total_ms'] is not None)
+            if res['total_ms'] is not None:
+                self.assertEqual(res['pareto'], not dominated)
+        best = traceanalysis.pick(front)
+        self.assertEqual((best['threshold'], best['stable_cnt'], best['max_dist']), (100, 3, 20))
+
+        out_fn = os.path.join(self.path, 'analysis.json')
+        ledsense.trace_analysis(config.Config(dict(config.DEF_CONFIG, color=self.COLORS)), [self.fn], out_fn, 1)
+        with open(out_fn) as infile:
+            saved = json.load(infile)
+        # Not beyond the stable_cnt of the recording
+        self.assertEqual(max(res['stable_cnt'] for res in saved['results']), 7)
+        self.assertEqual(len(saved['results']), len(traceanalysis.get_thresholds([self.data])) *
+                         len(range(2, 8)) * len(traceanalysis.ANALYSIS_STABLE_DISTS) *
+                         len(traceanalysis.ANALYSIS_MAX_DISTS))
+        self.assertEqual(saved['pick']['accuracy'], 1.0)
+
+
+class TestCaseSweep(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        backend.select(backend.BACKEND_RPI)
+        shutil.rmtree(self.path)
+
+    def test_pareto(self):
+        results = [
+            {'samples_per_s': 400, 'stable_ms': 10, 'accuracy': 0.5},
+            {'samples_per_s': 40, 'stable_ms': 100, 'accuracy': 1.0},
+            {'samples_per_s': 20, 'stable_ms': 200, 'accuracy': 1.0},
+            {'samples_per_s': 40, 'stable_ms': 80, 'accuracy': 1.0},
+        ]
+        front = paramsweep.mark_pareto(results)
+        self.assertEqual(front, [results[0], results[3]])
+        self.assertEqual([res['pareto'] for res in results], [True, False, False, True])
+        self.assertIs(paramsweep.pick(front), results[3])
+        self.assertIsNone(paramsweep.pick([]))
+
+    def test_sweep_sim(self):
+        config_sim = dict(config.DEF_SIM_CONFIG, speed=10.0, present=1000.0, absent=0.1)
+        cfg = config.Config(dict(config.DEF_CONFIG, sim=config_sim))
+        ledsense.setup(cfg['sensor'], cfg['color'], backend.BACKEND_SIM, config_sim)
+        grid = paramsweep.get_grid((TCS34725.TCS34725_INTEGRATIONTIME_2_4MS, TCS34725.TCS34725_INTEGRATIONTIME_24MS),
+                                   (TCS34725.TCS34725_GAIN_1X, TCS34725.TCS34725_GAIN_16X), (3,), (30,))
+        csv_fn = os.path.join(self.path, 'sweep.csv')
+        results = ledsense.sweep(cfg, 2, csv_fn, grid)
+        self.assertEqual(len(results), 4)
+        by_settings = dict(((res['integration_time'], res['gain']), res) for res in results)
+        # 2.4 ms and no gain: too few counts to tell the colors apart
+        self.assertEqual(by_settings[(TCS34725.TCS34725_INTEGRATIONTIME_2_4MS, TCS34725.TCS34725_GAIN_1X)]['accuracy'],
+                         0.0)
+        self.assertEqual(by_settings[(TCS34725.TCS34725_INTEGRATIONTIME_24MS, TCS34725.TCS34725_GAIN_16X)]['accuracy'],
+                         1.0)
+        self.assertGreater(by_settings[(TCS34725.TCS34725_INTEGRATIONTIME_2_4MS, TCS34725.TCS34725_GAIN_16X)]
+                           ['samples_per_s'],
+                           by_settings[(TCS34725.TCS34725_INTEGRATIONTIME_24MS, TCS34725.TCS34725_GAIN_16X)]
+                           ['samples_per_s'])
+        self.assertTrue(any(res['pareto'] for res in results))
+        with open(csv_fn) as infile:
+            lines = infile.read().splitlines()
+        self.assertEqual(lines[0].split(','), list(paramsweep.FIELDS))
+        self.assertEqual(len(lines), 5)
+        # The sensor is back at the configured settings
+        self.assertEqual(ledsense.tcs.get_integration_time(), cfg['sensor']['integration_time'][0])
+
+    def test_sweep_misclassified(self):
+        # Saturated readings are grey, closer to the grey of the palette than to the red cube
+        colors = [['red', [4000, 1000, 1000]], ['grey', [1300, 1300, 1300]]]
+        config_sim = dict(config.DEF_SIM_CONFIG, speed=20.0, present=1000.0, absent=0.1)
+        cfg = config.Config(dict(config.DEF_CONFIG, color=colors, sim=config_sim,
+                                 rgb=dict(config.DEF_CONFIG['rgb'], max_dist=100000)))
+        ledsense.setup(cfg['sensor'], cfg['color'], backend.BACKEND_SIM, config_sim)
+        grid = paramsweep.get_grid((TCS34725.TCS34725_INTEGRATIONTIME_50MS, TCS34725.TCS34725_INTEGRATIONTIME_700MS),
+                                   (TCS34725.TCS34725_GAIN_16X, TCS34725.TCS34725_GAIN_60X), (3,), (30,))
+        results = ledsense.sweep(cfg, 1, None, grid)
+        by_settings = dict(((res['integration_time'], res['gain']), res) for res in results)
+        self.assertEqual(by_settings[(TCS34725.TCS34725_INTEGRATIONTIME_50MS, TCS34725.TCS34725_GAIN_16X)]
+                         ['accuracy'], 1.0)
+        self.assertEqual(by_settings[(TCS34725.TCS34725_INTEGRATIONTIME_700MS, TCS34725.TCS34725_GAIN_60X)]
+                         ['accuracy'], 0.0)
+
+
+class TestCaseMultiSensor(unittest.TestCase):
+    def tearDown(self):
+        backend.select(backend.BACKEND_RPI)
+        if os.path.exists(config.DEF_MP3_CHECK_CACHE_FN):
+            os.remove(config.DEF_MP3_CHECK_CACHE_FN)
+
+    def test_mux(self):
+        sim_mux = sim.SimTCA9548A(transfer_rate=None)
+        sim_mux.attach(0, sim.SimTCS34725Bus(source=sim.const_source(1, 2, 3, 6), transfer_rate=None))
+        sim_mux.attach(5, sim.SimTCS34725Bus(source=sim.const_source(4, 5, 6, 15), transfer_rate=None))
+        mux = i2cmux.TCA9548A(sim_mux)
+        sensors = [TCS34725.TCS34725(integration_time=TCS34725.TCS34725_INTEGRATIONTIME_2_4MS,
+                                     i2c=mux.get_channel(channel)) for channel in (0, 5)]
+        self.assertEqual(sensors[0].get_raw_data(), (1, 2, 3, 6))
+        self.assertEqual(sensors[1].get_raw_data(), (4, 5, 6, 15))
+        switches = mux.switches
+        sensors[1].get_raw_data()
+        self.assertEqual(mux.switches, switches, 'The connected channel must not be selected again')
+        self.assertRaises(ValueError, mux.get_channel, 8)
+        mux.select(None)
+        self.assertRaises(OSError, sim_mux.read_byte_data, TCS34725.TCS34725_ADDRESS, TCS34725.TCS34725_ID)
+
+    def test_overlapping_sensors(self):
+        sensors = [{'mux_channel': 0, 'led_gpio': 4, 'station': 1},
+                   {'mux_channel': 1, 'led_gpio': 17, 'station': 2},
+                   {'bus': 3, 'led_gpio': 27, 'station': 3}]
+        config_sim = dict(config.DEF_SIM_CONFIG, speed=4.0)
+        cfg = config.Config(dict(config.DEF_CONFIG, sensors=sensors, sim=config_sim))
+        throughput = ledsense.app_multi(cfg, ledsense.setup_sensors(cfg, backend.BACKEND_SIM), duration=6.0)
+        self.assertEqual([entry['station'] for entry in throughput], [1, 2, 3])
+        sample_time = TCS34725.INTEGRATION_TIME_DELAY[cfg['sensor']['integration_time'][0]]
+        for entry in throughput:
+            # Sampled one after another each sensor would get a third of the samples
+            self.assertGreater(entry['samples_per_s'], 0.7 / sample_time)
+            self.assertGreaterEqual(entry['cubes'], 1)
+
+
+class TestCaseAsyncStation(unittest.TestCase):
+    def tearDown(self):
+        backend.select(backend.BACKEND_RPI)
+        if os.path.exists(config.DEF_MP3_CHECK_CACHE_FN):
+            os.remove(config.DEF_MP3_CHECK_CACHE_FN)
+
+    def test_player(self):
+        sink = play_music.NullSink(track_time=0.05)
+        mp3_index = config.get_mp3_index([[1, 'red', 'red']])
+
+        async def play():
+            executor = concurrent.futures.ThreadPoolExecutor(1)
+            player = aioapp.AsyncPlayer(mp3_index, 1, executor, sink)
+            task = asyncio.ensure_future(player.run())
+            player.start_playing('red')
+            while not sink.played:
+                await asyncio.sleep(0.01)
+            self.assertEqual(player.playing, 'red')
+            while player.playing is not None:
+                await asyncio.sleep(0.01)
+            player.start_playing('red')
+            await asyncio.sleep(0.02)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self.assertEqual(player.playing, 'red', 'Cancelling does not call the sink in the loop')
+            await asyncio.get_running_loop().run_in_executor(executor, player.stop_track)
+            executor.shutdown()
+            return player
+
+        player = asyncio.run(play())
+        self.assertEqual(len(sink.played), 2)
+        self.assertIsNone(player.playing)
+        self.assertEqual(sink.stopped, 1)
+
+    def test_station(self):
+        sensors = [{'mux_channel': 0, 'led_gpio': 4, 'station': 1},
+                   {'mux_channel': 1, 'led_gpio': 17, 'station': 2}]
+        config_sim = dict(config.DEF_SIM_CONFIG, speed=4.0)
+        cfg = config.Config(dict(config.DEF_CONFIG, sensors=sensors, sim=config_sim))
+        threads = threading.active_count()
+        throughput = ledsense.app_async(cfg, ledsense.setup_sensors(cfg, backend.BACKEND_SIM), duration=6.0)
+        self.assertEqual([entry['station'] for entry in throughput], [1, 2])
+        sample_time = TCS34725.INTEGRATION_TIME_DELAY[cfg['sensor']['integration_time'][0]]
+        for entry in throughput:
+            self.assertGreater(entry['samples_per_s'], 0.7 / sample_time)
+            self.assertGreaterEqual(entry['cubes'], 1)
+        self.assertEqual(threading.active_count(), threads, 'All executor threads end with the station')
+
+
 class TestCaseGetStableRgb(unittest.TestCase):
     def dummyfunc(self):
         return 0, 0, 0, 0
@@ -96,7 +855,7 @@ class TestCaseGetStableRgb(unittest.TestCase):
     def setUp(self):
         self.rgb = CreateRGBMeasurement()
         # Dummy setup for TCS
-        ledsense.tcs = tcs = TCS34725.TCS34725(integration_time=0, gain=0, i2c=1)
+        ledsense.tcs = tcs = TCS34725.TCS34725(integration_time=0, gain=0, i2c=sim.SimTCS34725Bus())
 
     def test_same_input_cnt_gt_2(self):
         cnt = 10
@@ -153,6 +912,80 @@ class TestCaseGetStableRgb(unittest.TestCase):
             self.assertEqual(ret, [avg, avg, avg], 'Returned RGB must match input RGB')
 
 
+class TestCaseStableRgbWindow(unittest.TestCase):
+    def test_outlier(self):
+        cnt = 5
+        window = helper.StableRgbWindow(cnt, 10)
+        samples = [[100, 100, 100]] * 20
+        samples[3] = [200, 100, 100]
+        for i, rgb in enumerate(samples):
+            if window.add(rgb):
+                break
+        # Outlier leaves the window cnt samples after the pair (3, 4)
+        self.assertEqual(window.get_sample_cnt(), 4 + cnt)
+        self.assertEqual(window.get_restarts(), 2)
+        self.assertEqual(window.get_median(), [100, 100, 100])
+
+    def test_stable_from_start(self):
+        cnt = 5
+        window = helper.StableRgbWindow(cnt, 10)
+        for i in range(cnt - 1):
+            self.assertFalse(window.add([i, i, i]))
+        self.assertTrue(window.add([cnt, cnt, cnt]))
+        self.assertEqual(window.get_restarts(), 0)
+
+    def test_cnt_le_2(self):
+        self.assertRaises(ValueError, helper.StableRgbWindow, 1, 10)
+
+
+class TestCaseRgbHelper(unittest.TestCase):
+    def setUp(self):
+        self.rand = numpy.random.RandomState(0)
+
+    def test_distance_length(self):
+        for rgb1, rgb2 in zip(self.rand.randint(0, 65536, (500, 3)).tolist(),
+                              self.rand.randint(0, 65536, (500, 3)).tolist()):
+            ref = numpy.linalg.norm(numpy.array(rgb1) - numpy.array(rgb2)).astype(int).tolist()
+            self.assertEqual(helper.get_rgb_distance(rgb1, rgb2), ref)
+            self.assertEqual(helper.get_rgb_distance(tuple(rgb1), tuple(rgb2)), ref)
+            self.assertEqual(helper.get_rgb_length(rgb1), numpy.linalg.norm(rgb1).astype(int).tolist())
+
+    def test_median_std(self):
+        for cnt in (1, 2, 5, 10, helper.RGB_LIST_PYTHON_MAX + 1):
+            rgb_list = self.rand.randint(0, 65536, (cnt, 3)).tolist()
+            self.assertEqual(helper.get_rgb_median(rgb_list), numpy.median(rgb_list, axis=0).astype(int).tolist())
+            self.assertEqual(helper.get_rgb_std(rgb_list), numpy.std(rgb_list, axis=0).astype(int).tolist())
+
+    def test_arrays(self):
+        rgb1 = self.rand.randint(0, 65536, (100, 3))
+        rgb2 = self.rand.randint(0, 65536, (100, 3))
+        dists = helper.get_rgb_distance_array(rgb1, rgb2)
+        self.assertEqual(dists.tolist(), [helper.get_rgb_distance(a, b) for a, b in zip(rgb1.tolist(), rgb2.tolist())])
+        self.assertEqual(helper.get_rgb_length_array(rgb1).tolist(), [helper.get_rgb_length(a) for a in rgb1.tolist()])
+        self.assertEqual(helper.get_rgb_median_array(rgb1).tolist(), helper.get_rgb_median(rgb1.tolist()))
+        self.assertEqual(helper.get_rgb_std_array(rgb1).tolist(), helper.get_rgb_std(rgb1.tolist()))
+
+
+class TestCaseRunningRgbStats(unittest.TestCase):
+    def test_against_full_calculation(self):
+        rand = numpy.random.RandomState(1)
+        stats = helper.RunningRgbStats()
+        values = []
+        for rgb in rand.randint(0, 5000, (200, 3)).tolist():
+            values.append(rgb)
+            stats.add(rgb)
+            self.assertEqual(stats.get_median(), numpy.median(values, axis=0).astype(int).tolist())
+            self.assertEqual(stats.get_std(), numpy.std(values, axis=0).astype(int).tolist())
+        self.assertEqual(stats.get_cnt(), 200)
+
+    def test_to_dict(self):
+        stats = helper.RunningRgbStats.from_values([[1, 2, 3], [3, 4, 5]])
+        res = yaml.safe_load(yaml.dump(stats.to_dict()))
+        self.assertEqual(res['cnt'], 2)
+        self.assertEqual(res['median'], [2, 3, 4])
+        self.assertEqual(res['std'], [1, 1, 1])
+
+
 class TestCaseGetColor(unittest.TestCase):
     def setUp(self):
         self.config_color = []
@@ -187,6 +1020,412 @@ class TestCaseGetColor(unittest.TestCase):
                 self.assertEqual(color, None, 'Colorname: Expected %s, got %s' % (str(i), color))
 
 
+class TestCaseColorClassifier(unittest.TestCase):
+    def linear_scan(self, rgb, config_color):
+        # Reference: the original get_color implementation
+        min_dist = 999999999
+        match = 0
+        for i, color in enumerate(config_color):
+            dist = helper.get_rgb_distance(rgb, color[1])
+            if dist < min_dist:
+                min_dist = dist
+                match = i
+        return match, min_dist
+
+    def check_palette(self, color_cnt):
+        rand = numpy.random.RandomState(color_cnt)
+        config_color = [[str(i), rand.randint(0, 5000, 3).tolist()] for i in range(color_cnt)]
+        # Some equal colors to check the order on equal distances
+        config_color += config_color[:3]
+        color_classifier = classifier.ColorClassifier(config_color)
+        for rgb in rand.randint(0, 5000, (200, 3)).tolist() + [color[1] for color in config_color]:
+            self.assertEqual(color_classifier.classify(rgb), self.linear_scan(rgb, config_color))
+
+    def test_small_palette(self):
+        self.check_palette(10)
+
+    def test_large_palette(self):
+        self.check_palette(2 * classifier.KDTREE_MIN_COLORS)
+
+    def check_batch(self, color_cnt):
+        rand = numpy.random.RandomState(color_cnt)
+        config_color = [[str(i), rand.randint(0, 5000, 3).tolist()] for i in range(color_cnt)]
+        config_color += config_color[:3]
+        color_classifier = classifier.ColorClassifier(config_color)
+        samples = rand.randint(0, 5000, (500, 3)).tolist() + [color[1] for color in config_color]
+        indices, dists = color_classifier.classify_batch(samples)
+        for rgb, index, dist in zip(samples, indices, dists):
+            self.assertEqual((index, dist), self.linear_scan(rgb, config_color))
+
+    def test_batch_small_palette(self):
+        self.check_batch(10)
+
+    def test_batch_large_palette(self):
+        self.check_batch(2 * classifier.KDTREE_MIN_COLORS)
+
+    def test_get_color(self):
+        config_color = [['a', [0, 0, 0]], ['b', [100, 0, 0]]]
+        color_classifier = classifier.ColorClassifier(config_color)
+        self.assertEqual(ledsense.get_color([90, 0, 0], color_classifier, 10), ('b', [100, 0, 0], 10))
+        self.assertEqual(ledsense.get_color([50, 0, 0], color_classifier, 10), None)
+
+
+class TestCaseCalAnalysis(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.def_path_cal = ledsense.DEF_PATH_CAL
+        ledsense.DEF_PATH_CAL = self.path + '/'
+        self.files = []
+        for station in (1, 2):
+            values = [['red', [[1000, 10, 10], [1010, 10, 10], [10, 1000, 10]]],
+                      ['green', [[10, 1000, 10], [10, 1020, 10]]]]
+            cfg = {'det': {'threshold': 2}, 'rgb': {}, 'sensor': {}, 'station': station,
+                   'color': [['red', [1000, 10, 10]], ['green', [10, 1000, 10]]],
+                   'values': values}
+            fn = os.path.join(self.path, 'station_%d.yaml' % station)
+            with open(fn, 'w') as outfile:
+                yaml.dump(cfg, outfile)
+            self.files.append(fn)
+
+    def test_analysis(self):
+        ledsense.cal_analysis(self.files)
+        result = [fn for fn in os.listdir(self.path) if fn.endswith('_all.yaml')]
+        self.assertEqual(len(result), 1)
+        res = config.load(os.path.join(self.path, result[0]))
+        self.assertEqual(res['color'], [['red', [1000, 10, 10]], ['green', [10, 1010, 10]]])
+
+    def tearDown(self):
+        ledsense.DEF_PATH_CAL = self.def_path_cal
+        shutil.rmtree(self.path)
+
+
+class TestCasePlaybackController(unittest.TestCase):
+    def setUp(self):
+        self.map_station_mp3_color = [[1, 'red', 'red'], [1, 'green', 'green'], [2, 'blue', 'blue']]
+        self.sink = play_music.NullSink(track_time=60.0)
+        self.pm = play_music.PlaybackController(config.get_mp3_index(self.map_station_mp3_color), 1, sink=self.sink)
+        self.pm.start()
+
+    def test_start_stop(self):
+        self.assertTrue(self.pm.start_playing('red'))
+        self.assertEqual(self.sink.played, [config.DEF_PATH_MP3 + 'red.mp3'])
+        self.assertEqual(self.pm.playing, 'red')
+        self.assertTrue(self.pm.start_playing('green'))
+        self.assertEqual(self.sink.stopped, 1)
+        self.assertTrue(self.pm.stop_playing())
+        self.assertEqual(self.sink.stopped, 2)
+        self.assertIsNone(self.pm.playing)
+
+    def test_unknown_color(self):
+        # blue is defined for another station only
+        self.assertFalse(self.pm.start_playing('blue'))
+        self.assertEqual(self.sink.played, [])
+        self.assertTrue(self.pm.is_alive())
+
+    def test_track_end(self):
+        self.sink.track_time = 0.0
+        self.assertTrue(self.pm.start_playing('red'))
+        time.sleep(3 * play_music.BUSY_POLL_INTERVAL)
+        self.assertIsNone(self.pm.playing)
+
+    def test_latency(self):
+        start = time.monotonic()
+        self.pm.start_playing('red')
+        self.assertLess(time.monotonic() - start, 0.05)
+
+    def test_preload(self):
+        self.pm.stop_playing()
+        self.assertEqual(self.sink.loaded, [config.DEF_PATH_MP3 + 'red.mp3', config.DEF_PATH_MP3 + 'green.mp3'])
+        self.pm.start_playing('green')
+        self.assertEqual(self.pm.cache.hits, 1)
+
+    def test_exit(self):
+        self.pm.start_playing('red')
+        self.pm.exit(1)
+        self.assertFalse(self.pm.is_alive())
+        self.assertEqual(self.sink.stopped, 1)
+
+    def tearDown(self):
+        self.pm.exit(1)
+
+
+class TestCaseSharedSink(unittest.TestCase):
+    """ Two heads on one pygame output, the shared pygame.mixer.music and the mixer channels
+        are replaced by objects recording the calls
+    """
+    class Music(object):
+        def __init__(self):
+            self.fn = None
+            self.busy = False
+            self.stopped = 0
+
+        def load(self, fn):
+            self.fn = fn
+
+        def set_volume(self, volume):
+            pass
+
+        def get_volume(self):
+            return 1.0
+
+        def play(self):
+            self.busy = True
+
+        def stop(self):
+            self.busy = False
+            self.stopped += 1
+
+        def get_busy(self):
+            return self.busy
+
+    class Channel(object):
+        def __init__(self):
+            self.busy = True
+
+        def stop(self):
+            self.busy = False
+
+        def get_busy(self):
+            return self.busy
+
+    class Sound(object):
+        def set_volume(self, volume):
+            pass
+
+        def play(self):
+            return TestCaseSharedSink.Channel()
+
+    def setUp(self):
+        self.music = self.Music()
+        stream = play_music.MusicStream(self.music)
+        self.heads = [play_music.PygameSink(stream), play_music.PygameSink(stream)]
+
+    def test_stop_streamed_by_other(self):
+        self.heads[0].play('a.mp3')
+        self.heads[1].play('b.mp3', self.Sound())
+        self.assertTrue(self.heads[0].is_busy())
+        self.heads[1].stop()
+        self.assertFalse(self.heads[1].is_busy())
+        # The stream of head 0 goes on
+        self.assertEqual((self.music.busy, self.music.stopped), (True, 0))
+        self.heads[0].stop()
+        self.assertEqual((self.music.busy, self.music.stopped), (False, 1))
+
+    def test_stream_taken_over(self):
+        self.heads[0].play('a.mp3')
+        self.heads[1].play('b.mp3')
+        self.assertFalse(self.heads[0].is_busy())
+        self.assertTrue(self.heads[1].is_busy())
+        self.heads[0].stop()
+        self.assertEqual((self.music.fn, self.music.busy), ('b.mp3', True))
+        self.heads[1].stop()
+        self.assertFalse(self.music.busy)
+
+
+class TestCaseAudioCache(unittest.TestCase):
+    def setUp(self):
+        self.loads = []
+        self.cache = play_music.AudioCache(self.loader, max_bytes=100)
+
+    def loader(self, fn):
+        self.loads.append(fn)
+        if fn == 'broken':
+            return None, 0
+        return 'sound ' + fn, int(fn)
+
+    def test_hit(self):
+        self.assertEqual(self.cache.get((1, 'red'), '40'), 'sound 40')
+        self.assertEqual(self.cache.get((1, 'red'), '40'), 'sound 40')
+        self.assertEqual(self.loads, ['40'])
+        self.assertEqual((self.cache.hits, self.cache.misses, self.cache.size), (1, 1, 40))
+
+    def test_lru(self):
+        self.cache.preload([((1, 'red'), '40'), ((1, 'green'), '40')])
+        self.cache.get((1, 'red'), '40')
+        # Does not fit, green was used least recently
+        self.cache.get((1, 'blue'), '50')
+        self.assertNotIn((1, 'green'), self.cache)
+        self.assertIn((1, 'red'), self.cache)
+        self.assertEqual(self.cache.size, 90)
+
+    def test_too_large(self):
+        self.assertIsNone(self.cache.get((1, 'red'), '101'))
+        self.assertIsNone(self.cache.get((1, 'green'), 'broken'))
+        self.assertEqual(len(self.cache), 0)
+
+
+class TestCaseConfig(unittest.TestCase):
+    def setUp(self):
+        self.raw = {
+            'det': {'threshold': 2},
+            'color': [['red', [1000, 10, 10]], ['green', [10, 1000, 10]], ['blue', [10, 10, 1000]]],
+            'map_station_mp3_color': [[1, '011_red.mp3', 'red'], [1, '012_green.mp3', 'green'],
+                                      [2, '021_red.mp3', 'red'], [2, '022_yellow.mp3', 'yellow']],
+        }
+        self.config = config.Config(self.raw)
+
+    def test_indexes(self):
+        self.assertEqual(self.config['det'], {'threshold': 2})
+        self.assertEqual(self.config.get_rgb('green'), (10, 1000, 10))
+        self.assertEqual(self.config.color_matrix.shape, (3, 3))
+        self.assertEqual(self.config.stations, (1, 2))
+        self.assertEqual(self.config.station_colors[2], ('red', 'yellow'))
+        self.assertEqual(self.config.color_stations['red'], (1, 2))
+        self.assertEqual(self.config.get_mp3_fn(2, 'red'), '021_red.mp3')
+        self.assertRaises(config.MP3FileError, self.config.get_mp3_fn, 2, 'green')
+
+    def test_immutable(self):
+        self.assertRaises(AttributeError, setattr, self.config, 'colors', ())
+        with self.assertRaises(TypeError):
+            self.config.mp3_index[(1, 'blue')] = 'x.mp3'
+        self.assertRaises(ValueError, self.config.color_matrix.__setitem__, 0, 0)
+
+    def test_validate(self):
+        # blue is not in the map, yellow not in the colors
+        self.assertEqual(self.config.validate(), 2)
+
+    def test_round_trip(self):
+        path = tempfile.mkdtemp()
+        fn = os.path.join(path, 'config.yaml')
+        self.config.save(fn)
+        self.assertEqual(config.load(fn).to_dict(), self.raw)
+        shutil.rmtree(path)
+
+
+class TestCaseConfigLoad(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.fn = os.path.join(self.path, 'config.yaml')
+        shutil.copyfile(config.DEF_CONFIG_FN, self.fn)
+
+    def test_tuples(self):
+        # The sensor settings are python tuples, the safe loader must accept them
+        res = config.load(self.fn, cache=False)
+        with open(self.fn) as infile:
+            self.assertEqual(res, yaml.load(infile, Loader=yaml.Loader))
+        self.assertIsInstance(res['sensor']['gain'], tuple)
+
+    def test_cache(self):
+        res = config.load(self.fn)
+        self.assertTrue(os.path.isfile(self.fn + config.CONFIG_CACHE_SUFFIX))
+        self.assertEqual(config.load(self.fn), res)
+        # Changed content is parsed again
+        cfg = res.to_dict()
+        cfg['desc'] = 'changed'
+        with open(self.fn, 'w') as outfile:
+            config.dump(cfg, outfile)
+        self.assertEqual(config.load(self.fn)['desc'], 'changed')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+class TestCaseStartup(unittest.TestCase):
+    def test_process_age(self):
+        age = startup.get_process_age()
+        self.assertGreater(age, 0.0)
+        self.assertLess(age, 3600.0)
+
+    def test_lazy_imports(self):
+        # The sensor only subcommands must not pull in numpy, yaml, scipy or pygame
+        code = 'import sys, ledsense; print(" ".join(sorted(sys.modules)))'
+        modules = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True).split()
+        for name in ('numpy', 'yaml', 'scipy', 'pygame', 'play_music', 'classifier'):
+            self.assertNotIn(name, modules)
+
+    def test_report_sensors(self):
+        # The heads of multi read with read_raw_data, the first of them reports
+        code = ('import logging, startup; startup.install(); import backend, config, ledsense; '
+                'logging.basicConfig(level=logging.INFO); '
+                'sensors = ledsense.setup_sensors(config.Config(config.DEF_CONFIG), backend.BACKEND_SIM); '
+                'sensors[0][1].read_raw_data(); sensors[0][1].read_raw_data()')
+        output = subprocess.check_output([sys.executable, '-c', code], stderr=subprocess.STDOUT,
+                                         universal_newlines=True)
+        self.assertEqual(output.count('Startup profile: first sample'), 1)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+        self.threads.add(threading.current_thread().name)
+
+
+class TestCaseLogListener(unittest.TestCase):
+    def test_queued_records(self):
+        logger = logging.getLogger('test_log_listener')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        handler = ListHandler()
+        logger.addHandler(handler)
+        listener = helper.start_log_listener(logger, [handler])
+        try:
+            self.assertNotIn(handler, logger.handlers)
+            for i in range(100):
+                logger.debug('R: %5d G: %5d', i, 2 * i)
+        finally:
+            listener.stop()
+            logger.handlers = []
+        self.assertEqual(len(handler.messages), 100)
+        self.assertEqual(handler.messages[-1], 'R:    99 G:   198')
+        # Formatted and written by the listener thread only
+        self.assertNotIn(threading.current_thread().name, handler.threads)
+
+
+class TestCaseLatencyRecorder(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.path = tempfile.mkdtemp()
+        self.log_fn = os.path.join(self.path, 'latency.jsonl')
+        self.recorder = latency.LatencyRecorder(size=4, clock=lambda: self.now, log_fn=self.log_fn)
+
+    def add_event(self, stable_time, play=True):
+        self.recorder.start()
+        self.now += 0.06
+        self.recorder.mark(latency.STAGE_LED_ON)
+        self.now += stable_time
+        self.recorder.mark(latency.STAGE_STABLE)
+        self.recorder.set_window(10, 1)
+        self.recorder.mark(latency.STAGE_CLASSIFIED)
+        if play:
+            self.now += 0.001
+            self.recorder.mark(latency.STAGE_PLAYING)
+        self.recorder.finish('red', 5)
+        self.now += 1.0
+
+    def test_summary(self):
+        for i in range(6):
+            self.add_event(0.1 * i, play=i != 5)
+        times, samples, restarts = self.recorder.get_events()
+        # Only the last 4 events are kept, oldest first
+        self.assertEqual(len(times), 4)
+        self.assertTrue(numpy.all(numpy.diff(times[:, 0]) > 0))
+        summary = self.recorder.get_summary(percentiles=(0, 100))
+        self.assertEqual(summary['events'], 4)
+        self.assertEqual(summary['led_on'], [60.0, 60.0])
+        self.assertEqual(summary['stable'], [200.0, 500.0])
+        self.assertEqual(summary['playing'], [1.0, 1.0])
+        self.assertEqual(summary['total'], [261.0, 560.0])
+        self.assertEqual(summary['samples'], [10, 10])
+
+    def test_log(self):
+        self.add_event(0.5)
+        self.recorder.close()
+        with open(self.log_fn) as infile:
+            events = [json.loads(line) for line in infile]
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0]['color'], events[0]['samples'], events[0]['restarts']), ('red', 10, 1))
+        self.assertAlmostEqual(events[0]['playing'], 561.0)
+
+    def tearDown(self):
+        self.recorder.close()
+        shutil.rmtree(self.path)
+
+
 class TestCaseCheckConfigsColorVsMapMp3(unittest.TestCase):
     def setUp(self):
         self.station_cnt = 10
@@ -262,10 +1501,50 @@ class TestCaseCheckForValidMp3(unittest.TestCase):
         os.remove(DEF_PATH_MP3 + MP3_TEST_FILE_COPY)
 
 
+class TestCaseMp3Check(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.fn = os.path.join(self.path, MP3_TEST_FILE)
+        with open(DEF_PATH_MP3 + MP3_TEST_FILE, 'rb') as infile:
+            self.data = infile.read()
+
+    def write(self, data):
+        with open(self.fn, 'wb') as outfile:
+            outfile.write(data)
+        return mp3check.check_mp3(self.fn)
+
+    def test_correct_file(self):
+        ret = self.write(self.data)
+        self.assertEqual(ret['result'], 'Ok')
+        self.assertEqual(ret['errors'], 'none')
+        self.assertEqual((ret['frames'], ret['samplerate'], ret['time']), ('288', '44100', '0:07.523'))
+
+    def test_truncated_file(self):
+        ret = self.write(self.data[:-1000])
+        self.assertEqual(ret['result'], 'Bad')
+        self.assertEqual(ret['errors'], mp3check.ERROR_UNIDENTIFIED)
+
+    def test_removed_bytes_in_frame(self):
+        ret = self.write(self.data[:100000] + self.data[100002:])
+        self.assertEqual(ret['result'], 'Bad')
+        self.assertEqual(ret['frames'], '287')
+
+    def test_empty_file(self):
+        ret = self.write(b'')
+        self.assertEqual(ret['errors'], mp3check.ERROR_EMPTY_FILE)
+        ret = self.write(b'ID3\x03\x00\x00\x00\x00\x00\x00')
+        self.assertEqual(ret['errors'], mp3check.ERROR_NO_FRAMES)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
 class TestCaseCheckMp3Files(unittest.TestCase):
     def setUp(self):
         shutil.copyfile(DEF_PATH_MP3 + MP3_TEST_FILE, DEF_PATH_MP3 + MP3_TEST_FILE_COPY)
+        self.convert_fn = config.convert_fn
         config.convert_fn = test_convert_fn
+        self.check_valid_mp3_content = config.check_valid_mp3_content
 
     def test_correct_files(self):
         # Setup config map_station_mp3_color and test after each step
@@ -304,7 +1583,40 @@ class TestCaseCheckMp3Files(unittest.TestCase):
                 map_station_mp3_color.append([station, 'dummy_fn', color])
                 self.assertRaises(config.MP3FileError, config.check_mp3_files, map_station_mp3_color)
 
+    def test_station_and_cache(self):
+        checked = []
+
+        def check_valid_mp3_content(path):
+            checked.append(path)
+            return {'result': 'Ok'}
+
+        config.check_valid_mp3_content = check_valid_mp3_content
+        cache_fn = os.path.join(tempfile.mkdtemp(), 'cache.yaml')
+        map_station_mp3_color = [[1, MP3_TEST_FILE_COPY, 'a'], [1, MP3_TEST_FILE_COPY, 'b'], [2, MP3_TEST_FILE, 'a']]
+        # Only station 1, the same file is checked once
+        self.assertEqual(config.check_mp3_files(map_station_mp3_color, 1, cache_fn, processes=1), 0)
+        self.assertEqual(checked, [DEF_PATH_MP3 + MP3_TEST_FILE_COPY])
+        # Cached
+        self.assertEqual(config.check_mp3_files(map_station_mp3_color, 1, cache_fn, processes=1), 0)
+        self.assertEqual(len(checked), 1)
+        # Changed file and full check
+        remove_bytes_from_file(DEF_PATH_MP3 + MP3_TEST_FILE_COPY, 6000)
+        self.assertEqual(config.check_mp3_files(map_station_mp3_color, None, cache_fn, processes=1), 0)
+        self.assertEqual(sorted(checked[1:]),
+                         sorted([DEF_PATH_MP3 + MP3_TEST_FILE_COPY, DEF_PATH_MP3 + MP3_TEST_FILE]))
+        # Another checker does not reuse the results
+        checker = config.MP3_CHECKER
+        config.MP3_CHECKER = 'mpck'
+        try:
+            self.assertEqual(config.check_mp3_files(map_station_mp3_color, None, cache_fn, processes=1), 0)
+        finally:
+            config.MP3_CHECKER = checker
+        self.assertEqual(len(checked), 5)
+        shutil.rmtree(os.path.dirname(cache_fn))
+
     def tearDown(self):
+        config.check_valid_mp3_content = self.check_valid_mp3_content
+        config.convert_fn = self.convert_fn
         os.remove(DEF_PATH_MP3 + MP3_TEST_FILE_COPY)
 
 
@@ -0,0 +1,341 @@
+"""Offline analysis of recorded traces (ledsense.py trace analysis).
+
+The detection (det.threshold) and the stable RGB search (rgb.stable_cnt, rgb.stable_dist,
+rgb.max_dist) are replayed with numpy over the whole sample arrays of binary traces (see
+rgbctrace.py), for every combination of the parameters.
+
+The LED of a recording is on while the recording looked for a stable RGB, so every run of
+LED on samples is a cube event. Its reference color is the classification of the median of
+the second half of the run, where the LED has settled. The LED off sample before the run
+is where the recording detected the cube.
+
+For a threshold the detection uses the LED off samples. After the cube of the previous
+event was removed (clear above the threshold), every drop below the threshold triggers a
+detection. The trigger the covered samples continue from up to the recording's detection
+detects the event; its latency is relative to the recording's detection, negative values
+are earlier. Every trigger no event claims is a false trigger. An event is missed if the
+clear reading at the recording's detection is not below the threshold. If the threshold
+saw no removal since the previous event, the event is merged into the previous one.
+
+The recording may have detected the same cube again, e.g. a noisy reading near its threshold.
+An event most of the analysed thresholds merge is such a re-detection: it is no event and
+a threshold that detects it has a false trigger. A threshold that merges one of the other
+events misses it.
+
+For stable_cnt and stable_dist the first window of the LED on run that StableRgbWindow
+would accept is searched, and its median is classified against the palette. A window can
+only be found within the recorded samples, the recording ended each run once its own
+window of rgb.stable_cnt samples was stable. Larger stable_cnts are not analysed.
+
+Detection and stable search are independent, the thresholds and the (stable_cnt,
+stable_dist) pairs are analysed by a process pool, the combinations are built by
+broadcasting the per event results.
+"""
+
+import warnings
+
+import numpy
+
+import paramsweep
+import rgbctrace
+from classifier import ColorClassifier
+from config import DEF_SENSOR_LED_HOLDOFF
+from helper import get_rgb_distance_array, pr
+
+# Thresholds are spread geometrically from 1 to the 99th percentile of the LED off clear readings
+ANALYSIS_THRESHOLD_STEPS = 32
+ANALYSIS_STABLE_CNTS = tuple(range(2, 11))
+ANALYSIS_STABLE_DISTS = (5, 10, 20, 30, 50, 75, 100, 150, 200)
+ANALYSIS_MAX_DISTS = (10, 20, 30, 50, 75, 100, 150, 200)
+
+# Rows of the Pareto front printed by report()
+ANALYSIS_REPORT_ROWS = 20
+
+# Columns of the CSV file
+FIELDS = ('threshold', 'stable_cnt', 'stable_dist', 'max_dist', 'events', 'accuracy', 'missed', 'unstable',
+          'rejected', 'misclassified', 'false_triggers', 'false_per_h', 'detect_ms', 'stable_ms', 'total_ms',
+          'pareto')
+
+# The Pareto front is built from these fields, True: larger is better (see paramsweep.mark_pareto)
+OBJECTIVES = (('accuracy', True), ('false_per_h', False), ('total_ms', False))
+
+
+class TraceData(object):
+    """ The arrays of a trace the analysis needs """
+    def __init__(self, trace, classifier):
+        records = trace.records
+        self.path = trace.path
+        self.duration = trace.get_duration()
+        # The stable_cnt of the recording, None if unknown
+        self.stable_cnt = trace.info.get('rgb', {}).get('stable_cnt')
+        t = numpy.asarray(records['t'], dtype=numpy.float64)
+        # The positions are searched in the times
+        if (numpy.diff(t) < 0).any():
+            raise ValueError('%s: Time goes backwards' % trace.path)
+        on = records['led'].astype(bool)
+        all_starts = numpy.flatnonzero(on & ~numpy.concatenate(([False], on[:-1])))
+        all_ends = numpy.flatnonzero(on & ~numpy.concatenate((on[1:], [False])))
+        # A run at the start of the trace has no detection
+        event = all_starts > 0
+        starts = all_starts[event]
+        ends = all_ends[event]
+
+        self.off_idx = numpy.flatnonzero(~on)
+        self.t_off = t[self.off_idx]
+        self.c_off = records['c'][self.off_idx].astype(numpy.int64)
+        # Position (in the LED off samples) of the recording's detection and of the first sample after the
+        # run and its LED holdoff, the samples before still see the LED
+        self.det_pos = numpy.searchsorted(self.off_idx, starts) - 1
+        holdoff = trace.info.get('led_holdoff', DEF_SENSOR_LED_HOLDOFF)
+        self.after_pos = numpy.searchsorted(self.t_off, t[ends] + holdoff)
+        settling = numpy.zeros(len(self.off_idx) + 1, dtype=int)
+        numpy.add.at(settling, numpy.searchsorted(self.off_idx, ends), 1)
+        numpy.add.at(settling, self.after_pos, -1)
+        self.settling = numpy.cumsum(settling)[:-1] > 0
+
+        on_idx = numpy.flatnonzero(on)
+        self.t_on = t[on_idx]
+        self.rgb_on = numpy.stack([records[channel][on_idx] for channel in 'rgb'], axis=1).astype(numpy.float64)
+        self.run_starts = numpy.searchsorted(on_idx, starts)
+        self.run_ends = numpy.searchsorted(on_idx, ends)
+        all_run_starts = numpy.searchsorted(on_idx, all_starts)
+        self.run_start_of = numpy.repeat(all_run_starts, all_ends - all_starts + 1)
+        # Distance of each LED on sample to the one before, pairs across runs are never inside a window
+        self.pair_dist = numpy.concatenate(([0], get_rgb_distance_array(self.rgb_on[1:], self.rgb_on[:-1])))
+        self.t_det = self.t_off[self.det_pos] if len(starts) else numpy.zeros(0)
+
+        ref_rgb = numpy.array([numpy.median(self.rgb_on[end - (end - start) // 2:end + 1], axis=0).astype(int)
+                               for start, end in zip(self.run_starts, self.run_ends)]).reshape(-1, 3)
+        self.ref_index = classifier.classify_batch(ref_rgb)[0] if len(ref_rgb) else numpy.zeros(0, dtype=int)
+
+    def __len__(self):
+        """ Number of events """
+        return len(self.det_pos)
+
+
+def get_thresholds(data, steps=ANALYSIS_THRESHOLD_STEPS):
+    """ Returns the thresholds to analyse for the TraceData list data """
+    c_off = numpy.concatenate([d.c_off for d in data])
+    top = max(2.0, numpy.percentile(c_off, 99)) if len(c_off) else 2.0
+    return numpy.unique(numpy.geomspace(1, top, steps).astype(int)).tolist()
+
+
+def analyse_detection(data, threshold):
+    """ Returns the detection of the events of data (TraceData) with threshold: whether each
+        event is detected, its latency in s (nan if not), the number of triggers no event
+        claims and whether each event is merged into the previous one, no removal in between
+    """
+    n = len(data.c_off)
+    pos = numpy.arange(n)
+    covered = (data.c_off < threshold) & ~data.settling
+    removed = (data.c_off > threshold) & ~data.settling
+    rising = covered & ~numpy.concatenate(([False], covered[:-1]))
+
+    def last_before(mask, none):
+        """ Position of the last True before each position 0..n """
+        return numpy.concatenate(([none], numpy.maximum.accumulate(numpy.where(mask, pos, none))))
+    # The start of the trace counts as removal. A drop below the threshold triggers a detection
+    # only if the cube was removed since the previous drop.
+    last_removed = last_before(removed, -1)
+    trigger = rising & (last_removed[:-1] > last_before(rising, -2)[:-1])
+    last_trigger = last_before(trigger, -1)
+
+    # First removal at or after each position
+    next_removed = numpy.concatenate((numpy.minimum.accumulate(numpy.where(removed, pos, n)[::-1])[::-1], [n]))
+    gap_start = numpy.concatenate(([0], next_removed[data.after_pos[:-1]]))
+    merged = gap_start > data.det_pos
+    det_trigger = last_trigger[data.det_pos + 1]
+    detected = ~merged & (det_trigger >= 0) & (last_removed[data.det_pos + 1] < det_trigger)
+    latency = numpy.full(len(data), numpy.nan)
+    latency[detected] = data.t_off[det_trigger[detected]] - data.t_off[data.det_pos[detected]]
+    unclaimed = int(trigger.sum()) - len(numpy.unique(det_trigger[detected]))
+    return detected, latency, unclaimed, merged
+
+
+def analyse_stable(data, classifier, stable_cnt, stable_dist):
+    """ Returns the stable RGB search of the events of data (TraceData) as StableRgbWindow(stable_cnt,
+        stable_dist) does, classified by classifier: the time from the recording's detection to
+        the stable RGB in s (nan if none was found), the index of the classified color and the
+        distance to it
+    """
+    n = len(data.rgb_on)
+    exceeded = numpy.concatenate(([0], numpy.cumsum(data.pair_dist > stable_dist)))
+    end = numpy.arange(n)
+    # The window ending at end holds the pairs ending at end - stable_cnt + 2 .. end
+    first_pair = numpy.clip(end - stable_cnt + 2, 0, n)
+    stable = (end - data.run_start_of >= stable_cnt - 1) & (exceeded[end + 1] == exceeded[first_pair])
+    found = numpy.full(len(data), n)
+    if len(data):
+        found = numpy.minimum.reduceat(numpy.where(stable, end, n), data.run_starts)
+    valid = found <= data.run_ends
+
+    latency = numpy.full(len(data), numpy.nan)
+    index = numpy.full(len(data), -1)
+    dist = numpy.full(len(data), numpy.iinfo(numpy.int64).max)
+    if valid.any():
+        window = found[valid][:, numpy.newaxis] + numpy.arange(1 - stable_cnt, 1)
+        medians = numpy.median(data.rgb_on[window], axis=1).astype(int)
+        index[valid], dist[valid] = classifier.classify_batch(medians)
+        latency[valid] = data.t_on[found[valid]] - data.t_det[valid]
+    return latency, index, dist
+
+
+# Set by init_worker(), the traces and the classifier of the process
+_data = None
+_classifier = None
+
+
+def init_worker(paths, colors):
+    """ Loads the traces (memory mapped, the pages are shared) and the palette of the process """
+    global _data, _classifier
+    _classifier = ColorClassifier(colors)
+    _data = [TraceData(rgbctrace.load(path), _classifier) for path in paths]
+
+
+def _detection_task(threshold):
+    results = [analyse_detection(d, threshold) for d in _data]
+    return (numpy.concatenate([r[0] for r in results]), numpy.concatenate([r[1] for r in results]),
+            sum(r[2] for r in results), numpy.concatenate([r[3] for r in results]))
+
+
+def _stable_task(params):
+    results = [analyse_stable(d, _classifier, *params) for d in _data]
+    return tuple(numpy.concatenate([r[i] for r in results]) for i in range(3))
+
+
+def _nanmedian_ms(values, axis):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return numpy.round(1000 * numpy.nanmedian(values, axis=axis), 1)
+
+
+def analyse(paths, colors, thresholds=None, stable_cnts=ANALYSIS_STABLE_CNTS, stable_dists=ANALYSIS_STABLE_DISTS,
+            max_dists=ANALYSIS_MAX_DISTS, processes=None):
+    """ Analyses all combinations of the parameters over the traces paths with the palette colors
+        (as config['color']), thresholds by default from get_thresholds(). The events most of the
+        thresholds merge are re-detections (see the module doc). stable_cnts larger than the one of a
+        recording are left out. processes: number of worker processes, None: one per
+        CPU, 1: no pool. Returns a list of dicts with the FIELDS,
+        sorted by threshold, stable_cnt, stable_dist and max_dist.
+    """
+    init_worker(paths, colors)
+    events = sum(len(d) for d in _data)
+    hours = sum(d.duration for d in _data) / 3600.0
+    if thresholds is None:
+        thresholds = get_thresholds(_data)
+    recorded_cnts = [d.stable_cnt for d in _data if d.stable_cnt is not None]
+    if recorded_cnts and max(stable_cnts) > min(recorded_cnts):
+        pr('Recorded with stable_cnt %d, not analysing larger ones', min(recorded_cnts))
+        stable_cnts = [cnt for cnt in stable_cnts if cnt <= min(recorded_cnts)]
+    pairs = [(cnt, dist) for cnt in stable_cnts for dist in stable_dists]
+    pr('Analysing %d events in %d traces (%.2f h): %d thresholds x %d stable windows x %d max distances',
+       events, len(paths), hours, len(thresholds), len(pairs), len(max_dists))
+    if processes == 1:
+        det = list(map(_detection_task, thresholds))
+        rgb = list(map(_stable_task, pairs))
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=init_worker,
+                                                    initargs=(paths, colors)) as executor:
+            det = list(executor.map(_detection_task, thresholds))
+            rgb = list(executor.map(_stable_task, pairs))
+
+    ref = numpy.concatenate([d.ref_index for d in _data])
+    detected = numpy.array([r[0] for r in det]).reshape(len(thresholds), events)
+    repeated = numpy.array([r[3] for r in det]).reshape(len(thresholds), events).mean(axis=0) > 0.5
+    if repeated.any():
+        pr('%d of the recorded events are re-detections of the previous cube', repeated.sum())
+    false_triggers = numpy.array([r[2] for r in det]) + (detected & repeated).sum(axis=1)
+    real = ~repeated
+    events = int(real.sum())
+    ref = ref[real]
+    # Shapes: detection (threshold, 1, 1, event), stable search (1, pair, 1, event), max_dist (1, 1, max_dist, 1)
+    detected = detected[:, real].reshape(len(thresholds), 1, 1, events)
+    det_latency = numpy.array([r[1] for r in det])[:, real].reshape(len(thresholds), 1, 1, events)
+    stable_latency = numpy.array([r[0] for r in rgb])[:, real].reshape(1, len(pairs), 1, events)
+    match = (numpy.array([r[1] for r in rgb])[:, real] == ref).reshape(1, len(pairs), 1, events)
+    accepted = numpy.array([r[2] for r in rgb])[:, real].reshape(1, len(pairs), 1, events) <= \
+        numpy.array(max_dists).reshape(1, 1, -1, 1)
+    stable = ~numpy.isnan(stable_latency)
+
+    shape = (len(thresholds), len(pairs), len(max_dists))
+    counts = {
+        'accuracy': (detected & stable & accepted & match).sum(axis=3),
+        'missed': (~detected).sum(axis=3),
+        'unstable': (detected & ~stable).sum(axis=3),
+        'rejected': (detected & stable & ~accepted).sum(axis=3),
+        'misclassified': (detected & stable & accepted & ~match).sum(axis=3),
+    }
+    counts = dict((field, numpy.broadcast_to(count, shape)) for field, count in counts.items())
+    detect_ms = numpy.broadcast_to(_nanmedian_ms(det_latency, axis=3), shape)
+    stable_ms = numpy.broadcast_to(_nanmedian_ms(numpy.where(detected, stable_latency, numpy.nan), axis=3), shape)
+    total_ms = numpy.broadcast_to(_nanmedian_ms(det_latency + stable_latency, axis=3), shape)
+
+    results = []
+    for i, j, k in numpy.ndindex(*shape):
+        res = {'threshold': thresholds[i], 'stable_cnt': pairs[j][0], 'stable_dist': pairs[j][1],
+               'max_dist': max_dists[k], 'events': events, 'false_triggers': int(false_triggers[i]),
+               'false_per_h': round(false_triggers[i] / hours, 1) if hours > 0 else 0.0}
+        for field, count in counts.items():
+            res[field] = round(count[i, j, k] / events, 4) if events else 0.0
+        for field, values in (('detect_ms', detect_ms), ('stable_ms', stable_ms), ('total_ms', total_ms)):
+            res[field] = None if numpy.isnan(values[i, j, k]) else float(values[i, j, k])
+        results.append(res)
+    return results
+
+
+def get_sort_key(res):
+    """ The most accurate result first, of those the one with the fewest false triggers, then the fastest """
+    return -res['accuracy'], res['false_per_h'], res['total_ms'] if res['total_ms'] is not None else numpy.inf
+
+
+def pick(front):
+    """ Returns the recommended result of the Pareto front, the first by get_sort_key(). Of the
+        equal ones the one in the middle of their thresholds, stable_cnts, stable_dists and
+        max_dists, the furthest from the parameters where the results change. None if front is empty.
+    """
+    if not front:
+        return None
+    best = min(get_sort_key(res) for res in front)
+    equal = [res for res in front if get_sort_key(res) == best]
+    for field in ('threshold', 'stable_cnt', 'stable_dist', 'max_dist'):
+        values = sorted(set(res[field] for res in equal))
+        middle = values[len(values) // 2]
+        equal = [res for res in equal if res[field] == middle]
+    return equal[0]
+
+
+def format_result(res):
+    def ms(value):
+        return '-' if value is None else '%.1f' % value
+    return '%5d %3d %4d %4d | %7.1f%% %6.1f%% %6.1f%% %6.1f%% %6.1f%% %8.1f %8s %8s %8s %s' % (
+        res['threshold'], res['stable_cnt'], res['stable_dist'], res['max_dist'], 100 * res['accuracy'],
+        100 * res['missed'], 100 * res['unstable'], 100 * res['rejected'], 100 * res['misclassified'],
+        res['false_per_h'], ms(res['detect_ms']), ms(res['stable_ms']), ms(res['total_ms']),
+        '*' if res.get('pareto') else '')
+
+
+RESULT_HEADER = '%5s %3s %4s %4s | %8s %7s %7s %7s %7s %8s %8s %8s %8s' % (
+    'Thres', 'Cnt', 'Dist', 'Max', 'Accuracy', 'Missed', 'Unstab.', 'Reject.', 'Miscl.', 'False/h', 'Det. ms',
+    'Stab. ms', 'Total ms')
+
+
+def report(results, rows=ANALYSIS_REPORT_ROWS):
+    """ Marks and prints the Pareto front, at most rows and of results equal in all objectives
+        only the pick. Returns the pick of the front.
+    """
+    front = paramsweep.mark_pareto(results, OBJECTIVES)
+    groups = {}
+    for res in front:
+        groups.setdefault(get_sort_key(res), []).append(res)
+    pr('Pareto front: %d of %d combinations, %d different, latencies are medians relative to the recorded detection',
+       len(front), len(results), len(groups))
+    pr(RESULT_HEADER + ' Equal')
+    for key in sorted(groups)[:rows]:
+        pr('%s %5d', format_result(pick(groups[key])), len(groups[key]))
+    best = pick(front)
+    if best is not None:
+        pr('Recommended: det threshold %d, rgb stable_cnt %d, stable_dist %d, max_dist %d',
+           best['threshold'], best['stable_cnt'], best['stable_dist'], best['max_dist'])
+    return best
+